@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+import tempfile
+import spacy
+from spacy.symbols import NOUN, ADJ
+from tqdm import tqdm
+from argparse import ArgumentParser
+
+# the ADJ/NOUN head walk only needs part-of-speech tags (tagger +
+# attribute_ruler) and dependency heads (parser), so skip the rest
+EXCLUDED_COMPONENTS = ['ner', 'lemmatizer', 'senter']
+
+def load_parser():
+    return spacy.load("en_core_web_sm", exclude=EXCLUDED_COMPONENTS)
+
+def get_adj_noun(parsed_sample):
+    adj_noun_str = ""
+    for possible_adj in parsed_sample:
+        if possible_adj.pos == ADJ:
+            ancestor = possible_adj.head
+            levels = 0
+            while (ancestor.dep_ != "ROOT" and levels < 5):
+                if ancestor.pos == NOUN:
+                    break
+                ancestor = ancestor.head
+                levels += 1
+            if ancestor.pos == NOUN:
+                adj_noun_str += " " + possible_adj.text + " " + ancestor.text
+            else:
+                adj_noun_str += " " + possible_adj.text
+    return adj_noun_str
+
+def desc_key(desc):
+    return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+def load_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path, 'r') as cache_file:
+        return json.load(cache_file)
+
+def save_cache(cache, cache_path):
+    # write then rename, so an interrupted run never leaves a truncated cache.
+    # the file written is this process's own, so concurrent writers never
+    # write into each other's
+    cache_file = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(cache_path) or '.',
+                                             prefix=os.path.basename(cache_path) + '.', suffix='.tmp', delete=False)
+    try:
+        with cache_file:
+            json.dump(cache, cache_file)
+        os.replace(cache_file.name, cache_path)
+    except BaseException:
+        os.remove(cache_file.name)
+        raise
+
+def extract_adj_nouns(descriptions, cache_path, batch_size=256, n_process=1, base_cache_path=None):
+    """
+    Parameters
+    ----------
+    descriptions: iterable of str
+        descriptions to extract adjective/noun strings from
+    cache_path: str
+        json file mapping desc_key(description) -> adj_noun string.
+        only descriptions missing from it are parsed
+    batch_size, n_process:
+        passed on to nlp.pipe
+    base_cache_path: str
+        cache of the same layout that is read but not written, e.g. the
+        merged cache when cache_path is the cache of one shard
+
+    Returns
+    -------
+    cache: dict
+        the updated cache, covering every description
+    """
+    cache = load_cache(cache_path)
+    known = load_cache(base_cache_path) if base_cache_path is not None else {}
+    known.update(cache)
+    missing = {}
+    for desc in descriptions:
+        key = desc_key(desc)
+        if key not in known:
+            missing[key] = desc
+    if len(missing) > 0:
+        nlp = load_parser()
+        # extra processes only pay off with several batches to hand out
+        n_process = max(1, min(n_process, len(missing) // batch_size))
+        docs = nlp.pipe(missing.values(), batch_size=batch_size, n_process=n_process)
+        for key, doc in tqdm(zip(missing.keys(), docs), total=len(missing)):
+            cache[key] = get_adj_noun(doc)
+        save_cache(cache, cache_path)
+        known.update(cache)
+    return known
+
+def merge_caches(cache_paths, cache_path):
+    """
+    adds the entries of the caches at cache_paths, e.g. those written by the
+    shards of a preprocessing run, to the cache at cache_path
+    """
+    cache = load_cache(cache_path)
+    for path in cache_paths:
+        cache.update(load_cache(path))
+    save_cache(cache, cache_path)
+    return cache
+
+if __name__ == "__main__":
+    argp = ArgumentParser()
+    argp.add_argument('--root',
+        help='dataset root containing annotations.json', default='dataset')
+    argp.add_argument('--batch_size',
+        help='descriptions per nlp.pipe batch', type=int, default=256)
+    argp.add_argument('--n_process',
+        help='number of spacy processes', type=int, default=os.cpu_count())
+    args = argp.parse_args()
+
+    with open(os.path.join(args.root, 'annotations.json'), 'r') as annotations_file:
+        model2desc = json.load(annotations_file)
+    descriptions = [desc for descs in model2desc.values() for desc in descs]
+    cache_path = os.path.join(args.root, 'processed', 'adj_noun_cache.json')
+    cache = extract_adj_nouns(descriptions, cache_path, args.batch_size, args.n_process)
+    print(len(cache), 'descriptions in', cache_path)
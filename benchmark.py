@@ -0,0 +1,504 @@
+import os
+import time
+import numpy as np
+from glob import glob
+from argparse import ArgumentParser
+
+# micro-benchmarks for the data and geometry kernels, e.g.
+#   python benchmark.py obj --limit 200
+#   python benchmark.py adj --subdivisions 2 3 4 5 6
+#   python benchmark.py chamfer --points 1000 10000 100000 --threads 8
+#   python benchmark.py pooling --batch_size 16 --verts 642 2562
+#   python benchmark.py grad_cache --batch_size 64 --chunk_size 8
+#   python benchmark.py contrastive --meshes 1000 10000 --chunk_size 1024
+#   python benchmark.py ddp --workers 1 2 4 8 --batch_size 256
+
+def timed(fn, *args, repeat=3, **kwargs):
+    """
+    best wall-clock time of repeat calls to fn, in seconds
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def legacy_obj_loader(fileName):
+    # the line-by-line parser utils.ObjLoader used before read_obj
+    vertices = []
+    faces = []
+    with open(fileName) as f:
+        for line in f:
+            line = line.replace('//','/')
+            if line[:2] == "v ":
+                index1 = line.find(" ") + 1
+                index2 = line.find(" ", index1 + 1)
+                index3 = line.find(" ", index2 + 1)
+                vertex = (float(line[index1:index2]), float(line[index2:index3]), float(line[index3:-1]))
+                vertices.append(vertex)
+            elif line[0] == "f":
+                string = line.split(' ')
+                string = string[1:]
+                string.reverse()
+                face = [int(s.split('/')[0]) for s in string]
+                faces.append(face)
+    return vertices, faces
+
+def legacy_batched_pooling(blocks, verts_pos, img_info):
+    # the index_select version of utils.batched_pooling, before grid_sample
+    import torch
+    from utils import batch_camera_info
+
+    cam_mat, cam_pos = batch_camera_info(img_info)
+    pt_trans = torch.matmul((verts_pos * .57) - cam_pos.unsqueeze(1), cam_mat.permute(0, 2, 1))
+    X, Y, Z = pt_trans[:, :, 0], pt_trans[:, :, 1], pt_trans[:, :, 2]
+    xs = ((-Y) / (-Z) * 248 + 224 / 2.0) / 223.
+    ys = (X / (-Z) * 248 + 224 / 2.0) / 223.
+
+    full_features = None
+    batch_size, num_verts = verts_pos.shape[0], verts_pos.shape[1]
+    for block in blocks:
+        dim = block.shape[-1]
+        cur_xs = torch.clamp(xs * dim, 0, dim - 1)
+        cur_ys = torch.clamp(ys * dim, 0, dim - 1)
+        x1s, y1s, x2s, y2s = torch.floor(cur_xs), torch.floor(cur_ys), torch.ceil(cur_xs), torch.ceil(cur_ys)
+        A, B, G, H = x2s - cur_xs, cur_xs - x1s, y2s - cur_ys, cur_ys - y1s
+        x1s, y1s, x2s, y2s = x1s.long(), y1s.long(), x2s.long(), y2s.long()
+
+        flat_block = block.permute(1, 0, 2, 3).contiguous().view(block.shape[1], -1)
+        block_upper = torch.arange(0, batch_size, device=block.device).unsqueeze(-1).expand(batch_size, num_verts)
+        corners = []
+        for rows, cols in [(x1s, y1s), (x1s, y2s), (x2s, y1s), (x2s, y2s)]:
+            selection = ((block_upper * dim * dim) + (rows * dim) + cols).view(-1)
+            corners.append(torch.index_select(flat_block, 1, selection).view(-1, batch_size, num_verts).permute(1, 0, 2))
+        C, D, E, F = corners
+        features = A.unsqueeze(1) * C * G.unsqueeze(1) + H.unsqueeze(1) * D * A.unsqueeze(1) \
+                 + G.unsqueeze(1) * E * B.unsqueeze(1) + B.unsqueeze(1) * F * H.unsqueeze(1)
+        features = features.permute(0, 2, 1)
+        full_features = features if full_features is None else torch.cat((full_features, features), dim=2)
+    return full_features
+
+def bench_obj(args):
+    import trimesh
+    from utils import read_obj
+
+    paths = sorted(glob(args.pattern))[:args.limit]
+    assert len(paths) > 0, 'no files match ' + args.pattern
+    loaders = [('legacy ObjLoader', legacy_obj_loader),
+               ('trimesh.load', lambda path: trimesh.load(path, force='mesh')),
+               ('read_obj', read_obj),
+               ('read_obj mmap', lambda path: read_obj(path, use_mmap=True))]
+    n_bytes = sum(os.path.getsize(path) for path in paths)
+    print(f'{len(paths)} files, {n_bytes / 2**20:.1f} MiB')
+    for name, loader in loaders:
+        seconds = sum(timed(loader, path, repeat=args.repeat) for path in paths)
+        print(f'{name:>20}: {seconds:8.3f} s  {n_bytes / 2**20 / seconds:8.1f} MiB/s')
+
+def bench_adj(args):
+    import torch
+    import trimesh
+    from utils import adj_init
+
+    print(f'{"vertices":>9} {"faces":>9} {"dense":>10} {"sparse":>10}')
+    for subdivisions in args.subdivisions:
+        mesh = trimesh.creation.icosphere(subdivisions)
+        faces = torch.from_numpy(mesh.faces).long().to(args.device)
+        sparse = timed(adj_init, faces, sparse=True, repeat=args.repeat)
+        # the dense matrices grow quadratically, past max_dense they no longer fit
+        if len(mesh.vertices) <= args.max_dense:
+            dense = f'{timed(adj_init, faces, repeat=args.repeat):9.4f}s'
+        else:
+            dense = f'{"-":>10}'
+        print(f'{len(mesh.vertices):9d} {len(mesh.faces):9d} {dense} {sparse:9.4f}s')
+
+def bench_chamfer(args):
+    import torch
+    from utils import chamfer_dist
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    print(f'{torch.get_num_threads()} threads, {args.budget / 2**20:.0f} MiB budget, batch size {args.batch_size}')
+    print(f'{"points":>9} {"seconds":>10} {"pairs/s":>12}')
+    for num in args.points:
+        a = torch.rand(args.batch_size, num, 3, device=args.device)
+        b = torch.rand(args.batch_size, num, 3, device=args.device)
+        seconds = timed(chamfer_dist, a, b, args.budget, repeat=args.repeat)
+        print(f'{num:9d} {seconds:10.4f} {args.batch_size * num * num / seconds:12.3e}')
+
+def legacy_contrastive_loss(logit_scale, desc_embeddings, mesh_embeddings):
+    # loss.ContrastiveLoss before the index-based version, with dense target matrices
+    import torch
+    from torch import nn
+
+    n_desc = desc_embeddings.shape[0]
+    n_mesh = mesh_embeddings.shape[0]
+    descs_per_mesh = n_desc // n_mesh
+    logits_per_mesh = logit_scale.exp() * mesh_embeddings @ desc_embeddings.T
+    logits_per_desc = logits_per_mesh.T
+    targets_per_desc = torch.zeros(n_desc, n_mesh).to(desc_embeddings.device)
+    targets_per_desc[torch.arange(n_desc),
+                     torch.arange(n_mesh).repeat_interleave(descs_per_mesh)] = 1
+    targets_per_mesh = torch.zeros(n_mesh, n_desc).to(mesh_embeddings.device)
+    targets_per_mesh[torch.arange(n_mesh).unsqueeze(dim=1),
+                     torch.arange(n_desc).reshape(n_desc // descs_per_mesh, descs_per_mesh)] = 1 / descs_per_mesh
+    cross_entropy = nn.CrossEntropyLoss()
+    return (cross_entropy(logits_per_desc, targets_per_desc) + cross_entropy(logits_per_mesh, targets_per_mesh)) / 2
+
+def bench_pooling(args):
+    import torch
+    from utils import batched_pooling
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    # feature blocks of the image encoder GEOMetrics pools from
+    shapes = [(64, 112), (128, 56), (256, 28), (512, 14)]
+    blocks = [torch.randn(args.batch_size, channels, dim, dim) for channels, dim in shapes]
+    # renderings are taken 30-45 degrees around the object, at a distance of about 0.6-0.9
+    img_info = torch.stack((torch.rand(args.batch_size) * 360, torch.rand(args.batch_size) * 30 + 15,
+                            torch.rand(args.batch_size) * .3 + .6), dim=1)
+    print(f'{torch.get_num_threads()} threads, batch size {args.batch_size}, '
+          f'{sum(channels for channels, _ in shapes)} channels')
+    print(f'{"vertices":>9} {"index_select":>13} {"grid_sample":>12} {"max diff":>10}')
+    for num_verts in args.verts:
+        verts = (torch.rand(args.batch_size, num_verts, 3) - .5) * .6
+        legacy = timed(legacy_batched_pooling, blocks, verts, img_info, repeat=args.repeat)
+        pooled = timed(batched_pooling, blocks, verts, img_info, repeat=args.repeat)
+        # the old weights vanish for vertices landing exactly on a feature (including every
+        # vertex clamped to the border), so compare the others
+        legacy_features = legacy_batched_pooling(blocks, verts, img_info)
+        defined = legacy_features != 0
+        diff = (legacy_features - batched_pooling(blocks, verts, img_info))[defined].abs().max()
+        print(f'{num_verts:9d} {legacy:12.4f}s {pooled:11.4f}s {diff:10.2e}')
+
+def synthetic_contrastive_batch(batch_size, descs_per_mesh, subdivisions, joint_embedding_dim, dropout_prob):
+    """
+    random colored icospheres with random token ids as their descriptions,
+    and an encoder for each, for timing the training step without the dataset
+
+    Returns
+    -------
+    graphs: list
+        batch_size PyG graphs with 6 input features per vertex
+    ids: torch.Tensor
+        (batch_size * descs_per_mesh x 32) token ids, 0 padded, grouped by mesh
+    desc_encoder: nn.Module
+        embeds {'full_desc': ids}, standing in for DescriptionContextEncoder,
+        which needs the CLIP weights
+    mesh_encoder: nn.Module
+        models.AdvancedMeshEncoder if dropout_prob else models.MeshEncoder
+    """
+    import torch
+    import trimesh
+    from torch import nn
+    import torch.nn.functional as F
+    from torch_geometric.data import Data
+    from models import MeshEncoder, AdvancedMeshEncoder
+
+    class TokenEncoder(nn.Module):
+        def __init__(self, vocab_size, joint_embed_dim, dropout_prob):
+            super().__init__()
+            self.embedding = nn.Embedding(vocab_size, joint_embed_dim, padding_idx=0)
+            self.proj = nn.Linear(joint_embed_dim, joint_embed_dim)
+            self.dropout_prob = dropout_prob
+
+        def forward(self, descs):
+            ids = descs['full_desc']
+            x = self.embedding(ids).sum(dim=1) / (ids != 0).sum(dim=1, keepdim=True).clamp(min=1)
+            x = F.dropout(self.proj(x), p=self.dropout_prob, training=self.training)
+            return F.normalize(x, dim=1)
+
+    mesh = trimesh.creation.icosphere(subdivisions)
+    edges = torch.from_numpy(np.array(mesh.edges_unique)).long().T
+    edge_index = torch.cat((edges, edges.flip(0)), dim=1)
+    graphs = [Data(x=torch.cat((torch.from_numpy(mesh.vertices).float() + torch.randn(3) * .1,
+                                torch.rand(len(mesh.vertices), 3)), dim=1),
+                   edge_index=edge_index) for _ in range(batch_size)]
+    n_descs = batch_size * descs_per_mesh
+    lengths = torch.randint(4, 32, (n_descs,))
+    ids = torch.randint(1, 1000, (n_descs, 32)) * (torch.arange(32) < lengths.unsqueeze(1))
+
+    desc_encoder = TokenEncoder(1000, joint_embedding_dim, dropout_prob)
+    if dropout_prob:
+        mesh_encoder = AdvancedMeshEncoder(6, joint_embedding_dim, dropout_prob=dropout_prob)
+    else:
+        mesh_encoder = MeshEncoder(6, joint_embedding_dim)
+    return graphs, ids, desc_encoder, mesh_encoder
+
+def bench_grad_cache(args):
+    import torch
+    from torch_geometric.data import Batch
+    from loss import ContrastiveLoss
+    from gradient_cache import GradientCache
+
+    torch.manual_seed(0)
+    graphs, ids, desc_encoder, mesh_encoder = synthetic_contrastive_batch(
+        args.batch_size, args.descs_per_mesh, args.subdivisions, args.joint_embedding_dim, dropout_prob=.5)
+    n_descs = len(ids)
+    desc_chunks = [{'full_desc': chunk} for chunk in ids.to(args.device).split(args.chunk_size * args.descs_per_mesh)]
+    mesh_chunks = [Batch.from_data_list(graphs[start:start + args.chunk_size]).to(args.device)
+                   for start in range(0, args.batch_size, args.chunk_size)]
+
+    desc_encoder = desc_encoder.to(args.device)
+    mesh_encoder = mesh_encoder.to(args.device)
+    contrastive_loss = ContrastiveLoss().to(args.device)
+    modules = [desc_encoder, mesh_encoder, contrastive_loss]
+    parameters = [parameter for module in modules for parameter in module.parameters()]
+
+    def full_batch():
+        # the same chunks with their graphs kept, so dropout draws the same masks
+        for parameter in parameters:
+            parameter.grad = None
+        desc_embeddings = torch.cat([desc_encoder(chunk) for chunk in desc_chunks])
+        mesh_embeddings = torch.cat([mesh_encoder(chunk) for chunk in mesh_chunks])
+        loss = contrastive_loss(desc_embeddings, mesh_embeddings)
+        loss.backward()
+        return loss.detach()
+
+    gc = GradientCache(models=[desc_encoder, mesh_encoder],
+                       chunk_sizes=[args.chunk_size * args.descs_per_mesh, args.chunk_size],
+                       loss_fn=contrastive_loss)
+    def cached():
+        for parameter in parameters:
+            parameter.grad = None
+        return gc(desc_chunks, mesh_chunks)
+
+    results = {}
+    for name, step in [('full batch', full_batch), ('gradient cache', cached)]:
+        torch.manual_seed(1)
+        loss = step()
+        results[name] = loss, [parameter.grad.clone() for parameter in parameters]
+        if args.device.startswith('cuda'):
+            torch.cuda.reset_peak_memory_stats()
+        seconds = timed(step, repeat=args.repeat)
+        memory = f'{torch.cuda.max_memory_allocated() / 2**20:9.1f} MiB' if args.device.startswith('cuda') else ''
+        print(f'{name:>15}: loss {loss.item():.6f} {seconds:9.4f}s {memory}')
+    (full_loss, full_grads), (cached_loss, cached_grads) = results['full batch'], results['gradient cache']
+    diff = max(((full - cached).abs().max() / full.abs().max().clamp(min=1e-12)).item()
+               for full, cached in zip(full_grads, cached_grads))
+    print(f'{args.batch_size} meshes of {graphs[0].num_nodes} vertices, {n_descs} descriptions, '
+          f'chunks of {args.chunk_size}: loss diff {(full_loss - cached_loss).abs().item():.2e}, '
+          f'max relative gradient diff {diff:.2e}')
+
+def bench_contrastive(args):
+    import torch
+    import torch.nn.functional as F
+    from loss import ContrastiveLoss
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cuda = args.device.startswith('cuda')
+    print(f'{torch.get_num_threads()} threads, {args.descs_per_mesh} descriptions per mesh, '
+          f'loss and backward{", peak MiB" if cuda else ""}')
+    print(f'{"meshes":>9} {"dense targets":>14} {"fused":>10} {"chunked":>10} {"max diff":>10}')
+    for n_mesh in args.meshes:
+        desc_embeddings = F.normalize(torch.randn(n_mesh * args.descs_per_mesh, args.joint_embedding_dim, device=args.device), dim=1)
+        mesh_embeddings = F.normalize(torch.randn(n_mesh, args.joint_embedding_dim, device=args.device), dim=1)
+        desc_embeddings.requires_grad_()
+        mesh_embeddings.requires_grad_()
+        fused = ContrastiveLoss().to(args.device)
+        chunked = ContrastiveLoss(args.chunk_size).to(args.device)
+        # the dense targets and the unchunked logits grow with n_desc x n_mesh,
+        # past max_dense and max_fused meshes they no longer fit
+        variants = [(args.max_dense, lambda: legacy_contrastive_loss(fused.logit_scale, desc_embeddings, mesh_embeddings)),
+                    (args.max_fused, lambda: fused(desc_embeddings, mesh_embeddings)),
+                    (None, lambda: chunked(desc_embeddings, mesh_embeddings))]
+        columns = []
+        grads = []
+        for limit, variant in variants:
+            if limit is not None and n_mesh > limit:
+                columns.append(f'{"-":>10}')
+                continue
+            def step():
+                desc_embeddings.grad = None
+                variant().backward()
+            if cuda:
+                torch.cuda.reset_peak_memory_stats()
+            seconds = timed(step, repeat=args.repeat)
+            memory = f' {torch.cuda.max_memory_allocated() / 2**20:.0f}' if cuda else ''
+            columns.append(f'{seconds:9.4f}s{memory}')
+            grads.append(desc_embeddings.grad.clone())
+        diff = max((grad - grads[-1]).abs().max().item() for grad in grads)
+        print(f'{n_mesh:9d} {columns[0]:>14} {columns[1]:>10} {columns[2]:>10} {diff:10.2e}')
+
+def ddp_worker(rank, world_size, args, port, results):
+    # one rank of bench_ddp: its shard of the same global batch on every world size
+    import torch
+    import torch.distributed as dist
+    from torch_geometric.data import Batch
+    from loss import ContrastiveLoss
+    from gradient_cache import GradientCache
+    from distributed import GlobalContrastiveLoss, all_reduce_grads
+
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(args.threads)
+
+    torch.manual_seed(0)
+    graphs, ids, desc_encoder, mesh_encoder = synthetic_contrastive_batch(
+        args.batch_size, args.descs_per_mesh, args.subdivisions, args.joint_embedding_dim, dropout_prob=0)
+    shard = args.batch_size // world_size
+    graphs = graphs[rank * shard:(rank + 1) * shard]
+    ids = ids[rank * shard * args.descs_per_mesh:(rank + 1) * shard * args.descs_per_mesh]
+    desc_chunks = [{'full_desc': chunk} for chunk in ids.split(args.chunk_size * args.descs_per_mesh)]
+    mesh_chunks = [Batch.from_data_list(graphs[start:start + args.chunk_size]) for start in range(0, shard, args.chunk_size)]
+
+    contrastive_loss = ContrastiveLoss()
+    gc = GradientCache(models=[desc_encoder, mesh_encoder],
+                       chunk_sizes=[args.chunk_size * args.descs_per_mesh, args.chunk_size],
+                       loss_fn=GlobalContrastiveLoss(contrastive_loss))
+    encoder_parameters = list(desc_encoder.parameters()) + list(mesh_encoder.parameters())
+    parameters = encoder_parameters + list(contrastive_loss.parameters())
+
+    def step():
+        for parameter in parameters:
+            parameter.grad = None
+        loss = gc(desc_chunks, mesh_chunks)
+        all_reduce_grads(encoder_parameters)
+        dist.barrier()
+        return loss
+
+    loss = step()
+    seconds = timed(step, repeat=args.repeat)
+    if rank == 0:
+        # as numpy arrays, since shared tensors would not outlive the worker
+        results.put((seconds, loss.item(), [parameter.grad.numpy().copy() for parameter in parameters]))
+    dist.destroy_process_group()
+
+def bench_ddp(args):
+    import socket
+    import torch.multiprocessing as mp
+
+    context = mp.get_context('spawn')
+    print(f'{args.batch_size} meshes, {args.batch_size * args.descs_per_mesh} descriptions per step, '
+          f'{args.threads} threads per worker')
+    print(f'{"workers":>8} {"seconds":>10} {"speedup":>8} {"efficiency":>11} {"max grad diff":>14}')
+    baseline = None
+    for world_size in args.workers:
+        assert args.batch_size % world_size == 0, 'batch_size must be divisible by every number of workers'
+        with socket.socket() as free:
+            free.bind(('127.0.0.1', 0))
+            port = free.getsockname()[1]
+        results = context.SimpleQueue()
+        workers = mp.spawn(ddp_worker, args=(world_size, args, port, results), nprocs=world_size, join=False)
+        # read before joining, rank 0 blocks until its gradients are taken off the pipe
+        seconds, loss, grads = results.get()
+        while not workers.join():
+            pass
+        if baseline is None:
+            baseline = seconds, grads
+        # every world size contrasts the same global batch, so the gradients should agree
+        diff = max(np.abs(grad - base).max() for grad, base in zip(grads, baseline[1]))
+        speedup = baseline[0] / seconds
+        print(f'{world_size:8d} {seconds:9.4f}s {speedup:7.2f}x {speedup / world_size * args.workers[0]:10.1%} {diff:14.2e}')
+
+if __name__ == "__main__":
+    argp = ArgumentParser()
+    subparsers = argp.add_subparsers(dest='benchmark', required=True)
+
+    obj_parser = subparsers.add_parser('obj', help='OBJ readers')
+    obj_parser.add_argument('--pattern',
+        help='glob of .obj files to read', default=os.path.join('dataset', 'colored_models', '*', '*', 'model.obj'))
+    obj_parser.add_argument('--limit',
+        help='maximum number of files', type=int, default=100)
+    obj_parser.add_argument('--repeat',
+        help='timing repetitions per file', type=int, default=3)
+    obj_parser.set_defaults(run=bench_obj)
+
+    adj_parser = subparsers.add_parser('adj', help='dense vs sparse adjacency construction')
+    adj_parser.add_argument('--subdivisions',
+        help='icosphere subdivision levels to build meshes of', type=int, nargs='+', default=[2, 3, 4, 5, 6])
+    adj_parser.add_argument('--max_dense',
+        help='largest vertex count to time the dense matrices for', type=int, default=12000)
+    adj_parser.add_argument('--device',
+        help='device to build the adjacency on', default='cpu')
+    adj_parser.add_argument('--repeat',
+        help='timing repetitions per mesh', type=int, default=3)
+    adj_parser.set_defaults(run=bench_adj)
+
+    chamfer_parser = subparsers.add_parser('chamfer', help='chunked chamfer nearest neighbours')
+    chamfer_parser.add_argument('--points',
+        help='points per cloud', type=int, nargs='+', default=[1000, 10000, 100000])
+    chamfer_parser.add_argument('--batch_size',
+        help='clouds per batch', type=int, default=1)
+    chamfer_parser.add_argument('--budget',
+        help='bytes of pairwise distances held at once', type=int, default=2**28)
+    chamfer_parser.add_argument('--threads',
+        help='intra-op threads, defaults to torch\'s choice', type=int, default=None)
+    chamfer_parser.add_argument('--device',
+        help='device to run on', default='cpu')
+    chamfer_parser.add_argument('--repeat',
+        help='timing repetitions per size', type=int, default=3)
+    chamfer_parser.set_defaults(run=bench_chamfer)
+
+    pooling_parser = subparsers.add_parser('pooling', help='perceptual feature pooling')
+    pooling_parser.add_argument('--batch_size',
+        help='images per batch', type=int, default=16)
+    pooling_parser.add_argument('--verts',
+        help='vertices per mesh', type=int, nargs='+', default=[162, 642, 2562])
+    pooling_parser.add_argument('--threads',
+        help='intra-op threads, defaults to torch\'s choice', type=int, default=None)
+    pooling_parser.add_argument('--repeat',
+        help='timing repetitions per size', type=int, default=3)
+    pooling_parser.set_defaults(run=bench_pooling)
+
+    grad_cache_parser = subparsers.add_parser('grad_cache', help='gradient cache against full-batch gradients')
+    grad_cache_parser.add_argument('--batch_size',
+        help='meshes per batch', type=int, default=64)
+    grad_cache_parser.add_argument('--chunk_size',
+        help='meshes per chunk', type=int, default=8)
+    grad_cache_parser.add_argument('--descs_per_mesh',
+        help='descriptions per mesh', type=int, default=5)
+    grad_cache_parser.add_argument('--subdivisions',
+        help='icosphere subdivision level of the meshes', type=int, default=3)
+    grad_cache_parser.add_argument('--joint_embedding_dim',
+        help='dimension of joint embedding space', type=int, default=128)
+    grad_cache_parser.add_argument('--device',
+        help='device to run on', default='cpu')
+    grad_cache_parser.add_argument('--repeat',
+        help='timing repetitions', type=int, default=3)
+    grad_cache_parser.set_defaults(run=bench_grad_cache)
+
+    contrastive_parser = subparsers.add_parser('contrastive', help='contrastive loss with dense targets, fused and chunked')
+    contrastive_parser.add_argument('--meshes',
+        help='meshes per batch', type=int, nargs='+', default=[1000, 5000, 10000])
+    contrastive_parser.add_argument('--descs_per_mesh',
+        help='descriptions per mesh', type=int, default=5)
+    contrastive_parser.add_argument('--chunk_size',
+        help='descriptions per block of logits in the chunked loss', type=int, default=1024)
+    contrastive_parser.add_argument('--max_dense',
+        help='largest number of meshes to time the dense targets for', type=int, default=5000)
+    contrastive_parser.add_argument('--max_fused',
+        help='largest number of meshes to time the unchunked loss for', type=int, default=5000)
+    contrastive_parser.add_argument('--joint_embedding_dim',
+        help='dimension of joint embedding space', type=int, default=128)
+    contrastive_parser.add_argument('--threads',
+        help='intra-op threads, defaults to torch\'s choice', type=int, default=None)
+    contrastive_parser.add_argument('--device',
+        help='device to run on', default='cpu')
+    contrastive_parser.add_argument('--repeat',
+        help='timing repetitions per size', type=int, default=3)
+    contrastive_parser.set_defaults(run=bench_contrastive)
+
+    ddp_parser = subparsers.add_parser('ddp', help='scaling of distributed gradient-cached training over gloo')
+    ddp_parser.add_argument('--workers',
+        help='numbers of worker processes to time, the first is the baseline', type=int, nargs='+', default=[1, 2, 4])
+    ddp_parser.add_argument('--batch_size',
+        help='meshes per global batch', type=int, default=64)
+    ddp_parser.add_argument('--chunk_size',
+        help='meshes per gradient cache chunk', type=int, default=8)
+    ddp_parser.add_argument('--descs_per_mesh',
+        help='descriptions per mesh', type=int, default=5)
+    ddp_parser.add_argument('--subdivisions',
+        help='icosphere subdivision level of the meshes', type=int, default=3)
+    ddp_parser.add_argument('--joint_embedding_dim',
+        help='dimension of joint embedding space', type=int, default=128)
+    ddp_parser.add_argument('--threads',
+        help='intra-op threads per worker', type=int, default=1)
+    ddp_parser.add_argument('--repeat',
+        help='timing repetitions', type=int, default=3)
+    ddp_parser.set_defaults(run=bench_ddp)
+
+    args = argp.parse_args()
+    args.run(args)
@@ -0,0 +1,88 @@
+import os
+import numpy as np
+import scipy.io as sio
+import torch
+from PIL import Image
+from tqdm import tqdm
+from functools import partial
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from utils import Mesh_loader, Voxel_loader, preprocess, sparse_adj
+
+# converts what utils.Mesh_loader and utils.Voxel_loader read per item into arrays under
+# <out>/<class>/<object>/, which the loaders memory map when given cache_location=<out>/:
+#   samples.npy     [N, 3] float32 ground truth surface samples
+#   metadata.npy    [views, 5] float32 rows of rendering_metadata.txt
+#   images.npy      [views, 224, 224, C] uint8 renderings, already resized
+#   voxels.npy      occupancy grid, bit-packed along the last axis
+#   verts.npy, faces.npy, adj_indices.npy, adj_values.npy
+#                   mesh and its normalized adjacency
+# e.g. python convert_geometrics.py --images 'data/images/*' --samples data/surfaces/ --out data/cache/
+
+def convert_renderings(loader, out, views, name):
+    obj, obj_class = name
+    cache = os.path.join(out, obj_class, obj)
+    if all(os.path.exists(os.path.join(cache, f)) for f in ['samples.npy', 'metadata.npy', 'images.npy']):
+        return
+    os.makedirs(cache, exist_ok=True)
+    samples = sio.loadmat(loader.Sample_location + obj_class + '/' + obj)['points']
+    np.save(os.path.join(cache, 'samples.npy'), np.ascontiguousarray(samples, dtype=np.float32))
+
+    rendering = loader.Img_location + obj_class + '/' + loader.set_type + '/' + obj + '/rendering/'
+    metadata = np.genfromtxt(rendering + 'rendering_metadata.txt', delimiter=' ')
+    np.save(os.path.join(cache, 'metadata.npy'), metadata[:views].astype(np.float32))
+    # the resize half of utils.preprocess; the loader does the scaling of ToTensor
+    resize = preprocess.transforms[0]
+    images = [np.asarray(resize(Image.open(rendering + str(num).zfill(2) + '.png'))) for num in range(views)]
+    np.save(os.path.join(cache, 'images.npy'), np.stack(images).astype(np.uint8))
+
+def convert_voxels(loader, out, name):
+    obj, obj_class = name
+    cache = os.path.join(out, obj_class, obj)
+    files = ['voxels.npy', 'verts.npy', 'faces.npy', 'adj_indices.npy', 'adj_values.npy']
+    if all(os.path.exists(os.path.join(cache, f)) for f in files):
+        return
+    os.makedirs(cache, exist_ok=True)
+    voxels = sio.loadmat(loader.Voxel_location + obj_class + '/' + obj)['model']
+    assert voxels.shape[-2] == voxels.shape[-1], 'voxel grids are expected to be cubic'
+    np.save(os.path.join(cache, 'voxels.npy'), np.packbits(voxels != 0, axis=-1))
+
+    mesh_info = sio.loadmat(loader.Mesh_loction + obj_class + '/' + obj + '.mat')
+    faces = np.ascontiguousarray(mesh_info['faces'], dtype=np.int64)
+    np.save(os.path.join(cache, 'verts.npy'), np.ascontiguousarray(mesh_info['verts'], dtype=np.float32))
+    np.save(os.path.join(cache, 'faces.npy'), faces)
+    adj = sparse_adj(torch.from_numpy(faces), normalize=True)
+    np.save(os.path.join(cache, 'adj_indices.npy'), adj.indices().numpy())
+    np.save(os.path.join(cache, 'adj_values.npy'), adj.values().numpy())
+
+def convert(fn, names, workers):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(tqdm(pool.map(fn, names, chunksize=8), total=len(names)))
+
+if __name__ == "__main__":
+    argp = ArgumentParser()
+    argp.add_argument('--images',
+        help='image location as passed to the loaders', required=True)
+    argp.add_argument('--samples',
+        help='directory of the sampled surface points, converts the Mesh_loader inputs', default=None)
+    argp.add_argument('--meshes',
+        help='directory of the mesh .mat files, with --voxels converts the Voxel_loader inputs', default=None)
+    argp.add_argument('--voxels',
+        help='directory of the voxel .mat files', default=None)
+    argp.add_argument('--set_types',
+        help='dataset splits to convert', nargs='+', default=['train'])
+    argp.add_argument('--views',
+        help='renderings per object', type=int, default=24)
+    argp.add_argument('--out',
+        help='directory to write the arrays to', required=True)
+    argp.add_argument('--workers',
+        help='number of converting processes', type=int, default=os.cpu_count())
+    args = argp.parse_args()
+
+    for set_type in args.set_types:
+        if args.samples is not None:
+            loader = Mesh_loader(args.images, args.meshes, args.samples, set_type=set_type, num=args.views - 1)
+            convert(partial(convert_renderings, loader, args.out, args.views), loader.names, args.workers)
+        if args.meshes is not None and args.voxels is not None:
+            loader = Voxel_loader(args.images, args.meshes, args.voxels, set_type=set_type)
+            convert(partial(convert_voxels, loader, args.out), loader.names, args.workers)
@@ -1,25 +1,48 @@
+import torch
 from torch.utils.data import Dataset
 from torch.nn.functional import pad
 import json
 import os
-from utils import load_initial
+import numpy as np
+from utils import load_initial, adj_init, batch_edge_list
+from mesh_store import MeshStore, shard_paths
 
 class AnnotatedMeshDataset(Dataset):
-    def __init__(self, models_path, annotations_path):
+    def __init__(self, models_path, annotations_path, mesh_store_dir=None, sparse=False):
+        """
+        reads .obj files from models_path, or, if mesh_store_dir is given,
+        the meshes converted into it by mesh_store.py. with sparse, batches
+        hold the concatenated vertices and an edge list for
+        models.SparseMeshEncoder instead of padded dense adjacencies
+        """
         self.models_path = models_path
+        self.sparse = sparse
         with open(annotations_path, 'r') as annotations_file:
             self.model2desc = json.load(annotations_file)
         self.max_desc_length = max([max([len(desc) for desc in descriptions]) for descriptions in self.model2desc.values()])
+        self.stores = None
+        if mesh_store_dir is not None:
+            self.stores = [MeshStore(path) for path in shard_paths(mesh_store_dir)]
+            self.store_index = [(store, i) for store in self.stores for i in range(len(store))]
 
     def __len__(self):
+        if self.stores is not None:
+            return len(self.store_index)
         return len(os.listdir(self.models_path))
 
     def __getitem__(self, idx):
-        obj_path = os.listdir(self.models_path)[idx]
-        model_id = obj_path.split('.')[0]
-        obj_path = os.path.join(self.models_path, obj_path)
+        if self.stores is not None:
+            store, i = self.store_index[idx]
+            mesh = store[i]
+            model_id = mesh['model_id']
+            positions = torch.from_numpy(np.array(mesh['vertices']))
+            adj_info = adj_init(torch.from_numpy(mesh['faces'].astype(np.int64)), sparse=self.sparse)
+        else:
+            obj_path = os.listdir(self.models_path)[idx]
+            model_id = obj_path.split('.')[0]
+            obj_path = os.path.join(self.models_path, obj_path)
 
-        adj_info, edge_index, positions = load_initial(obj_path)
+            adj_info, edge_index, positions = load_initial(obj_path, sparse=self.sparse)
         model_descriptions = self.model2desc[model_id]
 
         data = {
@@ -32,6 +55,18 @@ class AnnotatedMeshDataset(Dataset):
         return data
 
     def collate(self, batch):
+        if self.sparse:
+            num_verts = [item['verts'].shape[0] for item in batch]
+            edge_index, edge_weight, vertex_batch = batch_edge_list([item['adj'] for item in batch], num_verts)
+            return {
+                'verts': torch.cat([item['verts'] for item in batch]),
+                'faces': [item['faces'] for item in batch],
+                'edge_index': edge_index,
+                'edge_weight': edge_weight,
+                'batch': vertex_batch,
+                'descs': [item['descs'] for item in batch]
+            }
+
         max_nodes = max([item['verts'].shape[0] for item in batch])
 
         data = {
@@ -1,5 +1,5 @@
 import torch
-from torch_geometric.data import Data, InMemoryDataset
+from torch_geometric.data import Data, Dataset, InMemoryDataset
 import trimesh
 import json
 import os
@@ -7,21 +7,517 @@ import numpy as np
 from tqdm import tqdm
 import logging
 import pickle
-import spacy
-from spacy.symbols import NOUN, ADJ
+import hashlib
+import shutil
+import itertools
+import bisect
+import threading
+from collections import OrderedDict
+from scipy.spatial import cKDTree
+from adj_noun import get_adj_noun, desc_key, extract_adj_nouns, merge_caches
+from mesh_store import MeshStore, read_header, shard_paths
+from token_store import build_token_store
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 logger = logging.getLogger("trimesh")
 logger.setLevel(logging.ERROR) # quiet trimesh warnings
+log = logging.getLogger("dataset_pyg")
+
+COLORED_MODELS_DIR = os.path.join('dataset', 'colored_models')
+# bump whenever build_graph changes what it produces, so that cached
+# graphs in processed/good_graphs get rebuilt
+PREPROCESS_VERSION = 4
+# blender imports OBJs as Y-up -> Z-up, so the positions baked into
+# vertex_colors.pickle may be in (x, -z, y) rather than OBJ coordinates.
+# this maps them back to (x, y, z)
+BLENDER_TO_OBJ = np.array([[1, 0, 0],
+                           [0, 0, 1],
+                           [0, -1, 0]], dtype=np.float64)
+
+def list_models(obj_classes):
+    """
+    every (obj_class, obj_folder) pair under COLORED_MODELS_DIR, in a fixed
+    order so that shards built on different machines agree on indices
+    """
+    return [(obj_class, obj_folder)
+            for obj_class in obj_classes
+            for obj_folder in sorted(os.listdir(os.path.join(COLORED_MODELS_DIR, obj_class)))]
+
+def _probe_cells(codes, points, sorted_codes, order, keys, tolerance):
+    """
+    for every point, the first key within tolerance among the keys whose
+    cell code equals codes, or -1
+    """
+    found = np.full(len(codes), -1, dtype=np.int64)
+    # searching in sorted order is much more cache friendly
+    perm = np.argsort(codes)
+    pos = np.empty_like(perm)
+    pos[perm] = np.searchsorted(sorted_codes, codes[perm])
+    active = np.arange(len(codes))
+    # walk the run of keys sharing each cell; almost always length one
+    while len(active) > 0:
+        active = active[pos[active] < len(sorted_codes)]
+        active = active[sorted_codes[pos[active]] == codes[active]]
+        candidates = order[pos[active]]
+        diff = keys[candidates] - points[active]
+        close = np.einsum('ij,ij->i', diff, diff) <= tolerance ** 2
+        found[active[close]] = candidates[close]
+        active = active[~close]
+        pos[active] += 1
+    return found
+
+def _grid_match(vertices, keys, tolerance):
+    """
+    hash-grid join: bucket keys into cells at least tolerance wide, then
+    probe each vertex's own cell and, for the few vertices near a cell
+    border, the 26 neighbouring ones. returns the index of a key within
+    tolerance for every vertex, -1 where there is none
+    """
+    lo = np.minimum(keys.min(axis=0), vertices.min(axis=0))
+    extent = np.maximum(keys.max(axis=0), vertices.max(axis=0)) - lo
+    # keep the cell codes of both point sets within int64
+    cell = max(tolerance, float(extent.max()) / 2 ** 20)
+    lo = lo - cell
+    key_cells = np.floor((keys - lo) / cell).astype(np.int64)
+    vert_cells = np.floor((vertices - lo) / cell).astype(np.int64)
+    dims = np.maximum(key_cells.max(axis=0), vert_cells.max(axis=0)) + 2
+
+    key_codes = np.ravel_multi_index(key_cells.T, dims)
+    order = np.argsort(key_codes)
+    sorted_codes = key_codes[order]
+
+    nearest = _probe_cells(np.ravel_multi_index(vert_cells.T, dims), vertices,
+                           sorted_codes, order, keys, tolerance)
+    for offset in itertools.product([0, -1, 1], repeat=3):
+        rest = np.flatnonzero(nearest < 0)
+        if offset == (0, 0, 0) or len(rest) == 0:
+            continue
+        # clipping at the grid border can only produce extra candidates,
+        # which the distance check rejects
+        codes = np.ravel_multi_index((vert_cells[rest] + offset).T, dims, mode='clip')
+        nearest[rest] = _probe_cells(codes, vertices[rest], sorted_codes, order, keys, tolerance)
+    return nearest
+
+def join_vertex_colors(vertices, pos2col, tolerance=1e-4):
+    """
+    looks up the baked color of every vertex in pos2col with one batched
+    hash-grid join instead of a python loop over the vertices
+
+    Parameters
+    ----------
+    vertices: np.ndarray
+        (n_vertices x 3) mesh vertex positions
+    pos2col: dict
+        baked position tuple -> rgb list, as written by download_vertex_colors.py
+    tolerance: float
+        largest distance at which a baked position still counts as the same vertex
+
+    Returns
+    -------
+    colors: np.ndarray
+        (n_vertices x 3) colors, zero where no baked position was close enough
+    n_missing: int
+        number of vertices without a match
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    n_keys = len(pos2col)
+    colors = np.zeros((len(vertices), 3), dtype=np.float32)
+    if n_keys == 0 or len(vertices) == 0:
+        return colors, len(vertices)
+    keys = np.fromiter(itertools.chain.from_iterable(pos2col.keys()), dtype=np.float64, count=3 * n_keys)
+    values = np.fromiter(itertools.chain.from_iterable(v[:3] for v in pos2col.values()),
+                         dtype=np.float32, count=3 * n_keys)
+    keys, values = keys.reshape(n_keys, 3), values.reshape(n_keys, 3)
+
+    # the baked positions are either in OBJ or in blender coordinates;
+    # decide which from a sample of the vertices before the full join
+    sample = vertices[np.linspace(0, len(vertices) - 1, min(len(vertices), 1000)).astype(np.int64)]
+    hits = [(_grid_match(sample, keys @ frame.T, tolerance) >= 0).sum() for frame in [np.eye(3), BLENDER_TO_OBJ]]
+    frame = np.eye(3) if hits[0] >= hits[1] else BLENDER_TO_OBJ
+    nearest = _grid_match(vertices, keys @ frame.T, tolerance)
+
+    matched = nearest >= 0
+    colors[matched] = values[nearest[matched]]
+    return colors, int((~matched).sum())
+
+def simplify_mesh(mesh, colors, weld=False, max_faces=None, max_vertices=None):
+    """
+    optionally welds coincident vertices (seams split by uvs or normals) and
+    decimates the mesh down to a face/vertex budget with quadric
+    simplification, carrying the per-vertex colors along
+
+    Parameters
+    ----------
+    mesh: trimesh.Trimesh
+    colors: np.ndarray
+        (n_vertices x 3) colors of mesh.vertices
+    weld: bool
+        merge vertices at the same position
+    max_faces, max_vertices: int or None
+        budget for the simplified mesh. the vertex budget is turned into
+        a face budget of 2 * max_vertices, which holds for closed meshes
+
+    Returns
+    -------
+    mesh: trimesh.Trimesh
+    colors: np.ndarray
+    """
+    if weld:
+        unique, inverse = trimesh.grouping.unique_rows(mesh.vertices)
+        faces = inverse[mesh.faces]
+        faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+        mesh = trimesh.Trimesh(mesh.vertices[unique], faces, process=False)
+        colors = colors[unique]
+
+    budget = [n for n in [max_faces, None if max_vertices is None else 2 * max_vertices] if n is not None]
+    if len(budget) > 0 and len(mesh.faces) > min(budget):
+        # needs the fast_simplification package
+        simplified = mesh.simplify_quadric_decimation(face_count=min(budget))
+        # simplification moves vertices, so take the color of the nearest original one
+        _, nearest = cKDTree(mesh.vertices).query(simplified.vertices)
+        mesh, colors = simplified, colors[nearest]
+    return mesh, colors
+
+def load_colored_mesh(obj_class, obj_folder, simplify=None):
+    """
+    Parameters
+    ----------
+    simplify: dict or None
+        keyword arguments for simplify_mesh
+
+    Returns
+    -------
+    mesh: dict
+        'vertices' (n_vertices x 3), 'faces' (n_faces x 3), baked 'colors'
+        (n_vertices x 3), 'edges_unique' (n_edges x 2) with their
+        'edge_lengths', 'n_missing_colors', and the vertex and face count
+        before simplification as 'orig_size'
+    """
+    model_dir = os.path.join(COLORED_MODELS_DIR, obj_class, obj_folder)
+    mesh = trimesh.load(os.path.join(model_dir, 'model.obj'), force='mesh')
+    if len(mesh.vertices) == 0:
+        raise ValueError('no vertices in ' + os.path.join(model_dir, 'model.obj'))
+
+    with open(os.path.join(model_dir, 'vertex_colors.pickle'), 'rb') as vertex_colors_file:
+        pos2col = pickle.load(vertex_colors_file)
+    vertex_colors, n_missing = join_vertex_colors(mesh.vertices, pos2col)
+    orig_size = (len(mesh.vertices), len(mesh.faces))
+    if simplify:
+        mesh, vertex_colors = simplify_mesh(mesh, vertex_colors, **simplify)
+
+    return {'vertices': np.asarray(mesh.vertices),
+            'faces': np.asarray(mesh.faces),
+            'colors': vertex_colors,
+            'edges_unique': mesh.edges_unique,
+            'edge_lengths': mesh.edges_unique_length,
+            'n_missing_colors': n_missing,
+            'orig_size': orig_size}
+
+def build_graph(obj_class, obj_folder, descs, simplify=None):
+    mesh = load_colored_mesh(obj_class, obj_folder, simplify)
+
+    # convert trimesh into graph, where the vertex positions are
+    # the node features! we also attach an attribute that will
+    # store the natural language descriptions
+    unique_edges = mesh['edges_unique']
+    reversed_unique_edges = np.fliplr(unique_edges)
+    edges = np.concatenate([unique_edges, reversed_unique_edges])
+
+    edge_lengths = mesh['edge_lengths']
+    edge_lengths = np.concatenate([edge_lengths, edge_lengths])
+
+    node_features = np.concatenate([mesh['vertices'], mesh['colors']], axis=1)
+
+    return Data(x= torch.tensor(node_features).to(torch.float), # torch.rand(mesh.vertices.shape[0], 30),
+                edge_index=torch.tensor(edges.T),
+                edge_attr=torch.tensor(edge_lengths).to(torch.float),
+                model_id=obj_folder,
+                descs=descs,
+                n_missing_colors=mesh['n_missing_colors'],
+                orig_size=torch.tensor([mesh['orig_size']]),
+                reduced_size=torch.tensor([[len(mesh['vertices']), len(mesh['faces'])]]))
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def input_hashes(obj_class, obj_folder, descs, simplify=None):
+    """
+    hashes of everything a processed graph depends on
+    """
+    model_dir = os.path.join(COLORED_MODELS_DIR, obj_class, obj_folder)
+    return {'model.obj': file_hash(os.path.join(model_dir, 'model.obj')),
+            'vertex_colors.pickle': file_hash(os.path.join(model_dir, 'vertex_colors.pickle')),
+            'descs': hashlib.sha1(json.dumps(descs, sort_keys=True).encode('utf-8')).hexdigest(),
+            'simplify': simplify,
+            'version': PREPROCESS_VERSION}
+
+def hashes_path(graph_path):
+    return os.path.splitext(graph_path)[0] + '.json'
+
+def is_cached(graph_path, hashes):
+    """
+    whether graph_path was built from inputs with these hashes, as recorded
+    in the small json file saved next to it, so the graph is not unpickled
+    """
+    if not os.path.exists(graph_path) or not os.path.exists(hashes_path(graph_path)):
+        return False
+    with open(hashes_path(graph_path), 'r') as hashes_file:
+        try:
+            recorded = json.load(hashes_file)
+        except json.JSONDecodeError:
+            # interrupted while writing, rebuild
+            return False
+    # compare what json makes of hashes, e.g. tuples in simplify become lists
+    return recorded == json.loads(json.dumps(hashes))
+
+def load_graph(processed_dir, obj_folder):
+    return torch.load(os.path.join(processed_dir, 'good_graphs', obj_folder + '.pt'), weights_only=False)
+
+def _process_model(task):
+    obj_class, obj_folder, descs, processed_dir, simplify = task
+    graph_path = os.path.join(processed_dir, 'good_graphs', obj_folder + '.pt')
+    try:
+        hashes = input_hashes(obj_class, obj_folder, descs, simplify)
+        if is_cached(graph_path, hashes):
+            return 'cached'
+        g = build_graph(obj_class, obj_folder, descs, simplify)
+        # the hashes are only written once the graph is, so a graph
+        # interrupted while saving is never taken for a cached one
+        if os.path.exists(hashes_path(graph_path)):
+            os.remove(hashes_path(graph_path))
+        torch.save(g, graph_path)
+        with open(hashes_path(graph_path), 'w') as hashes_file:
+            json.dump(hashes, hashes_file)
+    except Exception:
+        log.exception('skipping %s/%s', obj_class, obj_folder)
+        return None
+    return 'built'
+
+def adj_noun_cache_path(processed_dir, shard=None, num_shards=None):
+    """
+    the adjective/noun cache the datasets read, or the one shard of
+    num_shards writes before merge_shards adds it to that
+    """
+    if shard is None:
+        return os.path.join(processed_dir, 'adj_noun_cache.json')
+    return os.path.join(processed_dir, 'shards', 'adj_noun_cache_{}_of_{}.json'.format(shard, num_shards))
+
+def process_models(models, model2desc, processed_dir, num_workers=1, simplify=None, adj_noun_cache=None):
+    """
+    builds and saves processed/good_graphs/<id>.pt for each (obj_class, obj_folder)
+    in models, using a pool of num_workers processes. models whose inputs
+    hash the same as when their graph was saved are not rebuilt.
+    simplify holds the simplify_mesh options, if any. adjective/noun strings are extracted up front into
+    adj_noun_cache (processed/adj_noun_cache.json by default), so the workers only look them up.
+    strings already in processed/adj_noun_cache.json are not extracted again
+
+    Returns
+    -------
+    done: list of bools
+        whether each model was processed successfully
+    """
+    os.makedirs(os.path.join(processed_dir, 'good_graphs'), exist_ok=True)
+    annotated = [obj_folder in model2desc for _, obj_folder in models]
+    for (obj_class, obj_folder), ok in zip(models, annotated):
+        if not ok:
+            log.warning('skipping %s/%s, which has no annotations', obj_class, obj_folder)
+    annotated_models = [model for model, ok in zip(models, annotated) if ok]
+    adj_nouns = extract_adj_nouns([desc for _, obj_folder in annotated_models for desc in model2desc[obj_folder]],
+                                  adj_noun_cache or adj_noun_cache_path(processed_dir),
+                                  n_process=num_workers, base_cache_path=adj_noun_cache_path(processed_dir))
+    tasks = []
+    for obj_class, obj_folder in annotated_models:
+        descs = [{'full_desc': desc, 'adj_noun': adj_nouns[desc_key(desc)]} for desc in model2desc[obj_folder]]
+        tasks.append((obj_class, obj_folder, descs, processed_dir, simplify))
+    if num_workers <= 1:
+        results = [_process_model(task) for task in tqdm(tasks)]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = list(tqdm(pool.map(_process_model, tasks, chunksize=4), total=len(tasks)))
+    results = iter(results)
+    results = [next(results) if ok else None for ok in annotated]
+    n_failed = sum(result is None for result in results)
+    log.info('%d models rebuilt, %d reused from cache',
+             results.count('built'), results.count('cached'))
+    if n_failed > 0:
+        log.warning('%d of %d models failed to process', n_failed, len(models))
+    return [result is not None for result in results]
+
+def shard_manifest_path(processed_dir, shard, num_shards):
+    return os.path.join(processed_dir, 'shards', '{}_of_{}.json'.format(shard, num_shards))
+
+def process_shard(root, processed_dir, obj_classes, shard=0, num_shards=1, num_workers=1, simplify=None):
+    """
+    processes every num_shards-th model starting at shard and writes a
+    manifest of the ones that succeeded, to be combined by merge_shards.
+    the shard's adjective/noun strings go to a cache file of its own, so
+    that shards running at the same time do not overwrite each other's
+    """
+    with open(os.path.join(root, 'annotations.json'), 'r') as annotations_file:
+        model2desc = json.load(annotations_file)
+    models = list_models(obj_classes)
+    indices = list(range(len(models)))[shard::num_shards]
+    os.makedirs(os.path.join(processed_dir, 'shards'), exist_ok=True)
+    done = process_models([models[i] for i in indices], model2desc, processed_dir, num_workers, simplify,
+                          adj_noun_cache_path(processed_dir, shard, num_shards))
+
+    manifest = {'shard': shard,
+                'num_shards': num_shards,
+                'models': [[i] + list(models[i]) for i, ok in zip(indices, done) if ok]}
+    with open(shard_manifest_path(processed_dir, shard, num_shards), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+def merge_shards(processed_dir, num_shards):
+    """
+    collates the graphs listed by all num_shards manifests, in global
+    model order, into the (data, slices) pair stored in data.pt, and adds
+    the adjective/noun strings of the shards to processed/adj_noun_cache.json
+    """
+    merge_caches([adj_noun_cache_path(processed_dir, shard, num_shards) for shard in range(num_shards)],
+                 adj_noun_cache_path(processed_dir))
+    models = []
+    for shard in range(num_shards):
+        with open(shard_manifest_path(processed_dir, shard, num_shards), 'r') as manifest_file:
+            models += json.load(manifest_file)['models']
+    models.sort(key=lambda model: model[0])
+
+    graphs = [load_graph(processed_dir, obj_folder) for _, _, obj_folder in tqdm(models)]
+    data, slices = InMemoryDataset.collate(graphs)
+    log.info('%d of %d vertices have no baked color',
+             int(data.n_missing_colors.sum()), data.x.shape[0])
+    torch.save((data, slices), os.path.join(processed_dir, 'data.pt'))
+    return data, slices
+
+def _shared_prefix(path):
+    source = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+    return 'bigchair-{}-'.format(source)
+
+def shared_copies(path, shm_dir='/dev/shm'):
+    """
+    every copy of path that shared_copy placed in shm_dir, of any version
+    """
+    prefix = _shared_prefix(path)
+    suffix = '-' + os.path.basename(path)
+    return [os.path.join(shm_dir, name) for name in os.listdir(shm_dir)
+            if name.startswith(prefix) and name.endswith(suffix)]
+
+def shared_copy(path, shm_dir='/dev/shm'):
+    """
+    path copied once into shm_dir (POSIX shared memory on linux), named after
+    its absolute path, size and modification time so that a rebuilt file gets
+    a new copy. every later caller on the host gets the existing copy. the
+    copy outlives the jobs using it, until release_shared removes it; making
+    a new copy removes the ones of older versions of path
+    """
+    stat = os.stat(path)
+    version = hashlib.sha1('{}:{}'.format(stat.st_size, stat.st_mtime_ns).encode('utf-8')).hexdigest()[:16]
+    shared_path = os.path.join(shm_dir, '{}{}-{}'.format(_shared_prefix(path), version, os.path.basename(path)))
+    if os.path.exists(shared_path):
+        return shared_path
+
+    tmp_path = '{}.{}.tmp'.format(shared_path, os.getpid())
+    try:
+        shutil.copyfile(path, tmp_path)
+        # of jobs copying at the same time, the first to link wins and the
+        # others map its copy, not a file that replaced it
+        try:
+            os.link(tmp_path, shared_path)
+        except FileExistsError:
+            pass
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    # jobs still mapping an old copy keep its pages until they exit
+    for old_path in shared_copies(path, shm_dir):
+        if old_path != shared_path:
+            log.info('removing %s, an older copy of %s', old_path, path)
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+    return shared_path
+
+def release_shared(path, shm_dir='/dev/shm'):
+    """
+    removes the copies of path shared_copy placed in shm_dir. their memory is
+    returned once the last job mapping them exits
+
+    Returns
+    -------
+    released: list
+        paths of the removed copies
+    """
+    released = []
+    for shared_path in shared_copies(path, shm_dir):
+        try:
+            os.remove(shared_path)
+        except FileNotFoundError:
+            continue
+        released.append(shared_path)
+    return released
 
 class AnnotatedMeshDataset(InMemoryDataset):
-    def __init__(self, root, transform=None, pre_transform=None, pre_filter=None):
+    """
+    share decides where the tensors of data.pt live:
+        None    read into the memory of every process
+        'mmap'  memory mapped from data.pt, so every DataLoader worker and
+                every job on the host reads the same pages of the page cache
+        'shm'   memory mapped from a copy of data.pt in /dev/shm, placed
+                there by the first job, which stays in memory
+    in both shared modes the tensors are only read, and adding workers or
+    jobs does not add copies of them. the /dev/shm copy holds as much memory
+    as data.pt and is kept after the jobs exit, for the next ones; rebuilding
+    data.pt replaces it, and
+        python dataset_pyg.py --release_shared
+    removes it
+    """
+    def __init__(self, root, transform=None, pre_transform=None, pre_filter=None,
+                 obj_classes=('Table',), num_workers=1, simplify=None, share=None):
         with open(os.path.join(root, 'annotations.json'), 'r') as annotations_file:
             self.model2desc = json.load(annotations_file)
-        self.max_desc_length = max([max([len(desc) for desc in descriptions]) 
+        self.max_desc_length = max([max([len(desc) for desc in descriptions])
                                     for descriptions in self.model2desc.values()])
-        self.parser = spacy.load("en_core_web_sm")
+        self.obj_classes = obj_classes
+        self.num_workers = num_workers
+        self.simplify = simplify
+        self.share = share
         super().__init__(root, transform, pre_transform, pre_filter)
-        self.data, self.slices = torch.load(self.processed_paths[0])
-        
+        self.data, self.slices = self.load_processed()
+
+    def load_processed(self):
+        path = self.processed_paths[0]
+        if self.share is None:
+            return torch.load(path, weights_only=False)
+        if self.share == 'shm':
+            path = shared_copy(path)
+        return torch.load(path, mmap=True, weights_only=False)
+
+    def __copy__(self):
+        # views made by index_select and slicing share the tensors of the
+        # dataset; only pickling, for another process, maps the file again
+        dataset = self.__class__.__new__(self.__class__)
+        dataset.__dict__.update(self.__dict__)
+        return dataset
+
+    def __getstate__(self):
+        # spawned DataLoader workers map the file again rather than receive a copy
+        state = self.__dict__.copy()
+        if self.share is not None:
+            state['_data'] = None
+            state['slices'] = None
+            state['_data_list'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.share is not None:
+            self.data, self.slices = self.load_processed()
+
     @property
     def raw_dir(self):
         os.path.join('dataset', 'annotated_models')
@@ -34,94 +530,199 @@ class AnnotatedMeshDataset(InMemoryDataset):
     def processed_file_names(self):
         return 'data.pt'
 
+    @property
+    def model_ids(self):
+        return self._data.model_id
+
+    def graph_sizes(self):
+        """
+        (len(self) x 2) node and edge counts of the graphs of this dataset
+        (or view of it), read from the slices without building the graphs
+        """
+        counts = torch.stack([self.slices['x'].diff(), self.slices['edge_index'].diff()], dim=1)
+        return counts[torch.tensor(list(self.indices()), dtype=torch.int64)]
+
     def get_adj_noun(self, parsed_sample):
-        adj_noun_str = ""
-        for possible_adj in parsed_sample:
-            if possible_adj.pos == ADJ:
-                ancestor = possible_adj.head
-                levels = 0
-                while (ancestor.dep_ != "ROOT" and levels < 5):
-                    if ancestor.pos == NOUN:
-                        break
-                    ancestor = ancestor.head
-                    levels += 1
-                if ancestor.pos == NOUN:
-                    adj_noun_str += " " + possible_adj.text + " " + ancestor.text
-                else:
-                    adj_noun_str += " " + possible_adj.text
-        return adj_noun_str
+        return get_adj_noun(parsed_sample)
 
     def process(self):
-        # processing noun-adj pairs
-        # adj_noun = [[self.get_adj_noun(desc) for desc in descriptions] for descriptions in self.model2desc.values()]
-
-
-
-        # processing graphs
-        graphs = []
-        print_descs = True
-        # for graph_name in os.listdir(os.path.join(self.processed_dir, 'graphs')):
-        #     g = torch.load(os.path.join(self.processed_dir, 'graphs', graph_name))
-        #     if isinstance(g.descs[0], str):
-        #         g.descs = [s.split('@')[0] for s in g.descs]
-        #     if print_descs:
-        #         print(g.descs)
-        #         print_descs = False
-        #     torch.save(g, os.path.join(self.processed_dir, 'graphs', graph_name))
-        #     graphs.append(g)
-        for obj_class in ['Table']: # os.listdir(os.path.join('dataset', 'colored_models')):
-            for obj_folder in tqdm(os.listdir(os.path.join('dataset', 'colored_models', obj_class))):
-                # if os.path.exists(os.path.join(self.processed_dir, 'graphs', obj_folder + '.pt')):
-                #     g = torch.load(os.path.join(self.processed_dir, 'graphs', obj_folder + '.pt'))
-                #     graphs.append(g)
-                #     continue
-                print('loading', os.path.join('dataset', 'colored_models', obj_class, obj_folder, 'model.obj'))
-                print(os.path.getsize(os.path.join('dataset', 'colored_models', obj_class, obj_folder, 'model.obj')))
-                mesh = trimesh.load(os.path.join('dataset', 'colored_models', obj_class, obj_folder, 'model.obj'), force='mesh')
-                print('trimesh load done')
-                
-                # model_id = obj.split('.')[0]
-                
-                full_descs = self.model2desc[obj_folder]
-                print('n descs', len(full_descs))
-                adj_nouns = [self.get_adj_noun(self.parser(desc)) for desc in full_descs]
-                descs = [{'full_desc': desc, 'adj_noun': adj_noun} for desc, adj_noun in zip(full_descs, adj_nouns)] #  + '@' + adj_noun
-                print('descs done')
-                # convert trimesh into graph, where the vertex positions are
-                # the node features! we also attach an attribute that will
-                # store the natural language descriptions
-                unique_edges = mesh.edges_unique
-                reversed_unique_edges = np.fliplr(unique_edges)
-                edges = np.concatenate([unique_edges, reversed_unique_edges])
-
-                edge_lengths = mesh.edges_unique_length
-                edge_lengths = np.concatenate([edge_lengths, edge_lengths])
-
-                # # get rid of alpha channel
-                # vertex_colors = np.delete(mesh.visual.vertex_colors, 3, 1)
-                # if not os.path.exists(os.path.join('dataset', 'colored_models', obj_class, obj_folder, 'vertex_colors.pickle')):
-                #     continue
-                vertex_colors_file = open(os.path.join('dataset', 'colored_models', obj_class, obj_folder, 'vertex_colors.pickle'), 'rb')
-                pos2col = pickle.load(vertex_colors_file)
-                rounded_pos2col = {}
-                for key, value in pos2col.items():
-                    rounded_key = tuple([round(c, 4) for c in key])
-                    rounded_pos2col[rounded_key] = value
-                vertex_colors = []
-                for v in mesh.vertices:
-                    vertex_colors.append([round(c, 4) for c in v])
-                vertex_colors = np.array(vertex_colors)
-                vertex_colors_file.close()
-                node_features = np.concatenate([mesh.vertices, vertex_colors], axis=1)
-                print('features done')
-
-                g = Data(x= torch.tensor(node_features).to(torch.float), # torch.rand(mesh.vertices.shape[0], 30),
-                            edge_index=torch.tensor(edges.T),
-                            edge_attr=torch.tensor(edge_lengths).to(torch.float),
-                            model_id=obj_folder,
-                            descs=descs)
-                graphs.append(g)
-                torch.save(g, os.path.join(self.processed_dir, 'good_graphs', obj_folder + '.pt'))
-        self.data, self.slices = self.collate(graphs)
-        torch.save((self.data, self.slices), self.processed_paths[0])
+        process_shard(self.root, self.processed_dir, self.obj_classes,
+                      num_workers=self.num_workers, simplify=self.simplify)
+        self.data, self.slices = merge_shards(self.processed_dir, num_shards=1)
+        build_token_store(self.root, self.processed_dir)
+
+class LazyAnnotatedMeshDataset(Dataset):
+    """
+    the same graphs as AnnotatedMeshDataset, built on demand from the mesh
+    store shards written by mesh_store.py instead of held in memory. at most
+    max_open_shards shards are mapped at once, and the next prefetch shards
+    after the one being read are paged in by a background thread. prefetch
+    is capped at max_open_shards - 1, and prefetching never closes the shard
+    being read
+    """
+    def __init__(self, root, store_dir=None, transform=None, max_open_shards=2, prefetch=1):
+        self.store_dir = store_dir or os.path.join(root, 'processed', 'mesh_store')
+        self.max_open_shards = max_open_shards
+        self.prefetch = max(0, min(prefetch, max_open_shards - 1))
+        self.paths = shard_paths(self.store_dir)
+        # only the shard headers are read up front
+        shard_model_ids = [read_header(path)[0]['model_ids'] for path in self.paths]
+        self.model_ids = [model_id for model_ids in shard_model_ids for model_id in model_ids]
+        self.shard_starts = np.cumsum([0] + [len(model_ids) for model_ids in shard_model_ids]).tolist()
+
+        with open(os.path.join(root, 'annotations.json'), 'r') as annotations_file:
+            model2desc = json.load(annotations_file)
+        self.model2desc = {model_id: model2desc[model_id] for model_id in self.model_ids}
+        self.adj_nouns = extract_adj_nouns([desc for descs in self.model2desc.values() for desc in descs],
+                                           os.path.join(root, 'processed', 'adj_noun_cache.json'))
+
+        self._stores = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._pending = set()
+        self._active = None
+        super().__init__(root, transform)
+
+    def len(self):
+        return len(self.model_ids)
+
+    def graph_sizes(self):
+        """
+        (len(self) x 2) node and edge counts of the graphs of this dataset
+        (or view of it), read from the shard offsets without loading meshes
+        """
+        sizes = np.concatenate([MeshStore(path).sizes() for path in self.paths])
+        # every unique edge becomes two directed ones
+        counts = torch.from_numpy(np.stack([sizes[:, 0], 2 * sizes[:, 2]], axis=1).astype(np.int64))
+        return counts[torch.tensor(list(self.indices()), dtype=torch.int64)]
+
+    def _open(self, shard):
+        with self._lock:
+            store = self._stores.get(shard)
+            if store is not None:
+                self._stores.move_to_end(shard)
+                return store
+        store = MeshStore(self.paths[shard])
+        with self._lock:
+            store = self._stores.setdefault(shard, store)
+            self._stores.move_to_end(shard)
+            # least recently used first, but never the shard get is reading
+            for old in list(self._stores):
+                if len(self._stores) <= self.max_open_shards:
+                    break
+                if old != self._active:
+                    del self._stores[old]
+        return store
+
+    def _prefetch(self, shard):
+        try:
+            self._open(shard)
+            # ask the kernel to start reading the whole shard into the page cache
+            if hasattr(os, 'posix_fadvise'):
+                fd = os.open(self.paths[shard], os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+        finally:
+            with self._lock:
+                self._pending.discard(shard)
+
+    def _schedule_prefetch(self, shard):
+        # DataLoader workers are forked with the dataset, so every process
+        # needs its own prefetch thread
+        if self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=1)
+            self._pool_pid = os.getpid()
+            self._pending = set()
+        for next_shard in range(shard + 1, min(shard + 1 + self.prefetch, len(self.paths))):
+            # each shard is submitted once, until it has been opened
+            with self._lock:
+                if next_shard in self._stores or next_shard in self._pending:
+                    continue
+                self._pending.add(next_shard)
+            self._pool.submit(self._prefetch, next_shard)
+
+    def get(self, idx):
+        shard = bisect.bisect_right(self.shard_starts, idx) - 1
+        self._active = shard
+        mesh = self._open(shard)[idx - self.shard_starts[shard]]
+        if self.prefetch > 0:
+            self._schedule_prefetch(shard)
+
+        edges = mesh['edges'].astype(np.int64)
+        edges = np.concatenate([edges, np.fliplr(edges)])
+        edge_lengths = np.concatenate([mesh['edge_lengths'], mesh['edge_lengths']])
+        node_features = np.concatenate([mesh['vertices'], mesh['colors']], axis=1)
+        descs = [{'full_desc': desc, 'adj_noun': self.adj_nouns[desc_key(desc)]}
+                 for desc in self.model2desc[mesh['model_id']]]
+        graph = Data(x=torch.from_numpy(node_features),
+                     edge_index=torch.from_numpy(np.ascontiguousarray(edges.T)),
+                     edge_attr=torch.from_numpy(edge_lengths),
+                     model_id=mesh['model_id'],
+                     descs=descs,
+                     orig_size=torch.from_numpy(np.array([mesh['orig_size']])),
+                     reduced_size=torch.tensor([[len(mesh['vertices']), len(mesh['faces'])]]))
+        if 'n_missing_colors' in mesh:
+            graph.n_missing_colors = mesh['n_missing_colors']
+        return graph
+
+    def __getstate__(self):
+        # open shards and the prefetch thread are per process
+        state = self.__dict__.copy()
+        state['_stores'] = OrderedDict()
+        state['_lock'] = None
+        state['_pool'] = None
+        state['_pool_pid'] = None
+        state['_pending'] = set()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+SPLITS = ('train', 'val', 'test')
+
+def split_of(model_id, seed=0, fractions=(0.8, 0.1)):
+    """
+    which of SPLITS model_id belongs to, decided by a seeded hash of the id
+    so that it does not depend on the order or size of the dataset. fractions
+    are the train and val shares, test gets the rest
+    """
+    digest = hashlib.sha1('{}:{}'.format(seed, model_id).encode('utf-8')).digest()
+    u = int.from_bytes(digest[:8], 'big') / 2**64
+    if u < fractions[0]:
+        return 'train'
+    if u < fractions[0] + fractions[1]:
+        return 'val'
+    return 'test'
+
+def split_path(root):
+    return os.path.join(root, 'processed', 'splits.json')
+
+def load_split(dataset, split, path=None):
+    """
+    view of the models of dataset (an AnnotatedMeshDataset or a
+    LazyAnnotatedMeshDataset) in split of the split file written by
+    make_data_sets.py. nothing is copied, the view indexes into dataset
+    """
+    with open(path or split_path(dataset.root), 'r') as split_file:
+        split_ids = set(json.load(split_file)['splits'][split])
+    model_ids = dataset.model_ids
+    assert len(model_ids) == len(dataset), 'load_split needs the whole dataset, not a view of it'
+    return dataset.index_select([i for i, model_id in enumerate(model_ids) if model_id in split_ids])
+
+if __name__ == "__main__":
+    argp = ArgumentParser()
+    argp.add_argument('--root',
+        help='dataset root containing processed/data.pt', default='dataset')
+    argp.add_argument('--release_shared',
+        help='remove the copies of data.pt that --share shm placed in /dev/shm', action='store_true')
+    args = argp.parse_args()
 
+    if args.release_shared:
+        released = release_shared(os.path.join(args.root, 'processed', 'data.pt'))
+        print('removed', len(released), 'shared copies:', *released)
+    else:
+        argp.print_help()
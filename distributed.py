@@ -0,0 +1,98 @@
+import os
+import torch
+import torch.distributed as dist
+from torch import nn
+
+# data-parallel contrastive training over torch.distributed. every rank
+# embeds its own shard of the batch, the embeddings of all ranks are gathered
+# so every rank computes the loss over the global batch (all negatives), and
+# the gradients of the gathered embeddings flow back to the rank that
+# produced them. since all ranks compute the same loss, each rank's parameter
+# gradients are its shard's share of the global gradient, and all_reduce_grads
+# sums them. launched by torchrun, e.g.
+#   torchrun --nproc_per_node 8 train_grad_cache.py name --distributed
+#   torchrun --nnodes 2 --node_rank 0 --master_addr host0 --nproc_per_node 8 train_grad_cache.py name --distributed
+
+def init_distributed(backend='gloo', threads=None):
+    """
+    joins the process group described by the environment torchrun sets up,
+    and splits the cores of the host between its ranks unless threads is given.
+    gloo only communicates cpu tensors; with nccl, for cuda tensors, every
+    rank uses the gpu of its local rank
+
+    Returns
+    -------
+    rank: int
+        rank of this process
+    world_size: int
+        number of processes
+    """
+    if backend == 'nccl':
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    dist.init_process_group(backend)
+    if threads is None:
+        threads = max(1, os.cpu_count() // int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+    torch.set_num_threads(threads)
+    return dist.get_rank(), dist.get_world_size()
+
+class GatherWithGrad(torch.autograd.Function):
+    """
+    all_gather along the first dimension, for shards of any size, whose
+    backward hands every rank the gradient of its own shard
+    """
+    @staticmethod
+    def forward(ctx, tensor):
+        world_size = dist.get_world_size()
+        size = torch.tensor([tensor.shape[0]], dtype=torch.int64, device=tensor.device)
+        sizes = [torch.zeros_like(size) for _ in range(world_size)]
+        dist.all_gather(sizes, size)
+        sizes = [int(size) for size in sizes]
+
+        # all_gather needs equal shapes, so shards are padded to the largest
+        padded = tensor.new_zeros((max(sizes),) + tensor.shape[1:])
+        padded[:tensor.shape[0]] = tensor
+        gathered = [torch.empty_like(padded) for _ in range(world_size)]
+        dist.all_gather(gathered, padded.contiguous())
+
+        ctx.sizes = sizes
+        ctx.rank = dist.get_rank()
+        return torch.cat([shard[:size] for shard, size in zip(gathered, sizes)])
+
+    @staticmethod
+    def backward(ctx, grad):
+        start = sum(ctx.sizes[:ctx.rank])
+        return grad[start:start + ctx.sizes[ctx.rank]]
+
+def all_gather_with_grad(tensor):
+    return GatherWithGrad.apply(tensor)
+
+class GlobalContrastiveLoss(nn.Module):
+    """
+    loss_fn over the embeddings of all ranks, in rank order, so that every
+    description is contrasted against the meshes of the global batch
+    """
+    def __init__(self, loss_fn):
+        super().__init__()
+        self.loss_fn = loss_fn
+
+    def forward(self, desc_embeddings, mesh_embeddings, **loss_kwargs):
+        return self.loss_fn(all_gather_with_grad(desc_embeddings), all_gather_with_grad(mesh_embeddings), **loss_kwargs)
+
+def all_reduce_grads(parameters):
+    """
+    sums the gradients of parameters over all ranks, in one flat buffer
+    """
+    grads = [parameter.grad for parameter in parameters if parameter.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = torch.cat([grad.flatten() for grad in grads])
+    dist.all_reduce(flat)
+    for grad, reduced in zip(grads, flat.split([grad.numel() for grad in grads])):
+        grad.copy_(reduced.view_as(grad))
+
+def broadcast_parameters(parameters, src=0):
+    """
+    copies the parameters of rank src to every other rank
+    """
+    for parameter in parameters:
+        dist.broadcast(parameter.data, src)
@@ -1,7 +1,7 @@
 # based on https://github.com/openai/CLIP/issues/83
 from lib2to3.pgen2 import token
 import torch
-from dataset_pyg import AnnotatedMeshDataset
+from dataset_pyg import AnnotatedMeshDataset, load_split
 from torch_geometric.loader import DataLoader
 from models import DescriptionContextEncoder, MeshEncoder, CLIP_pretrained, SimpleMeshEncoder
 import random
@@ -20,7 +20,7 @@ def top_5_eval(logits_per_text, targets_per_text, k=5):
     target_topk = torch.gather(targets_per_text, dim=1, index=index_topk)
     return (torch.sum(torch.sum(target_topk, dim=1) > 0)) / target_topk.shape[0]
 
-def evaluate(eval_dataset, desc_encoder, mesh_encoder, descs_per_mesh, batch_size=1, device="cpu"):
+def evaluate(eval_dataset, desc_encoder, mesh_encoder, descs_per_mesh, batch_size=1, device="cpu", tokens=None):
     desc_encoder.eval()
     mesh_encoder.eval()
 
@@ -32,9 +32,12 @@ def evaluate(eval_dataset, desc_encoder, mesh_encoder, descs_per_mesh, batch_siz
     mesh_index = 0
 
     for batch in tqdm(eval_dataloader):
-        batch.cuda()
-        batch_descs = batch.descs
-        sampled_descs = [random.choices(descs, k=descs_per_mesh) for descs in batch_descs]
+        batch = batch.to(device)
+        if tokens is not None:
+            sampled_descs = tokens.sample_tokens(batch.model_id, descs_per_mesh, device=device)
+        else:
+            batch_descs = batch.descs
+            sampled_descs = [random.choices(descs, k=descs_per_mesh) for descs in batch_descs]
             
         desc_embeddings_i = desc_encoder(sampled_descs).detach().cpu().clone()
         desc_embeddings[desc_index:desc_index + desc_embeddings_i.shape[0], :] = desc_embeddings_i
@@ -69,6 +72,8 @@ if __name__ == "__main__":
     #     choices=["GraphSAGE", "GAT"])
     argp.add_argument('--descs_per_mesh',
         help='number of descriptions per each mesh in a batch', type=int, default=5)
+    argp.add_argument('--share',
+        help='map data.pt (mmap) or a copy of it in /dev/shm (shm), shared with the training jobs on this host. the shm copy stays until python dataset_pyg.py --release_shared', choices=['mmap', 'shm'], default=None)
     args = argp.parse_args()
 
     device = 'cpu'
@@ -78,7 +83,7 @@ if __name__ == "__main__":
     desc_encoder.load_state_dict(torch.load(args.name + "/" + args.name + "_desc_parameters.pt"))
     mesh_encoder = MeshEncoder(128).to(device)
     mesh_encoder.load_state_dict(torch.load(args.name + "/" + args.name + "_mesh_parameters.pt"))
-    val_dataset = torch.load("dataset/processed/val_set.pt")
+    val_dataset = load_split(AnnotatedMeshDataset('dataset', share=args.share), 'val')
     print("Val Accuracy: ", evaluate(val_dataset, desc_encoder, mesh_encoder, device=device))
 
 
@@ -1,7 +1,7 @@
 # based on https://github.com/openai/CLIP/issues/83
 from lib2to3.pgen2 import token
 import torch
-from dataset_pyg import AnnotatedMeshDataset
+from dataset_pyg import AnnotatedMeshDataset, load_split
 from torch_geometric.loader import DataLoader
 from models import DescriptionContextEncoder, MeshEncoder, CLIP_pretrained, SimpleMeshEncoder
 import random
@@ -94,7 +94,7 @@ if __name__ == '__main__':
     desc_encoder.load_state_dict(torch.load(args.name + "/" + args.name + "_desc_parameters.pt"))
     mesh_encoder = MeshEncoder(128).to(device)
     mesh_encoder.load_state_dict(torch.load(args.name + "/" + args.name + "_mesh_parameters.pt"))
-    val_dataset = torch.load("dataset/processed/val_set.pt")
+    val_dataset = load_split(AnnotatedMeshDataset('dataset'), 'val')
     print("Val Accuracy: ", evaluate(val_dataset, desc_encoder, mesh_encoder, device=device))
 
 
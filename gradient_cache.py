@@ -0,0 +1,118 @@
+import torch
+from torch_geometric.data import Batch
+
+# gradient caching for the contrastive objective: the loss over a batch of
+# thousands of descriptions and meshes only needs their embeddings, so
+#   1. every encoder embeds its input chunk by chunk without keeping the graph,
+#   2. the loss runs on the concatenated embeddings, and its gradients with
+#      respect to them are cached,
+#   3. every chunk is embedded again, this time with the graph, and the cached
+#      gradient slice is backpropagated through it.
+# peak memory is that of one chunk plus the embedding matrices, and the
+# parameter gradients equal those of the full batch. random state (dropout)
+# is recorded before each chunk and replayed in step 3, so both passes see the
+# same masks.
+
+def split_inputs(model_input, chunk_size):
+    """
+    splits model_input into chunks of chunk_size items: lists are taken to be
+    chunked already, dicts of tensors (TokenStore.gather) are split along the
+    first dimension, and PyG batches by graph
+    """
+    if isinstance(model_input, (list, tuple)):
+        return list(model_input)
+    if isinstance(model_input, dict):
+        splits = {key: value.split(chunk_size) for key, value in model_input.items()}
+        return [dict(zip(splits, chunk)) for chunk in zip(*splits.values())]
+    if isinstance(model_input, Batch):
+        graphs = model_input.to_data_list()
+        return [Batch.from_data_list(graphs[start:start + chunk_size]) for start in range(0, len(graphs), chunk_size)]
+    return list(model_input.split(chunk_size))
+
+class RandState(object):
+    """
+    the cpu and cuda generator states at construction, restored for the
+    duration of a with block
+    """
+    def __init__(self):
+        self.cpu_state = torch.get_rng_state()
+        self.cuda_states = torch.cuda.get_rng_state_all() if torch.cuda.is_initialized() else []
+
+    def __enter__(self):
+        self.fork = torch.random.fork_rng(devices=range(len(self.cuda_states)))
+        self.fork.__enter__()
+        torch.set_rng_state(self.cpu_state)
+        if self.cuda_states:
+            torch.cuda.set_rng_state_all(self.cuda_states)
+
+    def __exit__(self, *exc):
+        return self.fork.__exit__(*exc)
+
+class GradientCache(object):
+    """
+    computes loss_fn over the embeddings of all models' inputs and
+    accumulates its parameter gradients into models and loss_fn, holding the
+    graph of one chunk at a time
+
+    Parameters
+    ----------
+    models: list
+        encoders, one per input of loss_fn
+    chunk_sizes: list
+        items per chunk of each model's input, unused for inputs passed as lists
+    loss_fn: nn.Module
+        called as loss_fn(*embeddings, **loss_kwargs)
+    split_input_fn: callable
+        split_input_fn(model_input, chunk_size) returns the chunks of model_input
+    """
+    def __init__(self, models, chunk_sizes, loss_fn, split_input_fn=split_inputs):
+        self.models = models
+        self.chunk_sizes = chunk_sizes
+        self.loss_fn = loss_fn
+        self.split_input_fn = split_input_fn
+
+    def forward_no_grad(self, model, chunks):
+        states = []
+        embeddings = []
+        for chunk in chunks:
+            states.append(RandState())
+            with torch.no_grad():
+                embeddings.append(model(chunk))
+        return torch.cat(embeddings), states, [len(embedding) for embedding in embeddings]
+
+    def build_cache(self, embeddings, **loss_kwargs):
+        embeddings = [embedding.detach().requires_grad_() for embedding in embeddings]
+        loss = self.loss_fn(*embeddings, **loss_kwargs)
+        loss.backward()
+        return loss.detach(), [embedding.grad for embedding in embeddings]
+
+    def forward_backward(self, model, chunks, states, grads):
+        for chunk, state, grad in zip(chunks, states, grads):
+            with state:
+                embedding = model(chunk)
+            embedding.backward(gradient=grad)
+
+    def __call__(self, *model_inputs, **loss_kwargs):
+        """
+        Returns
+        -------
+        loss: torch.Tensor
+            the detached loss over the whole batch; gradients are accumulated
+            into .grad, ready for optimizer.step()
+        """
+        chunked = [self.split_input_fn(model_input, chunk_size)
+                   for model_input, chunk_size in zip(model_inputs, self.chunk_sizes)]
+        embeddings = []
+        states = []
+        sizes = []
+        for model, chunks in zip(self.models, chunked):
+            model_embeddings, model_states, model_sizes = self.forward_no_grad(model, chunks)
+            embeddings.append(model_embeddings)
+            states.append(model_states)
+            sizes.append(model_sizes)
+
+        loss, grads = self.build_cache(embeddings, **loss_kwargs)
+
+        for model, chunks, model_states, grad, model_sizes in zip(self.models, chunked, states, grads, sizes):
+            self.forward_backward(model, chunks, model_states, grad.split(model_sizes))
+        return loss
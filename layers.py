@@ -60,4 +60,42 @@ class BatchGCNMax(nn.Module):
 		i_s = activation(v_s)      
 		f   = torch.max(v_s, dim = 1)[0]       
 	
-		return f                      
\ No newline at end of file
+		return f                      
+
+# aggregates adj @ support[:, :cols] as a scatter over a concatenated edge list,
+# where edge_index[0] are the rows (receiving vertices) and edge_weight the entries of adj
+def scatter_adj(support, edge_index, edge_weight, cols):
+	messages = support[edge_index[1], :cols]
+	if edge_weight is not None:
+		messages = messages * edge_weight.unsqueeze(-1)
+	return torch.zeros(support.shape[0], cols, dtype=support.dtype, device=support.device).index_add_(0, edge_index[0], messages)
+
+class SparseZERON_GCN(BatchZERON_GCN):
+	# BatchZERON_GCN on the vertices of a whole batch of meshes, (total_verts x in_features),
+	# with the adjacency given as an edge list instead of a padded dense matrix
+	def forward(self, input, edge_index, activation, edge_weight=None):
+		support = torch.matmul(input, self.weight)
+		output = scatter_adj(support, edge_index, edge_weight, support.shape[-1]//10)
+		output = torch.cat((output, support[:, support.shape[-1]//10:]), dim = -1)
+
+		if self.bias is not None:
+			output = output + self.bias
+		return activation(output)
+
+class SparseGCNMax(BatchGCNMax):
+	# BatchGCNMax on an edge list, taking the max over the vertices of each mesh as given by batch
+	def forward(self, r_s, edge_index, activation, batch, edge_weight=None, num_graphs=None):
+		bias = self.weight_Bs[0]
+		weight_W = self.weight_Ws[0]
+
+		support = torch.matmul(r_s, weight_W)
+		output = scatter_adj(support, edge_index, edge_weight, support.shape[-1]//10)
+		output = torch.cat((output, support[:, support.shape[-1]//10:]), dim = -1)
+
+		v_s = output + bias
+		if num_graphs is None:
+			num_graphs = int(batch.max()) + 1
+		f = torch.zeros(num_graphs, v_s.shape[-1], dtype=v_s.dtype, device=v_s.device)
+		f = f.scatter_reduce(0, batch.unsqueeze(-1).expand_as(v_s), v_s, reduce='amax', include_self=False)
+
+		return f
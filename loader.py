@@ -0,0 +1,118 @@
+import torch
+from torch.utils.data import Sampler
+from torch_geometric.loader.dataloader import Collater
+
+class BudgetBatchSampler(Sampler):
+    """
+    batch sampler packing graphs into batches of at most max_nodes nodes,
+    max_edges edges and max_graphs graphs, so that batches cost about the same
+    however large their meshes are. a graph over the budget on its own gets a
+    batch of its own. whole graphs are batched, so every mesh keeps its
+    descriptions for the contrastive loss. pass it to the PyG DataLoader as
+    batch_sampler
+
+    Parameters
+    ----------
+    sizes: torch.Tensor
+        (n_graphs x 2) node and edge counts, from dataset.graph_sizes()
+    num_buckets: int
+        with more than one bucket, graphs are sorted by node count into
+        num_buckets buckets and only batched with graphs of the same bucket,
+        which wastes less of the budget
+    shuffle: bool
+        shuffle the graphs within each bucket and the order of the batches,
+        differently every epoch (see set_epoch)
+    num_replicas, rank: int
+        for distributed training, the batches are dealt out to num_replicas
+        ranks, repeating some so that every rank gets as many
+    """
+    def __init__(self, sizes, max_nodes=None, max_edges=None, max_graphs=None,
+                 num_buckets=1, shuffle=False, seed=0, num_replicas=1, rank=0):
+        self.sizes = sizes
+        self.nodes = sizes[:, 0].tolist()
+        self.edges = sizes[:, 1].tolist()
+        self.max_nodes = max_nodes or float('inf')
+        self.max_edges = max_edges or float('inf')
+        self.max_graphs = max_graphs or float('inf')
+        self.num_buckets = num_buckets
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        if self.num_buckets > 1:
+            order = torch.argsort(self.sizes[:, 0], stable=True)
+        else:
+            order = torch.arange(len(self.nodes))
+
+        batches = []
+        for bucket in order.tensor_split(self.num_buckets):
+            if self.shuffle:
+                bucket = bucket[torch.randperm(len(bucket), generator=generator)]
+            batch = []
+            nodes = edges = 0
+            for i in bucket.tolist():
+                if batch and (nodes + self.nodes[i] > self.max_nodes or edges + self.edges[i] > self.max_edges
+                              or len(batch) >= self.max_graphs):
+                    batches.append(batch)
+                    batch = []
+                    nodes = edges = 0
+                batch.append(i)
+                nodes += self.nodes[i]
+                edges += self.edges[i]
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        if self.num_replicas > 1 and batches:
+            # every rank has to take part in every step
+            total = len(batches) + -len(batches) % self.num_replicas
+            batches = [batches[i % len(batches)] for i in range(self.rank, total, self.num_replicas)]
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
+
+class ContrastiveCollater(object):
+    """
+    collates a list of graphs into a PyG batch and samples descs_per_mesh
+    pre-tokenized descriptions of every mesh in it from tokens, inside the
+    DataLoader worker. the description strings are left out of the batch
+    """
+    def __init__(self, dataset, tokens, descs_per_mesh, exclude_keys=('descs',)):
+        self.collater = Collater(dataset, exclude_keys=list(exclude_keys))
+        self.tokens = tokens
+        self.descs_per_mesh = descs_per_mesh
+
+    def __call__(self, data_list):
+        batch = self.collater(data_list)
+        return batch, self.tokens.sample_tokens(batch.model_id, self.descs_per_mesh)
+
+class ContrastiveDataLoader(torch.utils.data.DataLoader):
+    """
+    PyG's DataLoader, yielding (batch, descs) pairs where descs are the
+    token ids TokenStore.sample_tokens draws for the meshes of batch. with
+    num_workers, sampling and collation run in the worker processes, which
+    read the token store from shared memory, stay alive between epochs and
+    keep prefetch_factor batches each in flight
+    """
+    def __init__(self, dataset, tokens, descs_per_mesh, batch_size=1, shuffle=False, **kwargs):
+        kwargs.pop('collate_fn', None)
+        if kwargs.get('num_workers', 0) > 0:
+            tokens.share_memory()
+            kwargs.setdefault('persistent_workers', True)
+        else:
+            kwargs.pop('prefetch_factor', None)
+        super().__init__(dataset, batch_size, shuffle,
+                         collate_fn=ContrastiveCollater(dataset, tokens, descs_per_mesh), **kwargs)
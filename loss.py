@@ -1,35 +1,78 @@
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+def block_logsumexp(desc_block, mesh_embeddings, logit_scale):
+    """
+    Returns
+    -------
+    desc_lse: torch.Tensor
+        logsumexp over the meshes of every description in desc_block
+    mesh_lse: torch.Tensor
+        logsumexp over the descriptions of desc_block of every mesh
+    """
+    logits = logit_scale.exp() * desc_block @ mesh_embeddings.T
+    return torch.logsumexp(logits, dim=1), torch.logsumexp(logits, dim=0)
 
 class ContrastiveLoss(nn.Module):
-    def __init__(self):
+    """
+    symmetric cross-entropy between descriptions and meshes: every
+    description's target is its mesh, every mesh's target is uniform over its
+    descriptions. the targets are never built as matrices; both directions
+    are their logsumexp minus the gathered logits of the matching pairs
+
+    Parameters
+    ----------
+    chunk_size: int
+        if given, the logits are computed chunk_size descriptions at a time and
+        recomputed in the backward pass, so the n_desc x n_mesh matrix is never
+        held in memory
+    """
+    def __init__(self, chunk_size=None):
         super().__init__()
 
-        self.desc_loss_fn = nn.CrossEntropyLoss()
-        self.mesh_loss_fn = nn.CrossEntropyLoss()
+        self.chunk_size = chunk_size
         self.logit_scale = nn.Parameter(torch.log(torch.tensor(1 / 0.07)))
 
-    def forward(self, desc_embeddings, mesh_embeddings):
+    def forward(self, desc_embeddings, mesh_embeddings, desc2mesh=None):
+        """
+        Parameters
+        ----------
+        desc_embeddings: torch.Tensor
+            (n_desc x dim) embeddings of the descriptions
+        mesh_embeddings: torch.Tensor
+            (n_mesh x dim) embeddings of the meshes
+        desc2mesh: torch.Tensor
+            index of the mesh of every description, for ragged description
+            counts. defaults to n_desc // n_mesh consecutive descriptions per mesh
+        """
         n_desc = desc_embeddings.shape[0]
         n_mesh = mesh_embeddings.shape[0]
-        descs_per_mesh = n_desc // n_mesh
-
-        # predicted logits
-        logits_per_mesh = self.logit_scale.exp() * mesh_embeddings @ desc_embeddings.T
-        logits_per_desc = logits_per_mesh.T
-
-        # target distributions
-        targets_per_desc = torch.zeros(n_desc, n_mesh).to(desc_embeddings.device)
-        # one-hot distribution for single matching mesh
-        targets_per_desc[torch.arange(n_desc), 
-                         torch.arange(n_mesh).repeat_interleave(descs_per_mesh)] = 1
-        targets_per_mesh = torch.zeros(n_mesh, n_desc).to(mesh_embeddings.device)
-        # uniform distribution over matching descs
-        targets_per_mesh[torch.arange(n_mesh).unsqueeze(dim=1), 
-                         torch.arange(n_desc).reshape(n_desc // descs_per_mesh, descs_per_mesh)] = 1 / descs_per_mesh
-
-        desc_loss = self.desc_loss_fn(logits_per_desc, targets_per_desc)
-        mesh_loss = self.desc_loss_fn(logits_per_mesh, targets_per_mesh)
+        if desc2mesh is None:
+            descs_per_mesh = n_desc // n_mesh
+            desc2mesh = torch.arange(n_mesh, device=desc_embeddings.device).repeat_interleave(descs_per_mesh)
+
+        if self.chunk_size is None:
+            desc_lse, mesh_lse = block_logsumexp(desc_embeddings, mesh_embeddings, self.logit_scale)
+        else:
+            desc_lses = []
+            mesh_lse = None
+            for desc_block in desc_embeddings.split(self.chunk_size):
+                block_desc_lse, block_mesh_lse = checkpoint(block_logsumexp, desc_block, mesh_embeddings,
+                                                            self.logit_scale, use_reentrant=False)
+                desc_lses.append(block_desc_lse)
+                mesh_lse = block_mesh_lse if mesh_lse is None else torch.logaddexp(mesh_lse, block_mesh_lse)
+            desc_lse = torch.cat(desc_lses)
+
+        # logits of the matching pairs
+        positives = self.logit_scale.exp() * (desc_embeddings * mesh_embeddings[desc2mesh]).sum(dim=1)
+        counts = torch.bincount(desc2mesh, minlength=n_mesh).to(positives.dtype)
+        mesh_positives = torch.zeros(n_mesh, dtype=positives.dtype, device=positives.device).index_add_(0, desc2mesh, positives)
+        mesh_positives = mesh_positives / counts.clamp(min=1)
+
+        desc_loss = (desc_lse - positives).mean()
+        # a mesh without descriptions has no target, and adds nothing
+        mesh_loss = torch.where(counts > 0, mesh_lse - mesh_positives, 0.).mean()
         total_loss = (desc_loss + mesh_loss) / 2
-        
+
         return total_loss
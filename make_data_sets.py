@@ -1,18 +1,31 @@
-from dataset_pyg import AnnotatedMeshDataset
-import torch
 import os
+import json
+from argparse import ArgumentParser
+from dataset_pyg import SPLITS, split_of, split_path
 
-dataset = AnnotatedMeshDataset('dataset')
-dataset.shuffle()
-dataset = dataset[:5000]
+# assigns every annotated model to train/val/test by a seeded hash of its id
+# and writes only the model ids of each split to dataset/processed/splits.json.
+# the training scripts open the splits as views with dataset_pyg.load_split
+argp = ArgumentParser()
+argp.add_argument('--root',
+    help='dataset root containing annotations.json', default='dataset')
+argp.add_argument('--seed',
+    help='seed of the split hash', type=int, default=0)
+argp.add_argument('--train',
+    help='share of models in the train split', type=float, default=0.8)
+argp.add_argument('--val',
+    help='share of models in the val split, the rest are test', type=float, default=0.1)
+args = argp.parse_args()
 
-train_share = int(0.8 * len(dataset))
-val_share = int(0.1 * len(dataset))
+with open(os.path.join(args.root, 'annotations.json'), 'r') as annotations_file:
+    model_ids = sorted(json.load(annotations_file))
 
-train_set = dataset[:train_share]
-val_set = dataset[train_share:train_share + val_share]
-test_set = dataset[train_share + val_share:train_share + 2*val_share]
+splits = {split: [] for split in SPLITS}
+for model_id in model_ids:
+    splits[split_of(model_id, args.seed, (args.train, args.val))].append(model_id)
 
-torch.save(train_set, os.path.join('dataset', 'processed', 'train_set.pt'))
-torch.save(val_set, os.path.join('dataset', 'processed', 'val_set.pt'))
-torch.save(test_set, os.path.join('dataset', 'processed', 'test_set.pt'))
+path = split_path(args.root)
+os.makedirs(os.path.dirname(path), exist_ok=True)
+with open(path, 'w') as split_file:
+    json.dump({'seed': args.seed, 'fractions': [args.train, args.val], 'splits': splits}, split_file)
+print(', '.join('{} {}'.format(len(splits[split]), split) for split in SPLITS), 'models in', path)
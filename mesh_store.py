@@ -0,0 +1,183 @@
+import os
+import json
+import logging
+import numpy as np
+from tqdm import tqdm
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+log = logging.getLogger("mesh_store")
+
+# a mesh store shard is a single file:
+#   MAGIC | uint64 header length | json header | arrays, each 64-byte aligned
+# the header lists the model ids and the dtype, shape and byte offset of
+# every array. all meshes of the shard are concatenated in each array, and
+# the offsets array gives where each mesh starts, so opening one mesh is
+# a handful of slices into a memory map
+MAGIC = b'BCMESH01'
+ALIGNMENT = 64
+
+# per-mesh arrays, the offsets column that indexes them, dtype and row width
+FIELDS = [('vertices', 0, np.float32, 3),
+          ('colors', 0, np.float32, 3),
+          ('faces', 1, np.int32, 3),
+          ('edges', 2, np.int32, 2),
+          ('edge_lengths', 2, np.float32, None)]
+
+def _row_counts(mesh):
+    return [len(mesh['vertices']), len(mesh['faces']), len(mesh['edges'])]
+
+def write_mesh_store(path, model_ids, meshes):
+    """
+    Parameters
+    ----------
+    path: str
+        shard file to write
+    model_ids: list of str
+    meshes: list of dicts
+        with 'vertices', 'colors', 'faces' (local vertex indices), 'edges'
+        (unique undirected edges, local vertex indices) and 'edge_lengths',
+        and optionally 'orig_size' and 'n_missing_colors'
+    """
+    offsets = np.zeros((len(meshes) + 1, 3), dtype=np.int64)
+    offsets[1:] = np.cumsum([_row_counts(mesh) for mesh in meshes], axis=0).reshape(-1, 3)
+    # vertex and face counts before any simplification
+    orig_sizes = [mesh.get('orig_size', (len(mesh['vertices']), len(mesh['faces']))) for mesh in meshes]
+    arrays = {'offsets': offsets, 'orig_sizes': np.array(orig_sizes, dtype=np.int64).reshape(-1, 2),
+              'n_missing_colors': np.array([mesh.get('n_missing_colors', 0) for mesh in meshes], dtype=np.int64)}
+    for name, _, dtype, width in FIELDS:
+        shape = (0,) if width is None else (0, width)
+        parts = [np.asarray(mesh[name], dtype=dtype).reshape(-1, *shape[1:]) for mesh in meshes]
+        arrays[name] = np.concatenate(parts) if len(parts) > 0 else np.zeros(shape, dtype=dtype)
+
+    header = {'model_ids': list(model_ids), 'arrays': {}}
+    position = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': position}
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + position)
+    os.replace(tmp_path, path)
+
+def read_header(path):
+    """
+    Returns
+    -------
+    header: dict
+        the json header of the shard at path
+    data_start: int
+        byte offset of the first array
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a mesh store shard')
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    return header, -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+class MeshStore(object):
+    """
+    read-only view of one mesh store shard. the file is memory mapped, so
+    meshes are only paged in when their arrays are touched
+    """
+    def __init__(self, path):
+        self.path = path
+        header, data_start = read_header(path)
+        self.model_ids = header['model_ids']
+        self.model_index = {model_id: i for i, model_id in enumerate(self.model_ids)}
+        self._memmap = np.memmap(path, dtype=np.uint8, mode='r')
+        self.arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            start = data_start + spec['offset']
+            n_bytes = int(np.prod(spec['shape'])) * dtype.itemsize
+            self.arrays[name] = self._memmap[start:start + n_bytes].view(dtype).reshape(spec['shape'])
+        self.offsets = self.arrays['offsets']
+
+    def __len__(self):
+        return len(self.model_ids)
+
+    def __getitem__(self, idx):
+        """
+        zero-copy views of the arrays of mesh idx (an int or a model id)
+        """
+        if isinstance(idx, str):
+            idx = self.model_index[idx]
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        mesh = {'model_id': self.model_ids[idx], 'orig_size': self.arrays['orig_sizes'][idx]}
+        # shards written before the count was stored do not have it
+        if 'n_missing_colors' in self.arrays:
+            mesh['n_missing_colors'] = int(self.arrays['n_missing_colors'][idx])
+        for name, column, _, _ in FIELDS:
+            mesh[name] = self.arrays[name][start[column]:end[column]]
+        return mesh
+
+    def sizes(self):
+        """
+        (n_meshes x 3) vertex, face and edge counts of every mesh
+        """
+        return np.diff(self.offsets, axis=0)
+
+def shard_paths(store_dir):
+    return sorted(os.path.join(store_dir, name) for name in os.listdir(store_dir) if name.endswith('.mesh'))
+
+def _load(task):
+    from dataset_pyg import load_colored_mesh
+    obj_class, obj_folder, simplify = task
+    try:
+        mesh = load_colored_mesh(obj_class, obj_folder, simplify)
+    except Exception:
+        log.exception('skipping %s/%s', obj_class, obj_folder)
+        return None
+    mesh['edges'] = mesh.pop('edges_unique')
+    return mesh
+
+def convert(obj_classes, store_dir, shard_size=1000, num_workers=1, simplify=None):
+    """
+    writes every model under dataset/colored_models/<obj_class> into
+    store_dir/shard_<i>.mesh, shard_size models per shard, after applying
+    dataset_pyg.simplify_mesh with the options in simplify, if any
+    """
+    from dataset_pyg import list_models
+    os.makedirs(store_dir, exist_ok=True)
+    models = list_models(obj_classes)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for shard, start in enumerate(range(0, len(models), shard_size)):
+            shard_models = models[start:start + shard_size]
+            tasks = [(obj_class, obj_folder, simplify) for obj_class, obj_folder in shard_models]
+            loaded = list(tqdm(pool.map(_load, tasks, chunksize=4), total=len(shard_models),
+                               desc='shard {}'.format(shard)))
+            done = [(model[1], mesh) for model, mesh in zip(shard_models, loaded) if mesh is not None]
+            write_mesh_store(os.path.join(store_dir, 'shard_{:05d}.mesh'.format(shard)),
+                             [model_id for model_id, _ in done], [mesh for _, mesh in done])
+
+if __name__ == "__main__":
+    argp = ArgumentParser()
+    argp.add_argument('--classes',
+        help='object classes under dataset/colored_models to convert', nargs='+', default=['Table'])
+    argp.add_argument('--out',
+        help='directory to write the shards to', default=os.path.join('dataset', 'processed', 'mesh_store'))
+    argp.add_argument('--shard_size',
+        help='number of meshes per shard file', type=int, default=1000)
+    argp.add_argument('--workers',
+        help='number of loading processes', type=int, default=os.cpu_count())
+    argp.add_argument('--weld',
+        help='merge coincident vertices', action='store_true')
+    argp.add_argument('--max_faces',
+        help='decimate meshes with more faces than this', type=int, default=None)
+    argp.add_argument('--max_vertices',
+        help='decimate meshes with more vertices than this', type=int, default=None)
+    args = argp.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    simplify = {'weld': args.weld, 'max_faces': args.max_faces, 'max_vertices': args.max_vertices}
+    convert(args.classes, args.out, args.shard_size, args.workers, simplify)
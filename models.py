@@ -14,7 +14,7 @@ from transformers import AutoTokenizer, AutoModel, CLIPProcessor, Trainer, Train
 import spacy
 from spacy.symbols import NOUN, ADJ
 
-from layers import BatchZERON_GCN, BatchGCNMax
+from layers import BatchZERON_GCN, BatchGCNMax, SparseZERON_GCN, SparseGCNMax
 device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
 
 class DescriptionContextEncoder(nn.Module):
@@ -73,9 +73,10 @@ class DescriptionContextEncoder(nn.Module):
         """
         Parameters
         ----------
-        tokenized_descs: torch.Tensor
-            tokenized model descriptions as returned by tokenize
-            of shape ((BATCH_SIZE * descs_per_mesh) x model_max_length)
+        descs: list of lists or dict
+            sampled descriptions as taken by tokenize, or already tokenized
+            'full_desc' and 'adj_noun' id tensors from TokenStore.gather
+            of shape ((BATCH_SIZE * descs_per_mesh) x max_length)
         
         Returns
         -------
@@ -83,13 +84,14 @@ class DescriptionContextEncoder(nn.Module):
             description embeddings 
             of shape ((BATCH_SIZE * descs_per_mesh) x joint_embed_dim)
         """
-        tokenized_descs = self.tokenize(descs)
+        pretokenized = isinstance(descs, dict)
+        tokenized_descs = descs['full_desc'].to(device) if pretokenized else self.tokenize(descs)
         last_hidden_state = self.huggingface_encoder(tokenized_descs).last_hidden_state
         # define 'global_context' as the hidden output of [EOS]
         global_context = last_hidden_state[torch.arange(last_hidden_state.shape[0]), tokenized_descs.argmax(dim=1)] # (tokenized_descs == self.eos_token_id).nonzero()]
         # print(global_context.shape)
         if self.adj_noun:
-            tokenized_adj_noun = self.adj_noun_tokenize(descs)
+            tokenized_adj_noun = descs['adj_noun'].to(device) if pretokenized else self.adj_noun_tokenize(descs)
 
             last_adj_noun_hidden_state = self.huggingface_encoder(tokenized_adj_noun).last_hidden_state
             adj_noun_context = last_adj_noun_hidden_state[torch.arange(last_hidden_state.shape[0]), tokenized_adj_noun.argmax(dim=1)]
@@ -282,25 +284,28 @@ class AdvancedMeshEncoder(nn.Module):
 
 
 class BatchMeshEncoder(nn.Module):
+    gcn_layer = BatchZERON_GCN
+    max_layer = BatchGCNMax
+
     def __init__(self, joint_embed_dim):
         super(BatchMeshEncoder, self).__init__()
-        self.h1 = BatchZERON_GCN(3, 60)
-        self.h21 = BatchZERON_GCN(60, 60)
-        self.h22 = BatchZERON_GCN(60, 60)
-        self.h23 = BatchZERON_GCN(60, 60)
-        self.h24 = BatchZERON_GCN(60,120)
-        self.h3 = BatchZERON_GCN(120, 120)
-        self.h4 = BatchZERON_GCN(120, 120)
-        self.h41 = BatchZERON_GCN(120, 150)
-        self.h5 = BatchZERON_GCN(150, 200)
-        self.h6 = BatchZERON_GCN(200, 210)
-        self.h7 = BatchZERON_GCN(210, 250)
-        self.h8 = BatchZERON_GCN(250, 300)
-        self.h81 = BatchZERON_GCN(300, 300)
-        self.h9 = BatchZERON_GCN(300, 300)
-        self.h10 = BatchZERON_GCN(300, 300)
-        self.h11 = BatchZERON_GCN(300, 300)
-        self.reduce = BatchGCNMax(300,joint_embed_dim)
+        self.h1 = self.gcn_layer(3, 60)
+        self.h21 = self.gcn_layer(60, 60)
+        self.h22 = self.gcn_layer(60, 60)
+        self.h23 = self.gcn_layer(60, 60)
+        self.h24 = self.gcn_layer(60,120)
+        self.h3 = self.gcn_layer(120, 120)
+        self.h4 = self.gcn_layer(120, 120)
+        self.h41 = self.gcn_layer(120, 150)
+        self.h5 = self.gcn_layer(150, 200)
+        self.h6 = self.gcn_layer(200, 210)
+        self.h7 = self.gcn_layer(210, 250)
+        self.h8 = self.gcn_layer(250, 300)
+        self.h81 = self.gcn_layer(300, 300)
+        self.h9 = self.gcn_layer(300, 300)
+        self.h10 = self.gcn_layer(300, 300)
+        self.h11 = self.gcn_layer(300, 300)
+        self.reduce = self.max_layer(300,joint_embed_dim)
 
     def resnet(self, features, res):
         temp = features[:,:res.shape[1]]
@@ -332,6 +337,40 @@ class BatchMeshEncoder(nn.Module):
 
         return latent
 
+class SparseMeshEncoder(BatchMeshEncoder):
+    """
+    BatchMeshEncoder on the concatenated vertices of a batch of meshes with an
+    edge list instead of padded dense adjacencies, so memory grows with the
+    number of edges rather than batch size x max vertices^2. the parameters
+    are the same, so state dicts load into either one
+    """
+    gcn_layer = SparseZERON_GCN
+    max_layer = SparseGCNMax
+
+    def forward(self, mesh, play = False):
+        """
+        Parameters
+        ----------
+        mesh: tuple
+            positions (total_verts x 3), edge_index (2 x n_edges) with the
+            receiving vertex first, edge_weight (n_edges) holding the
+            normalized adjacency entries, and batch (total_verts), the mesh
+            each vertex belongs to, as built by utils.batch_edge_list
+
+        Returns
+        -------
+        latent: torch.Tensor
+            (n_meshes x joint_embed_dim)
+        """
+        positions, edge_index, edge_weight, batch = mesh
+        features = positions
+        for layer in [self.h1, self.h21, self.h22, self.h23, self.h24, self.h3, self.h4, self.h41,
+                      self.h5, self.h6, self.h7, self.h8, self.h81, self.h9, self.h10, self.h11]:
+            features = layer(features, edge_index, F.elu, edge_weight)
+        latent = self.reduce(features, edge_index, F.elu, batch, edge_weight)
+
+        return latent
+
 class LayerNorm(nn.LayerNorm):
     """Subclass torch's LayerNorm to handle fp16."""
 
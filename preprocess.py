@@ -0,0 +1,43 @@
+import os
+import logging
+from argparse import ArgumentParser
+from dataset_pyg import process_shard, merge_shards
+from token_store import build_token_store
+
+# builds dataset/processed/data.pt, optionally split across several machines:
+#   python preprocess.py --workers 64 --shard 0/4   (on each machine, 0/4 .. 3/4)
+#   python preprocess.py --merge --shard 0/4        (once all shards are done)
+argp = ArgumentParser()
+argp.add_argument('--root',
+    help='dataset root containing annotations.json', default='dataset')
+argp.add_argument('--classes',
+    help='object classes under dataset/colored_models to process', nargs='+', default=['Table'])
+argp.add_argument('--workers',
+    help='number of preprocessing processes', type=int, default=os.cpu_count())
+argp.add_argument('--shard',
+    help='which part of the dataset to build, as i/n', default='0/1')
+argp.add_argument('--weld',
+    help='merge coincident vertices', action='store_true')
+argp.add_argument('--max_faces',
+    help='decimate meshes with more faces than this', type=int, default=None)
+argp.add_argument('--max_vertices',
+    help='decimate meshes with more vertices than this', type=int, default=None)
+argp.add_argument('--merge',
+    help='collate the finished shards into data.pt', action='store_true')
+args = argp.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+
+shard, num_shards = [int(s) for s in args.shard.split('/')]
+assert 0 <= shard < num_shards, '--shard must be i/n with 0 <= i < n'
+processed_dir = os.path.join(args.root, 'processed')
+simplify = None
+if args.weld or args.max_faces is not None or args.max_vertices is not None:
+    simplify = {'weld': args.weld, 'max_faces': args.max_faces, 'max_vertices': args.max_vertices}
+
+if not args.merge:
+    process_shard(args.root, processed_dir, args.classes, shard, num_shards, args.workers, simplify)
+if args.merge or num_shards == 1:
+    data, slices = merge_shards(processed_dir, num_shards)
+    print('merged', len(slices['x']) - 1, 'graphs into', os.path.join(processed_dir, 'data.pt'))
+    print('tokenized descriptions into', build_token_store(args.root, processed_dir))
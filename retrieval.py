@@ -1,5 +1,5 @@
 from lib2to3.pgen2.token import tok_name
-from dataset_pyg import AnnotatedMeshDataset
+from dataset_pyg import AnnotatedMeshDataset, load_split
 from torch_geometric.loader import DataLoader
 from models import DescriptionContextEncoder, MeshEncoder
 import torch
@@ -8,7 +8,7 @@ import random
 from tqdm import tqdm
 import os
 
-dataset = torch.load('dataset/processed/val_set.pt')
+dataset = load_split(AnnotatedMeshDataset('dataset'), 'val')
 retrieval_dataset = dataset[:20]
 retrieval_dataloader = DataLoader(retrieval_dataset, batch_size=2, shuffle=False)
 
@@ -0,0 +1,211 @@
+import os
+import json
+import pickle
+import numpy as np
+import pytest
+import torch
+import dataset_pyg
+from adj_noun import desc_key
+
+TETRAHEDRON = np.array([[0., 0., 0.], [1., 0., 0.], [0., 1., 0.], [0., 0., 1.]])
+TETRAHEDRON_FACES = np.array([[1, 3, 2], [1, 2, 4], [1, 4, 3], [2, 3, 4]])
+
+def write_model(model_dir, vertices, colors, frame=np.eye(3)):
+    """
+    model.obj of vertices, and vertex_colors.pickle baking colors at the
+    vertices mapped into frame
+    """
+    os.makedirs(model_dir)
+    with open(os.path.join(model_dir, 'model.obj'), 'w') as obj_file:
+        for vertex in vertices:
+            obj_file.write('v {} {} {}\n'.format(*vertex))
+        for face in TETRAHEDRON_FACES:
+            obj_file.write('f {} {} {}\n'.format(*face))
+    baked = {tuple(position): list(color) for position, color in zip(vertices @ frame.T, colors)}
+    with open(os.path.join(model_dir, 'vertex_colors.pickle'), 'wb') as vertex_colors_file:
+        pickle.dump(baked, vertex_colors_file)
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    """
+    dataset root of three tetrahedra, with their adjective/noun strings
+    cached so that no parser is loaded
+    """
+    monkeypatch.setattr(dataset_pyg, 'COLORED_MODELS_DIR', str(tmp_path / 'colored_models'))
+    model2desc = {}
+    for i in range(3):
+        obj_folder = 'model{}'.format(i)
+        write_model(str(tmp_path / 'colored_models' / 'Table' / obj_folder), TETRAHEDRON + i,
+                    np.full((4, 3), i / 3))
+        model2desc[obj_folder] = ['a table {}'.format(i), 'a red table {}'.format(i)]
+    with open(tmp_path / 'annotations.json', 'w') as annotations_file:
+        json.dump(model2desc, annotations_file)
+    os.makedirs(tmp_path / 'processed')
+    with open(tmp_path / 'processed' / 'adj_noun_cache.json', 'w') as cache_file:
+        json.dump({desc_key(desc): '' for descs in model2desc.values() for desc in descs}, cache_file)
+    return str(tmp_path)
+
+@pytest.fixture
+def built(monkeypatch):
+    """
+    the models build_graph is called for
+    """
+    calls = []
+    build_graph = dataset_pyg.build_graph
+    def counting_build_graph(obj_class, obj_folder, descs, simplify=None):
+        calls.append(obj_folder)
+        return build_graph(obj_class, obj_folder, descs, simplify)
+    monkeypatch.setattr(dataset_pyg, 'build_graph', counting_build_graph)
+    return calls
+
+def test_process_shard_reuses_cache(root, built):
+    processed_dir = os.path.join(root, 'processed')
+    dataset_pyg.process_shard(root, processed_dir, ['Table'])
+    assert sorted(built) == ['model0', 'model1', 'model2']
+
+    del built[:]
+    dataset_pyg.process_shard(root, processed_dir, ['Table'])
+    assert built == []
+
+    # changed inputs are rebuilt, and only those
+    write_model(os.path.join(root, 'colored_models', 'Table', 'model3'), TETRAHEDRON, np.zeros((4, 3)))
+    with open(os.path.join(root, 'colored_models', 'Table', 'model1', 'vertex_colors.pickle'), 'wb') as vertex_colors_file:
+        pickle.dump({}, vertex_colors_file)
+    with open(os.path.join(root, 'annotations.json'), 'r') as annotations_file:
+        model2desc = json.load(annotations_file)
+    model2desc['model3'] = model2desc['model0']
+    with open(os.path.join(root, 'annotations.json'), 'w') as annotations_file:
+        json.dump(model2desc, annotations_file)
+    dataset_pyg.process_shard(root, processed_dir, ['Table'])
+    assert sorted(built) == ['model1', 'model3']
+
+def test_merge_shards_round_trip(root):
+    processed_dir = os.path.join(root, 'processed')
+    for shard in range(2):
+        dataset_pyg.process_shard(root, processed_dir, ['Table'], shard=shard, num_shards=2)
+    data, slices = dataset_pyg.merge_shards(processed_dir, num_shards=2)
+
+    saved_data, saved_slices = torch.load(os.path.join(processed_dir, 'data.pt'), weights_only=False)
+    assert saved_data.model_id == data.model_id == ['model0', 'model1', 'model2']
+    for key in slices:
+        assert torch.equal(saved_slices[key], slices[key])
+    for i, obj_folder in enumerate(data.model_id):
+        graph = dataset_pyg.load_graph(processed_dir, obj_folder)
+        x = saved_data.x[saved_slices['x'][i]:saved_slices['x'][i + 1]]
+        edge_index = saved_data.edge_index[:, saved_slices['edge_index'][i]:saved_slices['edge_index'][i + 1]]
+        assert torch.equal(x, graph.x)
+        assert torch.equal(edge_index, graph.edge_index)
+        assert saved_data.descs[i] == graph.descs
+
+def test_join_vertex_colors_blender_frame():
+    rng = np.random.default_rng(0)
+    vertices = rng.uniform(-1, 1, (500, 3))
+    colors = rng.uniform(0, 1, (500, 3)).astype(np.float32)
+    # blender bakes (x, y, z) at (x, -z, y)
+    blender = np.stack([vertices[:, 0], -vertices[:, 2], vertices[:, 1]], axis=1)
+    pos2col = {tuple(position): list(color) for position, color in zip(blender, colors)}
+
+    joined, n_missing = dataset_pyg.join_vertex_colors(vertices, pos2col)
+    assert n_missing == 0
+    np.testing.assert_array_equal(joined, colors)
+
+def test_load_colored_mesh_blender_frame(root):
+    obj_to_blender = np.array([[1., 0., 0.], [0., 0., -1.], [0., 1., 0.]])
+    colors = np.eye(4, 3, dtype=np.float32)
+    write_model(os.path.join(dataset_pyg.COLORED_MODELS_DIR, 'Chair', 'model0'), TETRAHEDRON + 0.5,
+                colors, frame=obj_to_blender)
+    mesh = dataset_pyg.load_colored_mesh('Chair', 'model0')
+    assert mesh['n_missing_colors'] == 0
+    np.testing.assert_array_equal(mesh['colors'], colors)
+
+def test_shared_copy_replaces_older_versions(tmp_path):
+    shm_dir = str(tmp_path / 'shm')
+    os.makedirs(shm_dir)
+    path = str(tmp_path / 'data.pt')
+    with open(path, 'wb') as f:
+        f.write(b'old')
+    old_copy = dataset_pyg.shared_copy(path, shm_dir)
+    assert dataset_pyg.shared_copy(path, shm_dir) == old_copy
+
+    with open(path, 'wb') as f:
+        f.write(b'rebuilt')
+    new_copy = dataset_pyg.shared_copy(path, shm_dir)
+    assert new_copy != old_copy
+    assert os.listdir(shm_dir) == [os.path.basename(new_copy)]
+    with open(new_copy, 'rb') as f:
+        assert f.read() == b'rebuilt'
+
+    assert dataset_pyg.release_shared(path, shm_dir) == [new_copy]
+    assert os.listdir(shm_dir) == []
+
+def test_shards_merge_adj_noun_caches(root, monkeypatch):
+    import spacy
+    import adj_noun
+    monkeypatch.setattr(adj_noun, 'load_parser', lambda: spacy.blank('en'))
+    processed_dir = os.path.join(root, 'processed')
+    os.remove(dataset_pyg.adj_noun_cache_path(processed_dir))
+    for shard in range(2):
+        dataset_pyg.process_shard(root, processed_dir, ['Table'], shard=shard, num_shards=2)
+    assert not os.path.exists(dataset_pyg.adj_noun_cache_path(processed_dir))
+    shard_caches = [adj_noun.load_cache(dataset_pyg.adj_noun_cache_path(processed_dir, shard, 2)) for shard in range(2)]
+    assert sorted(len(cache) for cache in shard_caches) == [2, 4]
+
+    dataset_pyg.merge_shards(processed_dir, num_shards=2)
+    merged = adj_noun.load_cache(dataset_pyg.adj_noun_cache_path(processed_dir))
+    assert merged == {**shard_caches[0], **shard_caches[1]}
+    assert [name for name in os.listdir(processed_dir) if name.endswith('.tmp')] == []
+
+def test_shared_dataset_views_share_storage(root, monkeypatch):
+    processed_dir = os.path.join(root, 'processed')
+    dataset_pyg.process_shard(root, processed_dir, ['Table'])
+    dataset_pyg.merge_shards(processed_dir, num_shards=1)
+    loads = []
+    load = torch.load
+    monkeypatch.setattr(torch, 'load', lambda *args, **kwargs: loads.append(args) or load(*args, **kwargs))
+
+    dataset = dataset_pyg.AnnotatedMeshDataset(root, share='mmap')
+    view = dataset[:2][1:]
+    assert len(loads) == 1
+    assert view._data.x.data_ptr() == dataset._data.x.data_ptr()
+    assert torch.equal(view[0].x, dataset[1].x)
+
+    # pickled for another process, the file is mapped again
+    unpickled = pickle.loads(pickle.dumps(view))
+    assert len(loads) == 2
+    assert torch.equal(unpickled[0].x, dataset[1].x)
+
+def test_lazy_dataset_matches_eager(root):
+    from mesh_store import write_mesh_store
+    processed_dir = os.path.join(root, 'processed')
+    dataset_pyg.process_shard(root, processed_dir, ['Table'])
+    data, slices = dataset_pyg.merge_shards(processed_dir, num_shards=1)
+
+    store_dir = os.path.join(processed_dir, 'mesh_store')
+    os.makedirs(store_dir)
+    for shard, (obj_class, obj_folder) in enumerate(dataset_pyg.list_models(['Table'])):
+        mesh = dataset_pyg.load_colored_mesh(obj_class, obj_folder)
+        mesh['edges'] = mesh.pop('edges_unique')
+        write_mesh_store(os.path.join(store_dir, 'shard_{:05d}.mesh'.format(shard)), [obj_folder], [mesh])
+
+    lazy = dataset_pyg.LazyAnnotatedMeshDataset(root, max_open_shards=2, prefetch=5)
+    assert lazy.prefetch == 1
+    for i in range(len(lazy)):
+        graph = lazy.get(i)
+        # the prefetch of the next shard never closes the one being read
+        while lazy._pending:
+            pass
+        assert i in lazy._stores
+        assert graph.model_id == data.model_id[i]
+        assert torch.equal(graph.x, data.x[slices['x'][i]:slices['x'][i + 1]])
+        assert torch.equal(graph.edge_index, data.edge_index[:, slices['edge_index'][i]:slices['edge_index'][i + 1]])
+        assert graph.n_missing_colors == int(data.n_missing_colors[i])
+
+def test_process_shard_skips_unannotated_models(root, built):
+    write_model(os.path.join(dataset_pyg.COLORED_MODELS_DIR, 'Table', 'model1a'), TETRAHEDRON, np.zeros((4, 3)))
+    processed_dir = os.path.join(root, 'processed')
+    dataset_pyg.process_shard(root, processed_dir, ['Table'])
+    assert sorted(built) == ['model0', 'model1', 'model2']
+    with open(dataset_pyg.shard_manifest_path(processed_dir, 0, 1), 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    assert [model[2] for model in manifest['models']] == ['model0', 'model1', 'model2']
+    assert [model[0] for model in manifest['models']] == [0, 1, 3]
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import torch
+import utils
+
+# two triangles sharing the edge (0, 1), both obtuse at the vertex opposite it
+OBTUSE_VERTS = torch.tensor([[0., 0., 0.], [2., 0., 0.], [1., 0.1, 0.], [1., -0.1, 0.], [1., 1., 1.]])
+OBTUSE_FACES = torch.tensor([[0, 1, 2], [1, 0, 3], [2, 1, 4]])
+
+def test_cotangent_laplacian_obtuse_triangle():
+    rows, cols, values = utils.cotangent_weights(OBTUSE_FACES, OBTUSE_VERTS, 5)
+    assert (values < 0).any()
+
+    operator = utils.LaplacianOperator(OBTUSE_FACES, weights='cotangent', verts=OBTUSE_VERTS)
+    weights = operator.matrix.to_dense()
+    assert (weights >= 0).all()
+    # every vertex is compared to a convex combination of its neighbours
+    row_sums = (weights * operator.inv_degrees).sum(dim = 1)
+    torch.testing.assert_close(row_sums, torch.ones(5))
+
+    positions = torch.randn(2, 5, 3)
+    laplacian = operator(positions)
+    assert torch.isfinite(laplacian).all()
+    torch.testing.assert_close(operator(positions + torch.tensor([1., 2., 3.])), laplacian)
+
+def test_laplacian_operator_cache(monkeypatch):
+    finalized = []
+    finalize = utils.weakref.finalize
+    monkeypatch.setattr(utils.weakref, 'finalize', lambda obj, *args: finalized.append(id(obj)) or finalize(obj, *args))
+    utils._laplacian_cache.clear()
+    faces = OBTUSE_FACES.clone()
+    operator = utils.laplacian_operator(faces)
+    assert utils.laplacian_operator(faces) is operator
+
+    # modified in place, the entry of the mesh is replaced rather than added to
+    faces[0] = faces[0].flip(0)
+    assert utils.laplacian_operator(faces) is not operator
+    assert len(utils._laplacian_cache) == 1
+
+    meshes = [OBTUSE_FACES.clone() for _ in range(utils.LAPLACIAN_CACHE_SIZE + 8)]
+    for mesh in meshes:
+        utils.laplacian_operator(mesh)
+    assert len(utils._laplacian_cache) == utils.LAPLACIAN_CACHE_SIZE
+    # evicted and cached again, a mesh keeps its one finalizer
+    for _ in range(3):
+        for mesh in meshes:
+            utils.laplacian_operator(mesh)
+    assert sorted(finalized) == sorted([id(faces)] + [id(mesh) for mesh in meshes])
+    del meshes, mesh
+    assert len(utils._laplacian_cache) == 0
+
+def write_obj(tmp_path, text):
+    path = str(tmp_path / 'model.obj')
+    with open(path, 'w') as obj_file:
+        obj_file.write(text)
+    return path
+
+def test_read_obj(tmp_path):
+    path = write_obj(tmp_path, 'v 0 0 0\nv 1 0 0\nv 0 1 0\nv 1 1 0\nvt 0 0\nf 1/1 2/1 4/1 3/1\nf -4 -3 -2\n')
+    vertices, faces = utils.read_obj(path)
+    np.testing.assert_array_equal(vertices, [[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]])
+    np.testing.assert_array_equal(faces, [[0, 1, 3], [0, 3, 2], [0, 1, 2]])
+
+@pytest.mark.parametrize('text', ['v 0 0 0\nv 1 zero 0\nv 0 1 0\nf 1 2 3\n',
+                                  'v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 x\n',
+                                  'v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2\n',
+                                  'v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 4\n'])
+def test_read_obj_malformed(tmp_path, text):
+    path = write_obj(tmp_path, text)
+    with pytest.raises(utils.ObjFormatError, match='model.obj'):
+        utils.read_obj(path)
@@ -0,0 +1,156 @@
+import os
+import json
+import hashlib
+import logging
+import torch
+from argparse import ArgumentParser
+from adj_noun import desc_key, extract_adj_nouns
+log = logging.getLogger("token_store")
+
+TOKENIZER_ID = 'openai/clip-vit-base-patch32'
+FIELDS = ['full_desc', 'adj_noun']
+
+# the token store holds every description of every model already run
+# through the tokenizer, in a CSR layout:
+#   model_ids              the models, in store order
+#   mesh_ptr  [M + 1]      descriptions of model m are mesh_ptr[m]:mesh_ptr[m + 1]
+#   <field>/ids            int32 token ids of all descriptions, concatenated
+#   <field>/lengths [D]    int16 number of tokens of each description
+# with one ids/lengths pair for the full description and one for its
+# adjective/noun string
+def tokenize(tokenizer, texts, batch_size=1024):
+    """
+    Returns
+    -------
+    ids: torch.Tensor
+        int32 token ids of all texts, concatenated
+    lengths: torch.Tensor
+        int16 number of tokens of each text
+    """
+    token_lists = []
+    for start in range(0, len(texts), batch_size):
+        token_lists.extend(tokenizer(texts[start:start + batch_size], truncation=True).input_ids)
+    ids = torch.tensor([token for tokens in token_lists for token in tokens], dtype=torch.int32)
+    lengths = torch.tensor([len(tokens) for tokens in token_lists], dtype=torch.int16)
+    return ids, lengths
+
+def build_token_store(root, processed_dir, tokenizer=None):
+    """
+    tokenizes the full descriptions and adjective/noun strings of every model
+    in root/annotations.json into processed_dir/tokens.pt, unless it is
+    already up to date
+    """
+    annotations_path = os.path.join(root, 'annotations.json')
+    with open(annotations_path, 'rb') as annotations_file:
+        annotations_hash = hashlib.sha1(annotations_file.read()).hexdigest()
+    store_path = os.path.join(processed_dir, 'tokens.pt')
+    if os.path.exists(store_path):
+        store = torch.load(store_path)
+        if store.get('annotations') == annotations_hash and store.get('tokenizer') == TOKENIZER_ID:
+            return store_path
+
+    with open(annotations_path, 'r') as annotations_file:
+        model2desc = json.load(annotations_file)
+    model_ids = sorted(model2desc)
+    descriptions = [desc for model_id in model_ids for desc in model2desc[model_id]]
+    adj_nouns = extract_adj_nouns(descriptions, os.path.join(processed_dir, 'adj_noun_cache.json'))
+    if tokenizer is None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_ID)
+
+    mesh_ptr = torch.zeros(len(model_ids) + 1, dtype=torch.int64)
+    mesh_ptr[1:] = torch.cumsum(torch.tensor([len(model2desc[model_id]) for model_id in model_ids]), dim=0)
+    store = {'annotations': annotations_hash,
+             'tokenizer': TOKENIZER_ID,
+             'pad_token_id': tokenizer.pad_token_id,
+             'model_ids': model_ids,
+             'mesh_ptr': mesh_ptr}
+    texts = {'full_desc': descriptions,
+             'adj_noun': [adj_nouns[desc_key(desc)] for desc in descriptions]}
+    for field in FIELDS:
+        ids, lengths = tokenize(tokenizer, texts[field])
+        store[field] = {'ids': ids, 'lengths': lengths}
+        log.info('%s: %d descriptions, %d tokens', field, len(lengths), len(ids))
+
+    os.makedirs(processed_dir, exist_ok=True)
+    tmp_path = store_path + '.tmp'
+    torch.save(store, tmp_path)
+    os.replace(tmp_path, store_path)
+    return store_path
+
+class TokenStore(object):
+    """
+    pre-tokenized descriptions, handed to DescriptionContextEncoder as
+    padded id tensors instead of strings
+    """
+    def __init__(self, path):
+        store = torch.load(path)
+        self.model_ids = store['model_ids']
+        self.model_index = {model_id: i for i, model_id in enumerate(self.model_ids)}
+        self.mesh_ptr = store['mesh_ptr']
+        self.pad_token_id = store['pad_token_id']
+        self.ids = {}
+        self.lengths = {}
+        self.ptr = {}
+        for field in FIELDS:
+            self.ids[field] = store[field]['ids']
+            self.lengths[field] = store[field]['lengths'].long()
+            self.ptr[field] = torch.cumsum(self.lengths[field], dim=0) - self.lengths[field]
+
+    def __len__(self):
+        return len(self.model_ids)
+
+    def share_memory(self):
+        """
+        moves the store into shared memory, so that DataLoader workers
+        read it instead of each holding a copy
+        """
+        self.mesh_ptr.share_memory_()
+        for field in FIELDS:
+            self.ids[field].share_memory_()
+            self.lengths[field].share_memory_()
+            self.ptr[field].share_memory_()
+        return self
+
+    def sample(self, model_ids, k, generator=None):
+        """
+        indices of k descriptions drawn with replacement for each of model_ids,
+        grouped by model like random.choices(descs, k=k) for each mesh
+        """
+        meshes = torch.tensor([self.model_index[model_id] for model_id in model_ids], dtype=torch.int64)
+        counts = self.mesh_ptr[meshes + 1] - self.mesh_ptr[meshes]
+        choices = (torch.rand(len(meshes), k, generator=generator) * counts.unsqueeze(1)).long()
+        return (self.mesh_ptr[meshes].unsqueeze(1) + choices).flatten()
+
+    def gather(self, desc_indices, device=None):
+        """
+        Returns
+        -------
+        tokens: dict
+            'full_desc' and 'adj_noun' token ids of desc_indices, each
+            (n_descs x longest description) padded with pad_token_id
+        """
+        tokens = {}
+        for field in FIELDS:
+            lengths = self.lengths[field][desc_indices]
+            max_length = int(lengths.max()) if len(lengths) > 0 else 0
+            positions = torch.arange(max_length)
+            mask = positions.unsqueeze(0) < lengths.unsqueeze(1)
+            flat = (self.ptr[field][desc_indices].unsqueeze(1) + positions.unsqueeze(0))[mask]
+            padded = torch.full((len(lengths), max_length), self.pad_token_id, dtype=torch.int64)
+            padded[mask] = self.ids[field][flat].long()
+            tokens[field] = padded if device is None else padded.to(device, non_blocking=True)
+        return tokens
+
+    def sample_tokens(self, model_ids, k, generator=None, device=None):
+        return self.gather(self.sample(model_ids, k, generator), device)
+
+if __name__ == "__main__":
+    argp = ArgumentParser()
+    argp.add_argument('--root',
+        help='dataset root containing annotations.json', default='dataset')
+    args = argp.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store_path = build_token_store(args.root, os.path.join(args.root, 'processed'))
+    print(len(TokenStore(store_path)), 'models in', store_path)
@@ -1,14 +1,16 @@
 import torch
 from torch import nn
 from torch import optim
-from dataset_pyg import AnnotatedMeshDataset
+from dataset_pyg import AnnotatedMeshDataset, LazyAnnotatedMeshDataset, load_split
 from torch_geometric.data import Data
 from torch_geometric.loader import DataLoader
 from models import MeshEncoder, DescriptionContextEncoder, HierarchicalMeshEncoder, DescriptionEncoder
 from loss import ContrastiveLoss
-from grad_cache import GradCache
+from token_store import TokenStore
+from loader import BudgetBatchSampler, ContrastiveDataLoader
 import random
 import os
+import time
 from argparse import ArgumentParser
 from typing import List
 from evaluate_big_embeddings import evaluate
@@ -33,38 +35,61 @@ argp.add_argument('--descs_per_mesh',
     help='number of descriptions per each mesh in a batch', type=int, default=5)
 argp.add_argument('--joint_embedding_dim',
     help='dimension of joint embedding space', type=int, default=128)
+argp.add_argument('--mesh_store',
+    help='read meshes lazily from this mesh_store.py directory instead of data.pt', default=None)
+argp.add_argument('--loss_chunk_size',
+    help='descriptions per block of logits in the loss, all at once by default', type=int, default=None)
+argp.add_argument('--max_nodes',
+    help='pack sub-batches of up to sub_batch_size meshes with at most this many vertices', type=int, default=None)
+argp.add_argument('--max_edges',
+    help='pack sub-batches of up to sub_batch_size meshes with at most this many edges', type=int, default=None)
+argp.add_argument('--buckets',
+    help='with --max_nodes/--max_edges, only batch meshes of similar size, sorted into this many buckets', type=int, default=1)
+argp.add_argument('--shuffle',
+    help='shuffle the training set every epoch', action='store_true')
+argp.add_argument('--num_workers',
+    help='processes sampling descriptions and collating sub-batches, 0 to do it in the training loop', type=int, default=0)
+argp.add_argument('--prefetch_factor',
+    help='sub-batches each worker keeps ready', type=int, default=2)
+argp.add_argument('--share',
+    help='map data.pt (mmap) or a copy of it in /dev/shm (shm) instead of reading it into every process. the shm copy stays until python dataset_pyg.py --release_shared', choices=['mmap', 'shm'], default=None)
 args = argp.parse_args()
 
 if not os.path.isdir(args.name):
     os.mkdir(args.name)
 # dataset setup
 
-train_set = torch.load(os.path.join('dataset', 'processed', 'train_set.pt'))
-train_dataloader = DataLoader(train_set, batch_size=args.sub_batch_size, shuffle=False)
-
-val_set = torch.load(os.path.join('dataset', 'processed', 'val_set.pt'))
+if args.mesh_store is None:
+    dataset = AnnotatedMeshDataset('dataset', share=args.share)
+else:
+    dataset = LazyAnnotatedMeshDataset('dataset', args.mesh_store)
+# splits written by make_data_sets.py, as views over dataset
+train_set = load_split(dataset, 'train')
+# descriptions tokenized by preprocess.py
+tokens = TokenStore(os.path.join('dataset', 'processed', 'tokens.pt'))
 
 device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
 
+# sub-batches come with their sampled descriptions, drawn in the loader workers
+loader_args = dict(num_workers=args.num_workers, prefetch_factor=args.prefetch_factor, pin_memory=device != 'cpu')
+if args.max_nodes is not None or args.max_edges is not None:
+    sampler = BudgetBatchSampler(train_set.graph_sizes(), args.max_nodes, args.max_edges, args.sub_batch_size,
+                                 num_buckets=args.buckets, shuffle=args.shuffle)
+    train_dataloader = ContrastiveDataLoader(train_set, tokens, args.descs_per_mesh, batch_sampler=sampler, **loader_args)
+else:
+    sampler = None
+    train_dataloader = ContrastiveDataLoader(train_set, tokens, args.descs_per_mesh, batch_size=args.sub_batch_size,
+                                             shuffle=args.shuffle, **loader_args)
+
+val_set = load_split(dataset, 'val')
+
 # init models
 desc_encoder = DescriptionContextEncoder(args.joint_embedding_dim, args.adj_noun).to(device)
 
 # 6 is input dim because we have 3 for vertex positions and 3 for vertex colors
 mesh_encoder = MeshEncoder(6, args.joint_embedding_dim).to(device)
 
-contrastive_loss = ContrastiveLoss().to(device)
-
-cross_entropy = nn.CrossEntropyLoss()
-
-def split_inputs(model_input, chunk_size):
-    return model_input
-
-# gradient caching
-gc = GradCache(models=[desc_encoder, mesh_encoder],
-               chunk_sizes=[args.sub_batch_size * args.descs_per_mesh,
-                               args.sub_batch_size],
-               loss_fn=contrastive_loss,
-               split_input_fn=split_inputs)
+contrastive_loss = ContrastiveLoss(args.loss_chunk_size).to(device)
 
 desc_encoder.train()
 mesh_encoder.train()
@@ -78,59 +103,47 @@ optimizer = optim.Adam(parameters, lr=1e-2,betas=(0.9,0.98),eps=1e-6,weight_deca
 losses = []
 train_accs = []
 val_accs = []
+data_waits = []
 
 for epoch in range(args.epoch):
     print('starting epoch', epoch)
+    if sampler is not None:
+        sampler.set_epoch(epoch)
 
     desc_encoder.train()
     mesh_encoder.train()
     contrastive_loss.train()
 
-    for i_batch, batch in enumerate(train_dataloader):
-        batch.to(device)
+    data_start = time.perf_counter()
+    for i_batch, (batch, sampled_descs) in enumerate(train_dataloader):
+        # time spent waiting for the loader rather than computing
+        data_wait = time.perf_counter() - data_start
+        batch.to(device, non_blocking=True)
+        sampled_descs = {field: ids.to(device, non_blocking=True) for field, ids in sampled_descs.items()}
 
         optimizer.zero_grad()
 
-        batch_descs, batch_meshes = [sub_batch.descs for sub_batch in batch], batch
-        sampled_descs = [[random.choices(descs, k=args.descs_per_mesh) for descs in sub_batch_descs]
-                            for sub_batch_descs in batch_descs]
+        batch_meshes = batch
 
-        # loss = gc(sampled_descs, batch_meshes) # GradCache takes care of backprop
-        desc_embeddings = desc_encoder(batch_descs)
+        desc_embeddings = desc_encoder(sampled_descs)
         mesh_embeddings = mesh_encoder(batch_meshes)
-        n_desc = desc_embeddings.shape[0]
-        n_mesh = mesh_embeddings.shape[0]
-        descs_per_mesh = n_desc // n_mesh
-
-        # predicted logits
-        logits_per_mesh = mesh_embeddings @ desc_embeddings.T
-        logits_per_desc = logits_per_mesh.T
-
-        # target distributions
-        targets_per_desc = torch.zeros(n_desc, n_mesh).to(desc_embeddings.device)
-        # one-hot distribution for single matching mesh
-        targets_per_desc[torch.arange(n_desc), 
-                         torch.arange(n_mesh).repeat_interleave(descs_per_mesh)] = 1
-        targets_per_mesh = torch.zeros(n_mesh, n_desc).to(mesh_embeddings.device)
-        # uniform distribution over matching descs
-        targets_per_mesh[torch.arange(n_mesh).unsqueeze(dim=1), 
-                         torch.arange(n_desc).reshape(n_desc // descs_per_mesh, descs_per_mesh)] = 1 / descs_per_mesh
-
-        desc_loss = cross_entropy(logits_per_desc, targets_per_desc)
-        mesh_loss = cross_entropy(logits_per_mesh, targets_per_mesh)
-        loss = (desc_loss + mesh_loss) / 2
+        loss = contrastive_loss(desc_embeddings, mesh_embeddings)
+        loss.backward()
         optimizer.step()
 
         loss.detach().cpu()
 
-        print("batch " + str(i_batch) + ": " + str(loss.item()))
+        print("batch " + str(i_batch) + ": " + str(loss.item()) + ", data wait {:.3f}s".format(data_wait))
         average_loss = loss / (len(batch) * args.sub_batch_size)
         losses.append(average_loss)
+        data_waits.append(data_wait)
         torch.save(losses, os.path.join(args.name, args.name + "_loss.pt"))
+        torch.save(data_waits, os.path.join(args.name, args.name + "_data_wait.pt"))
 
         #print(torch.cuda.memory_summary())
+        data_start = time.perf_counter()
 
-    epoch_acc = evaluate(train_set[:len(val_set)], desc_encoder, mesh_encoder, args.descs_per_mesh, device="cuda:0")
+    epoch_acc = evaluate(train_set[:len(val_set)], desc_encoder, mesh_encoder, args.descs_per_mesh, device=device, tokens=tokens)
     print('training accuracy:', epoch_acc)
     train_accs.append(epoch_acc)
     
@@ -145,7 +158,7 @@ for epoch in range(args.epoch):
 print("done!")
 
 print('final evaluation')
-val_acc = evaluate(val_set, desc_encoder, mesh_encoder, args.descs_per_mesh, device="cuda:0")
+val_acc = evaluate(val_set, desc_encoder, mesh_encoder, args.descs_per_mesh, device=device, tokens=tokens)
 torch.save(val_acc, os.path.join(args.name, args.name + '_val_acc.pt'))
 
 
@@ -1,14 +1,20 @@
 import torch
 from torch import nn
 from torch import optim
-from dataset_pyg import AnnotatedMeshDataset
+from dataset_pyg import AnnotatedMeshDataset, LazyAnnotatedMeshDataset, load_split
 from torch_geometric.data import Data
 from torch_geometric.loader import DataLoader
 from models import MeshEncoder, DescriptionContextEncoder, AdvancedMeshEncoder, DescriptionEncoder
 from loss import ContrastiveLoss
-from grad_cache import GradCache
+from token_store import TokenStore
+from loader import BudgetBatchSampler, ContrastiveDataLoader
+from gradient_cache import GradientCache
+from distributed import init_distributed, GlobalContrastiveLoss, all_reduce_grads, broadcast_parameters
+from torch.utils.data import DistributedSampler
+import torch.distributed as dist
 import random
 import os
+import time
 from argparse import ArgumentParser
 from typing import List
 from evaluate_big_embeddings import evaluate
@@ -33,18 +39,66 @@ argp.add_argument('--descs_per_mesh',
 	help='number of descriptions per each mesh in a batch', type=int, default=5)
 argp.add_argument('--joint_embedding_dim',
 	help='dimension of joint embedding space', type=int, default=128)
+argp.add_argument('--mesh_store',
+	help='read meshes lazily from this mesh_store.py directory instead of data.pt', default=None)
+argp.add_argument('--loss_chunk_size',
+	help='descriptions per block of logits in the loss, all at once by default', type=int, default=None)
+argp.add_argument('--max_nodes',
+	help='pack sub-batches of up to sub_batch_size meshes with at most this many vertices', type=int, default=None)
+argp.add_argument('--max_edges',
+	help='pack sub-batches of up to sub_batch_size meshes with at most this many edges', type=int, default=None)
+argp.add_argument('--buckets',
+	help='with --max_nodes/--max_edges, only batch meshes of similar size, sorted into this many buckets', type=int, default=1)
+argp.add_argument('--shuffle',
+	help='shuffle the training set every epoch', action='store_true')
+argp.add_argument('--num_workers',
+	help='processes sampling descriptions and collating sub-batches, 0 to do it in the training loop', type=int, default=0)
+argp.add_argument('--prefetch_factor',
+	help='sub-batches each worker keeps ready', type=int, default=2)
+argp.add_argument('--share',
+	help='map data.pt (mmap) or a copy of it in /dev/shm (shm) instead of reading it into every process. the shm copy stays until python dataset_pyg.py --release_shared', choices=['mmap', 'shm'], default=None)
+argp.add_argument('--distributed',
+	help='run as one of the processes started by torchrun, contrasting against the batches of all of them', action='store_true')
+argp.add_argument('--threads',
+	help='intra-op threads per process, by default the cores of the host split between its processes', type=int, default=None)
 args = argp.parse_args()
 
-if not os.path.isdir(args.name):
-	os.mkdir(args.name)
-# dataset setup
+device = 'cuda:' + os.environ.get('LOCAL_RANK', '0') if torch.cuda.is_available() else 'cpu'
 
-train_set = torch.load(os.path.join('dataset', 'processed', 'train_set.pt'))
-train_dataloader = DataLoader(train_set, batch_size=args.sub_batch_size, shuffle=False)
+# every rank takes batch_size // world_size meshes of each batch. gloo cannot
+# communicate cuda tensors, so gpu ranks use nccl
+if args.distributed:
+	rank, world_size = init_distributed('nccl' if device != 'cpu' else 'gloo', args.threads)
+else:
+	rank, world_size = 0, 1
+	if args.threads is not None:
+		torch.set_num_threads(args.threads)
 
-val_set = torch.load(os.path.join('dataset', 'processed', 'val_set.pt'))
+os.makedirs(args.name, exist_ok=True)
+# dataset setup
 
-device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+if args.mesh_store is None:
+	dataset = AnnotatedMeshDataset('dataset', share=args.share)
+else:
+	dataset = LazyAnnotatedMeshDataset('dataset', args.mesh_store)
+# splits written by make_data_sets.py, as views over dataset
+train_set = load_split(dataset, 'train')
+# descriptions tokenized by preprocess.py
+tokens = TokenStore(os.path.join('dataset', 'processed', 'tokens.pt'))
+
+# sub-batches come with their sampled descriptions, drawn in the loader workers
+loader_args = dict(num_workers=args.num_workers, prefetch_factor=args.prefetch_factor, pin_memory=device != 'cpu')
+if args.max_nodes is not None or args.max_edges is not None:
+	# ranks get as many sub-batches each, so they stay in step
+	sampler = BudgetBatchSampler(train_set.graph_sizes(), args.max_nodes, args.max_edges, args.sub_batch_size,
+								 num_buckets=args.buckets, shuffle=args.shuffle, num_replicas=world_size, rank=rank)
+	train_dataloader = ContrastiveDataLoader(train_set, tokens, args.descs_per_mesh, batch_sampler=sampler, **loader_args)
+else:
+	sampler = DistributedSampler(train_set, num_replicas=world_size, rank=rank, shuffle=args.shuffle) if args.distributed else None
+	train_dataloader = ContrastiveDataLoader(train_set, tokens, args.descs_per_mesh, batch_size=args.sub_batch_size,
+											 shuffle=args.shuffle and sampler is None, sampler=sampler, **loader_args)
+
+val_set = load_split(dataset, 'val')
 
 # init models
 desc_encoder = DescriptionContextEncoder(args.joint_embedding_dim, args.adj_noun).to(device)
@@ -52,17 +106,17 @@ desc_encoder = DescriptionContextEncoder(args.joint_embedding_dim, args.adj_noun
 # 6 is input dim because we have 3 for vertex positions and 3 for vertex colors
 mesh_encoder = AdvancedMeshEncoder(6, args.joint_embedding_dim).to(device)
 
-contrastive_loss = ContrastiveLoss().to(device)
+contrastive_loss = ContrastiveLoss(args.loss_chunk_size).to(device)
 
-def split_inputs(model_input, chunk_size):
-	return model_input
+# gradient caching, one chunk per sub-batch
+gc = GradientCache(models=[desc_encoder, mesh_encoder],
+				   chunk_sizes=[args.sub_batch_size * args.descs_per_mesh,
+								args.sub_batch_size],
+				   loss_fn=GlobalContrastiveLoss(contrastive_loss) if args.distributed else contrastive_loss)
 
-# gradient caching
-gc = GradCache(models=[desc_encoder, mesh_encoder],
-			   chunk_sizes=[args.sub_batch_size * args.descs_per_mesh,
-			   				args.sub_batch_size],
-			   loss_fn=contrastive_loss,
-			   split_input_fn=split_inputs)
+if args.distributed:
+	# every rank starts from the weights of rank 0
+	broadcast_parameters(list(desc_encoder.parameters()) + list(mesh_encoder.parameters()))
 
 desc_encoder.train()
 mesh_encoder.train()
@@ -76,60 +130,84 @@ optimizer = optim.Adam(parameters, lr=1e-2,betas=(0.9,0.98),eps=1e-6,weight_deca
 losses = []
 train_accs = []
 val_accs = []
+data_waits = []
 
 for epoch in range(args.epoch):
 	print('starting epoch', epoch)
+	if sampler is not None:
+		sampler.set_epoch(epoch)
 
 	desc_encoder.train()
 	mesh_encoder.train()
 	contrastive_loss.train()
 
 	batch = []
+	sampled_descs = []
 	i_batch = 0
-	for sub_batch in train_dataloader:
-		sub_batch.to(device)
+	# time spent waiting for the loader rather than computing, over the sub-batches of a step
+	data_wait = 0.
+	data_start = time.perf_counter()
+	for sub_batch, descs in train_dataloader:
+		data_wait += time.perf_counter() - data_start
+		sub_batch.to(device, non_blocking=True)
 		batch.append(sub_batch)
+		sampled_descs.append({field: ids.to(device, non_blocking=True) for field, ids in descs.items()})
 
-		if len(batch) >= args.batch_size // args.sub_batch_size:
+		if len(batch) >= args.batch_size // (args.sub_batch_size * world_size):
 			optimizer.zero_grad()
 
-			batch_descs, batch_meshes = [sub_batch.descs for sub_batch in batch], batch
-			sampled_descs = [[random.choices(descs, k=args.descs_per_mesh) for descs in sub_batch_descs]
-							 for sub_batch_descs in batch_descs]
-							 
-			loss = gc(sampled_descs, batch_meshes) # GradCache takes care of backprop
+			batch_meshes = batch
+
+			loss = gc(sampled_descs, batch_meshes) # GradientCache takes care of backprop
+			if args.distributed:
+				# every rank computed the same loss, and so the same logit_scale gradient
+				all_reduce_grads(list(desc_encoder.parameters()) + list(mesh_encoder.parameters()))
 			optimizer.step()
 
 			loss.detach().cpu()
 
-			print("batch " + str(i_batch) + ": " + str(loss.item()))
-			average_loss = loss / (len(batch) * args.sub_batch_size)
-			losses.append(average_loss)
-			torch.save(losses, os.path.join(args.name, args.name + "_loss.pt"))
+			if rank == 0:
+				print("batch " + str(i_batch) + ": " + str(loss.item()) + ", data wait {:.3f}s".format(data_wait))
+				average_loss = loss / (sum(sub_batch.num_graphs for sub_batch in batch) * world_size)
+				losses.append(average_loss)
+				data_waits.append(data_wait)
+				torch.save(losses, os.path.join(args.name, args.name + "_loss.pt"))
+				torch.save(data_waits, os.path.join(args.name, args.name + "_data_wait.pt"))
 
 			#print(torch.cuda.memory_summary())
 
 
 			i_batch += 1
 			batch = []
-
-	epoch_acc = evaluate(train_set[:len(val_set)], desc_encoder, mesh_encoder, args.descs_per_mesh, device="cuda:0")
-	print('training accuracy:', epoch_acc)
-	train_accs.append(epoch_acc)
+			sampled_descs = []
+			data_wait = 0.
+		data_start = time.perf_counter()
+
+	# the other ranks wait for rank 0 to evaluate and save
+	if rank == 0:
+		epoch_acc = evaluate(train_set[:len(val_set)], desc_encoder, mesh_encoder, args.descs_per_mesh, device=device, tokens=tokens)
+		print('training accuracy:', epoch_acc)
+		train_accs.append(epoch_acc)
 	
-	torch.save(desc_encoder.state_dict(), os.path.join(args.name, args.name + "_desc_parameters.pt"))
-	torch.save(mesh_encoder.state_dict(),os.path.join(args.name, args.name + "_mesh_parameters.pt"))
-	torch.save(contrastive_loss.state_dict(), os.path.join(args.name, args.name + "_loss_parameters.pt"))
+		torch.save(desc_encoder.state_dict(), os.path.join(args.name, args.name + "_desc_parameters.pt"))
+		torch.save(mesh_encoder.state_dict(),os.path.join(args.name, args.name + "_mesh_parameters.pt"))
+		torch.save(contrastive_loss.state_dict(), os.path.join(args.name, args.name + "_loss_parameters.pt"))
 
-	torch.save(losses, os.path.join(args.name, args.name + "_loss.pt"))
-	torch.save(train_accs, os.path.join(args.name, args.name + "_train_accs.pt"))
+		torch.save(losses, os.path.join(args.name, args.name + "_loss.pt"))
+		torch.save(train_accs, os.path.join(args.name, args.name + "_train_accs.pt"))
+	if args.distributed:
+		dist.barrier()
 
 
 print("done!")
 
-print('final evaluation')
-val_acc = evaluate(val_set, desc_encoder, mesh_encoder, args.descs_per_mesh, device="cuda:0")
-torch.save(val_acc, os.path.join(args.name, args.name + '_val_acc.pt'))
+if rank == 0:
+	print('final evaluation')
+	val_acc = evaluate(val_set, desc_encoder, mesh_encoder, args.descs_per_mesh, device=device, tokens=tokens)
+	torch.save(val_acc, os.path.join(args.name, args.name + '_val_acc.pt'))
+if args.distributed:
+	dist.destroy_process_group()
+
 
 
 
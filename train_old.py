@@ -2,7 +2,7 @@
 import torch
 from torch import nn
 from torch import optim
-from dataset_pyg import AnnotatedMeshDataset
+from dataset_pyg import AnnotatedMeshDataset, load_split
 from torch_geometric.loader import DataLoader
 from models import CLIP_pretrained, SimpleMeshEncoder
 from torch.utils.tensorboard import SummaryWriter
@@ -37,7 +37,7 @@ dataset = AnnotatedMeshDataset(dataset_root)
 # val_dataset = dataset[train_share: train_share + val_share]
 # test_dataset = dataset[train_share + val_share: ]
 
-train_dataloader = DataLoader(torch.load("dataset/processed/train_set.pt"), batch_size=BATCH_SIZE, shuffle=False)
+train_dataloader = DataLoader(load_split(dataset, 'train'), batch_size=BATCH_SIZE, shuffle=False)
 
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
 
@@ -6,6 +6,10 @@ import torch.optim as optim
 from torch.autograd import Variable
 import sys
 import os
+import re
+import mmap
+import weakref
+from collections import OrderedDict
 import torch
 from glob import glob
 import scipy.io as sio
@@ -27,17 +31,15 @@ preprocess = transforms.Compose([
    transforms.ToTensor()
 ])
 
-# from chamfer_distance import ChamferDistance
-# chamfer_dist = ChamferDistance()
+# pairwise distances chamfer_dist holds in memory at once, in bytes
+CHAMFER_MEMORY_BUDGET = 2**28
 
-# from tri_distance import TriDistance
-# tri_dist = TriDistance()
 
 
 
 
 # loads the initial mesh and stores vertex, face, and adjacency matrix information
-def load_initial( obj='386.obj'):
+def load_initial( obj='386.obj', sparse=False):
 	# load obj file
 	obj = ObjLoader(obj)
 	labels = np.array(obj.vertices)
@@ -45,59 +47,115 @@ def load_initial( obj='386.obj'):
 	faces = torch.LongTensor(np.array(obj.faces) -1)
 
 	# get adjacency matrix infomation
-	adj_info = adj_init(faces)
-	edge_index = (adj_info['adj_orig'] > 0).nonzero().T
+	adj_info = adj_init(faces, sparse=sparse)
+	if sparse:
+		edge_index = adj_info['adj_orig'].indices()
+	else:
+		edge_index = (adj_info['adj_orig'] > 0).nonzero().T
 
 	return adj_info, edge_index, features
 
 
 
+class ObjFormatError(ValueError):
+	pass
+
+_OBJ_VERTEX = re.compile(rb'^v[ \t]+(\S+[ \t]+\S+[ \t]+\S+)', re.M)
+_OBJ_FACE = re.compile(rb'^f[ \t]+([^\n]*)', re.M)
+_OBJ_INDEX_SUFFIX = re.compile(rb'/\S*')
+
+# the whitespace separated numbers of buf, any malformed one reported as an ObjFormatError
+def _obj_numbers(buf, dtype, fileName, records):
+	try:
+		return np.array(buf.split(), dtype=dtype)
+	except ValueError as e:
+		raise ObjFormatError(f'{fileName}: malformed {records} records ({e})') from e
+
+# reads the v and f records of an .obj file into numpy arrays in one pass
+# faces may use any of the v, v/vt, v//vn, v/vt/vn index forms, and faces
+# with more than three vertices are fan triangulated
+def read_obj(fileName, use_mmap=False):
+	with open(fileName, 'rb') as f:
+		if use_mmap and os.fstat(f.fileno()).st_size > 0:
+			buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			buf = f.read()
+
+	# vertices: keep x y z of every v record and parse them all at once
+	vertex_records = _OBJ_VERTEX.findall(buf)
+	vertices = _obj_numbers(b' '.join(vertex_records), np.float64, fileName, 'vertex')
+	if len(vertex_records) == 0 or vertices.shape[0] != 3 * len(vertex_records):
+		raise ObjFormatError(f'{fileName}: missing or malformed vertex records')
+	vertices = vertices.reshape(-1, 3)
+
+	# faces: drop the /vt/vn part of each index, then count the indices per record
+	face_records = _OBJ_FACE.findall(buf)
+	if len(face_records) == 0:
+		return vertices, np.zeros((0, 3), dtype=np.int64)
+	flat = _OBJ_INDEX_SUFFIX.sub(b'', b'\n'.join(face_records))
+	chars = np.frombuffer(flat, dtype=np.uint8)
+	is_newline = chars == ord('\n')
+	is_index = ~(is_newline | (chars == ord(' ')) | (chars == ord('\t')) | (chars == ord('\r')))
+	index_starts = is_index & ~np.concatenate(([False], is_index[:-1]))
+	counts = np.bincount(np.cumsum(is_newline)[index_starts], minlength=len(face_records))
+	indices = _obj_numbers(flat, np.int64, fileName, 'face')
+	if indices.shape[0] != counts.sum() or counts.min() < 3:
+		raise ObjFormatError(f'{fileName}: malformed face records')
+
+	if (indices < 0).any():
+		# negative indices count back from the last vertex defined before the face
+		vertex_starts = [m.start() for m in _OBJ_VERTEX.finditer(buf)]
+		face_starts = [m.start() for m in _OBJ_FACE.finditer(buf)]
+		defined = np.searchsorted(vertex_starts, face_starts)
+		defined = np.repeat(defined, counts)
+		indices = np.where(indices < 0, indices + defined + 1, indices)
+	indices = indices - 1
+
+	# fan triangulation: polygon (v0, v1, ..., vk) -> (v0, vi, vi+1)
+	n_tris = counts - 2
+	first = np.repeat(np.cumsum(counts) - counts, n_tris)
+	local = np.arange(n_tris.sum()) - np.repeat(np.cumsum(n_tris) - n_tris, n_tris)
+	faces = np.stack((indices[first], indices[first + local + 1], indices[first + local + 2]), axis=1)
+	if faces.min() < 0 or faces.max() >= vertices.shape[0]:
+		raise ObjFormatError(f'{fileName}: face index out of range')
+	return vertices, faces
+
+
 # loads object file
 # involves identifying face and vertex infomation in .obj file
-# needs to be triangulated to work
+# faces keep the 1-based indices and reversed winding of the original loader
 class ObjLoader(object):
-	def __init__(self, fileName):
-		self.vertices = []
-		self.faces = []
-		##
-		try:
-			f = open(fileName)
-			for line in f:
-				line = line.replace('//','/')
-				if line[:2] == "v ":
-					index1 = line.find(" ") + 1
-					index2 = line.find(" ", index1 + 1)
-					index3 = line.find(" ", index2 + 1)
-					vertex = (float(line[index1:index2]), float(line[index2:index3]), float(line[index3:-1]))
-					self.vertices.append(vertex)
-
-				elif line[0] == "f":
-					string = line.split(' ')
-					string = string[1:]
-					string.reverse()
-					face = [int(s.split('/')[0]) for s in string]
-
-					self.faces.append(face)
-			f.close()
-		except IOError:
-			print(".obj file not found.")
-			exit()
+	def __init__(self, fileName, use_mmap=False):
+		vertices, faces = read_obj(fileName, use_mmap)
+		self.vertices = vertices
+		self.faces = faces[:, ::-1] + 1
 
 
 
 
 # normalizes symetric, binary adj matrix such that sum of each row is 1
 def normalize_adj(mx):
+	if mx.is_sparse:
+		mx = mx.coalesce()
+		rowsum = torch.zeros(mx.shape[0], device=mx.device).index_add_(0, mx.indices()[0], mx.values())
+		r_inv = 1./rowsum
+		r_inv[r_inv != r_inv] = 0.
+		values = mx.values() * r_inv[mx.indices()[0]]
+		return torch.sparse_coo_tensor(mx.indices(), values, mx.shape, is_coalesced=True, check_invariants=False)
 	rowsum = mx.sum(1)
 	r_inv = (1./rowsum).view(-1)
 	r_inv[r_inv != r_inv] = 0.
 	mx = torch.mm(torch.eye(r_inv.shape[0]).to(mx.device)*r_inv, mx)
 	return mx
 
-def adj_init(faces):
-	adj = calc_adj(faces)
-	adj_orig = adj.clone()
-	adj = normalize_adj(adj)
+def adj_init(faces, sparse=False):
+	if sparse:
+		adj_orig = sparse_adj(faces)
+		adj = sparse_adj(faces, normalize=True)
+	else:
+		adj = calc_adj(faces)
+		adj_orig = adj.clone()
+		adj = normalize_adj(adj)
 	adj_info = {}
 
 	adj_info['adj'] = adj
@@ -105,7 +163,9 @@ def adj_init(faces):
 	adj_info['faces'] = faces
 	return adj_info
 
-def calc_adj(faces):
+def calc_adj(faces, sparse=False):
+	if sparse:
+		return sparse_adj(faces)
 	v1 = faces[:, 0]
 	v2 = faces[:, 1]
 	v3 = faces[:, 2]
@@ -123,12 +183,66 @@ def calc_adj(faces):
 
 	return adj
 
+# builds the same adjacency as calc_adj (and normalize_adj if normalize) as a sparse
+# tensor in O(F), without ever allocating a num_verts x num_verts matrix
+def sparse_adj(faces, num_verts=None, self_loops=True, normalize=False, layout=torch.sparse_coo):
+	faces = faces.long()
+	if num_verts is None:
+		num_verts = int(faces.max()) + 1
+	rows = faces[:, [0, 0, 1, 1, 2, 2]].reshape(-1)
+	cols = faces[:, [1, 2, 0, 2, 0, 1]].reshape(-1)
+	if self_loops:
+		loops = torch.arange(num_verts, device=faces.device)
+		rows = torch.cat((rows, loops))
+		cols = torch.cat((cols, loops))
+
+	# edges shared by two faces collapse into one entry, sorted row-major
+	keys = torch.unique(rows * num_verts + cols)
+	rows = keys // num_verts
+	cols = keys % num_verts
+	values = torch.ones(keys.shape[0], device=faces.device)
+	if normalize:
+		degrees = torch.bincount(rows, minlength=num_verts).float()
+		values = values / degrees[rows]
+
+	adj = torch.sparse_coo_tensor(torch.stack((rows, cols)), values, (num_verts, num_verts),
+		is_coalesced=True, check_invariants=False)
+	if layout == torch.sparse_csr:
+		adj = adj.to_sparse_csr()
+	return adj
+
+# concatenates the sparse normalized adjacencies of a batch of meshes (as built by
+# adj_init(faces, sparse=True)) into one edge list, with batch giving the mesh of every
+# vertex, as taken by models.SparseMeshEncoder
+def batch_edge_list(adjs, num_verts):
+	edge_indices, edge_weights, batch = [], [], []
+	offset = 0
+	for i, (adj, mesh_verts) in enumerate(zip(adjs, num_verts)):
+		adj = adj.coalesce()
+		edge_indices.append(adj.indices() + offset)
+		edge_weights.append(adj.values())
+		batch.append(torch.full((mesh_verts,), i, dtype=torch.long, device=adj.device))
+		offset += mesh_verts
+	return torch.cat(edge_indices, dim=1), torch.cat(edge_weights), torch.cat(batch)
+
+# adj @ x for a dense or sparse (N x N) adj and x of shape (N x C) or (B x N x C)
+def adj_matmul(adj, x):
+	if adj.layout == torch.strided:
+		return torch.matmul(adj, x)
+	if x.dim() == 2:
+		return adj @ x
+	batch_size, num_verts, channels = x.shape
+	x = x.transpose(0, 1).reshape(num_verts, batch_size * channels)
+	return (adj @ x).reshape(num_verts, batch_size, channels).transpose(0, 1)
+
 
 # loader for GEOMetrics
 class Mesh_loader(object):
-	def __init__(self, Img_location, Mesh_loction, Sample_location, set_type='train', num= 23, sample_num= 3000):
+	def __init__(self, Img_location, Mesh_loction, Sample_location, set_type='train', num= 23, sample_num= 3000, cache_location=None):
 
 		# initialization of data locations
+		# cache_location: arrays written by convert_geometrics.py, read instead of the .mat, .png and .txt files
+		self.cache_location = cache_location
 		self.Mesh_loction = Mesh_loction
 		self.Img_location = Img_location
 		if '*' in self.Img_location:
@@ -169,9 +283,14 @@ class Mesh_loader(object):
 
 
 		# load sampled ground truth points
-		samples = sio.loadmat(self.Sample_location + obj_class + '/' + obj )['points']
-		np.random.shuffle(samples)
-		data['samples'] = torch.FloatTensor(samples[:self.sample_num])
+		if self.cache_location is not None:
+			cache = self.cache_location + obj_class + '/' + obj + '/'
+			samples = np.load(cache + 'samples.npy', mmap_mode='r')
+		else:
+			samples = sio.loadmat(self.Sample_location + obj_class + '/' + obj )['points']
+		# random subset drawn as indices, so the samples are never shuffled in place
+		choice = np.random.permutation(samples.shape[0])[:self.sample_num]
+		data['samples'] = torch.FloatTensor(samples[choice])
 
 		#load images
 
@@ -179,9 +298,14 @@ class Mesh_loader(object):
 
 		str_num  = str(num).zfill(2)
 
-		img = (Image.open(self.Img_location + obj_class + '/' + self.set_type + '/' + obj +  '/rendering/' + str_num + '.png'))
-		img = preprocess(img)
-		img_info = np.genfromtxt(self.Img_location + obj_class + '/' + self.set_type + '/' + obj + '/rendering/rendering_metadata.txt', delimiter=' ')[num]
+		if self.cache_location is not None:
+			# already resized, only scaled to [0, 1] the way ToTensor does
+			img = torch.from_numpy(np.load(cache + 'images.npy', mmap_mode='r')[num].transpose(2, 0, 1).copy()).float() / 255.
+			img_info = np.load(cache + 'metadata.npy', mmap_mode='r')[num]
+		else:
+			img = (Image.open(self.Img_location + obj_class + '/' + self.set_type + '/' + obj +  '/rendering/' + str_num + '.png'))
+			img = preprocess(img)
+			img_info = np.genfromtxt(self.Img_location + obj_class + '/' + self.set_type + '/' + obj + '/rendering/rendering_metadata.txt', delimiter=' ')[num]
 		img_info = [img_info[0] , img_info[1], img_info[3]]
 
 		data['imgs'] = torch.FloatTensor(img)
@@ -208,8 +332,12 @@ class Mesh_loader(object):
 
 # loader to Auto-Encoder
 class Voxel_loader(object):
-	def __init__(self, Img_location, Mesh_loction, Voxel_location,  set_type='train'):
+	def __init__(self, Img_location, Mesh_loction, Voxel_location,  set_type='train', sparse=False, cache_location=None):
 
+		# sparse: build the normalized adjacency as a sparse tensor
+		self.sparse = sparse
+		# cache_location: arrays written by convert_geometrics.py, read instead of the .mat files
+		self.cache_location = cache_location
 		self.Voxel_location = Voxel_location
 		self.Mesh_loction = Mesh_loction
 		self.Img_location = Img_location
@@ -235,6 +363,23 @@ class Voxel_loader(object):
 		obj, obj_class = self.names[index]
 		data['names'] = obj
 
+		if self.cache_location is not None:
+			cache = self.cache_location + obj_class + '/' + obj + '/'
+			# voxel grids are cubic, bit-packed along the last axis
+			packed = np.load(cache + 'voxels.npy', mmap_mode='r')
+			data['voxels'] = torch.FloatTensor(np.unpackbits(packed, axis=-1, count=packed.shape[-2]))
+			verts = torch.from_numpy(np.load(cache + 'verts.npy'))
+			faces = torch.from_numpy(np.load(cache + 'faces.npy'))
+			# the normalized adjacency, precomputed
+			adj_indices = torch.from_numpy(np.load(cache + 'adj_indices.npy'))
+			adj_values = torch.from_numpy(np.load(cache + 'adj_values.npy'))
+			num_verts = int(faces.max()) + 1
+			adj = torch.sparse_coo_tensor(adj_indices, adj_values, (num_verts, num_verts), is_coalesced=True, check_invariants=False)
+			data['verts'] = verts
+			data['faces'] = faces
+			data['adj'] = adj if self.sparse else adj.to_dense()
+			return data
+
 		#load voxels
 		voxels = sio.loadmat(self.Voxel_location + obj_class + '/' + obj )['model']
 		data['voxels'] = torch.FloatTensor(voxels)
@@ -243,8 +388,11 @@ class Voxel_loader(object):
 		mesh_info  =  sio.loadmat(self.Mesh_loction + obj_class + '/' + obj  +  '.mat')
 		verts = torch.FloatTensor(mesh_info['verts'])
 		faces = torch.LongTensor(mesh_info['faces'])
-		adj = calc_adj(faces)
-		adj = normalize_adj( torch.FloatTensor(adj))
+		if self.sparse:
+			adj = sparse_adj(faces, normalize=True)
+		else:
+			adj = calc_adj(faces)
+			adj = normalize_adj( torch.FloatTensor(adj))
 		data['verts'] = verts
 		data['faces'] = faces
 		data['adj'] = adj
@@ -289,10 +437,10 @@ def batch_camera_info(param):
 	cam_pos = torch.cat((camX.unsqueeze(1), camY.unsqueeze(1), camZ.unsqueeze(1)), dim = 1 )
 
 	axisZ = cam_pos.clone()
-	axisY = torch.FloatTensor([0,1,0]).cuda().unsqueeze(0).expand(axisZ.shape[0], 3)
+	axisY = torch.tensor([0., 1., 0.], dtype=axisZ.dtype, device=axisZ.device).unsqueeze(0).expand(axisZ.shape[0], 3)
 
-	axisX = torch.cross(axisY, axisZ)
-	axisY = torch.cross(axisZ, axisX)
+	axisX = torch.cross(axisY, axisZ, dim = 1)
+	axisY = torch.cross(axisZ, axisX, dim = 1)
 
 
 
@@ -317,15 +465,16 @@ def batched_pooling(blocks, verts_pos, img_info):
 	X = pt_trans[:,:,0]
 	Y = pt_trans[:,:,1]
 	Z = pt_trans[:,:,2]
-	F = 248
+	focal = 248
 
-	h = (-Y)/(-Z)*F + 224/2.0
-	w = X/(-Z)*F + 224/2.0
+	h = (-Y)/(-Z)*focal + 224/2.0
+	w = X/(-Z)*focal + 224/2.0
 	xs = h / 223.
 	ys = w /223.
 
-	full_features = None
-	batch_size = verts_pos.shape[0]
+	batch_size, num_verts = verts_pos.shape[0], verts_pos.shape[1]
+	full_features = torch.empty(batch_size, num_verts, sum(block.shape[1] for block in blocks), dtype=blocks[0].dtype, device=verts_pos.device)
+	channel = 0
 	for block in blocks:
 		# scale coordinated to block dimensions/resolution
 		dim = block.shape[-1]
@@ -333,56 +482,63 @@ def batched_pooling(blocks, verts_pos, img_info):
 		cur_xs = torch.clamp(xs * dim, 0, dim-1)
 		cur_ys = torch.clamp(ys * dim, 0, dim-1)
 
-		# this is basically bilinear interpolation of the 4 closest feature vectors to where the vertex lands in the block
-		# https://en.wikipedia.org/wiki/Bilinear_interpolation
-		x1s, y1s, x2s, y2s = torch.floor(cur_xs), torch.floor(cur_ys), torch.ceil(cur_xs), torch.ceil(cur_ys)
-		A = x2s -cur_xs
-		B = cur_xs-x1s
-		G = y2s-cur_ys
-		H = cur_ys-y1s
-
-		x1s = x1s.type(torch.cuda.LongTensor)
-		y1s = y1s.type(torch.cuda.LongTensor)
-		x2s = x2s.type(torch.cuda.LongTensor)
-		y2s = y2s.type(torch.cuda.LongTensor)
-
-		flat_block = block.permute(1,0,2,3).contiguous().view(block.shape[1], -1)
-		block_upper = torch.arange(0, verts_pos.shape[0]).cuda().unsqueeze(-1).expand(batch_size, verts_pos.shape[1] )
-
-		selection = ((block_upper * dim * dim) + (x1s * dim) + y1s).view(-1)
-		C = torch.index_select(flat_block, 1, selection)
-		C = C.view(-1,batch_size,verts_pos.shape[1]).permute(1,0,2)
-		selection = ((block_upper * dim * dim) + (x1s * dim) + y2s).view(-1)
-		D = torch.index_select(flat_block, 1, selection)
-		D = D .view(-1,batch_size,verts_pos.shape[1]).permute(1,0,2)
-		selection = ((block_upper * dim * dim) + (x2s * dim) + y1s).view(-1)
-		E = torch.index_select(flat_block, 1, selection)
-		E = E.view(-1,batch_size,verts_pos.shape[1]).permute(1,0,2)
-		selection = ((block_upper * dim * dim) + (x2s * dim) + y2s).view(-1)
-		F = torch.index_select(flat_block, 1, selection)
-		F = F.view(-1,batch_size,verts_pos.shape[1]).permute(1,0,2)
-
-
-		section1 = A.unsqueeze(1)*C*G.unsqueeze(1)
-		section2 = H.unsqueeze(1)*D*A.unsqueeze(1)
-		section3 = G.unsqueeze(1)*E*B.unsqueeze(1)
-		section4 = B.unsqueeze(1)*F*H.unsqueeze(1)
-
-
-		features = (section1 + section2 + section3 + section4)
-		features = features.permute(0,2,1)
-
-
-
-		if full_features is None: full_features = features
-		else: full_features = torch.cat((full_features, features), dim = 2)
-
+		# bilinear interpolation of the 4 closest feature vectors to where the vertex lands in the block.
+		# with align_corners the grid maps -1 and 1 to the centers of the first and last feature, so
+		# block coordinate c is 2c / (dim - 1) - 1. xs index the rows (grid y), ys the columns (grid x)
+		grid = torch.stack((cur_ys, cur_xs), dim = -1) * (2. / (dim - 1)) - 1
+		features = F.grid_sample(block, grid.unsqueeze(1).to(block.dtype), mode='bilinear', align_corners=True)
+		full_features[:, :, channel:channel + block.shape[1]] = features.squeeze(2).permute(0,2,1)
+		channel += block.shape[1]
 
 	return full_features
 
 
 
-def batch_point_to_point(pred_vert, adj_info, gt_points, num = 1000, f1 = False ):
+# nearest neighbours between two batches of point clouds a (B x N x 3) and b (B x M x 3),
+# as the chamfer_distance extension returned them: for every point of a the index of the
+# closest point of b, and for every point of b the index of the closest point of a.
+# the pairwise distances are computed in blocks of rows of a, so at most memory_budget
+# bytes of them exist at a time, on whichever device the points are
+@torch.no_grad()
+def chamfer_dist(a, b, memory_budget=None):
+	if memory_budget is None:
+		memory_budget = CHAMFER_MEMORY_BUDGET
+	batch_size, num_a, num_b = a.shape[0], a.shape[1], b.shape[1]
+	a = a.contiguous()
+	b = b.contiguous()
+	chunk = max(1, memory_budget // (batch_size * num_b * a.element_size()))
+
+	sq_b = torch.sum(b**2, dim = -1).unsqueeze(1)
+	b_t = b.transpose(1, 2)
+	id_a = torch.empty(batch_size, num_a, dtype=torch.long, device=a.device)
+	best_b = torch.full((batch_size, num_b), float('inf'), dtype=a.dtype, device=a.device)
+	id_b = torch.zeros(batch_size, num_b, dtype=torch.long, device=a.device)
+	for start in range(0, num_a, chunk):
+		a_chunk = a[:, start:start + chunk]
+		# |a|^2 + |b|^2 - 2 a.b for this block of rows
+		dists = torch.baddbmm(sq_b, a_chunk, b_t, alpha=-2).add_(torch.sum(a_chunk**2, dim = -1).unsqueeze(-1))
+		id_a[:, start:start + chunk] = dists.argmin(dim = 2)
+		chunk_best, chunk_id = dists.min(dim = 1)
+		closer = chunk_best < best_b
+		best_b = torch.where(closer, chunk_best, best_b)
+		id_b = torch.where(closer, chunk_id + start, id_b)
+	return id_a, id_b
+
+
+# precision, recall and f-score of every item of a batch at every threshold, from dist_to_pred
+# (B x N_gt), the distance of each ground truth point to its closest predicted point, and
+# dist_to_gt (B x N_pred), the reverse. each is returned as a (B x len(thresholds)) tensor on
+# the device of the distances, so nothing is synchronized with the host
+def batch_f_score(dist_to_pred, dist_to_gt, thresholds = (1e-2,)):
+	thresholds = torch.as_tensor(thresholds, dtype=dist_to_pred.dtype, device=dist_to_pred.device)
+	recall = (dist_to_pred.unsqueeze(-1) <= thresholds).to(dist_to_pred.dtype).mean(dim = 1)
+	precision = (dist_to_gt.unsqueeze(-1) <= thresholds).to(dist_to_gt.dtype).mean(dim = 1)
+	f_score = 2*(precision * recall)/(precision + recall + 1e-8)
+	return f_score, precision, recall
+
+
+# with f1, also returns the mean f-score over the batch at each of thresholds
+def batch_point_to_point(pred_vert, adj_info, gt_points, num = 1000, f1 = False, thresholds = (1e-2,) ):
 	# grab the faces still in use
 	batch_size = pred_vert.shape[0]
 
@@ -398,7 +554,7 @@ def batch_point_to_point(pred_vert, adj_info, gt_points, num = 1000, f1 = False
 	pred_points = pred_points.view(-1,3)
 	gt_points = gt_points.contiguous().view(-1,3)
 
-	points_range = num*torch.arange(0, batch_size).cuda().unsqueeze(-1).expand(batch_size,num)
+	points_range = num*torch.arange(0, batch_size, device=pred_vert.device).unsqueeze(-1).expand(batch_size,num)
 	id_p = (id_p.long() + points_range).view(-1)
 	id_g = (id_g.long() + points_range).view(-1)
 
@@ -417,20 +573,14 @@ def batch_point_to_point(pred_vert, adj_info, gt_points, num = 1000, f1 = False
 		dist_to_pred = torch.sqrt(torch.sum((.57*pred_counters - .57*gt_points)**2, dim  = 1 )).view(batch_size, -1)
 		dist_to_gt = torch.sqrt(torch.sum((.57*gt_counters - .57*pred_points)**2, dim = 1)).view(batch_size, -1)
 
-		f_score = 0
-		for i in range(dist_to_pred.shape[0]):
-			recall = float(torch.where(dist_to_pred[i] <=1e-2)[0].shape[0]) / float(num)
-			precision = float(torch.where(dist_to_gt[i] <= 1e-2)[0].shape[0]) / float(num)
-
-
-			f_score +=  2*(precision * recall)/(precision + recall+1e-8)
-		f_score = f_score / (batch_size)
-		return loss, f_score
+		f_score, _, _ = batch_f_score(dist_to_pred, dist_to_gt, thresholds)
+		return loss, f_score.mean(dim = 0)
 	else:
 		return loss
 
 
-def batch_point_to_surface(pred_vert, adj_info, gt_points, num = 1000, f1 = False ):
+# with f1, also returns the mean f-score over the batch at each of thresholds
+def batch_point_to_surface(pred_vert, adj_info, gt_points, num = 1000, f1 = False, thresholds = (1e-2,) ):
 	# grab the faces still in use
 	batch_size = pred_vert.shape[0]
 
@@ -443,35 +593,35 @@ def batch_point_to_surface(pred_vert, adj_info, gt_points, num = 1000, f1 = Fals
 	id_p, id_g = chamfer_dist( gt_points, pred_points)
 
 	# select pairs and calculate chamfer distance
-	points_range = pred_points.shape[1]*torch.arange(0, batch_size).cuda().unsqueeze(-1).expand(batch_size,gt_points.shape[1])
+	points_range = pred_points.shape[1]*torch.arange(0, batch_size, device=pred_vert.device).unsqueeze(-1).expand(batch_size,gt_points.shape[1])
 	id_p = (id_p.long() + points_range).view(-1)
 	pred_counters = torch.index_select(pred_points.view(-1,3), 0, id_p)
 
-	points_range = gt_points.shape[1]*torch.arange(0, batch_size).cuda().unsqueeze(-1).expand(batch_size,pred_points.shape[1])
+	points_range = gt_points.shape[1]*torch.arange(0, batch_size, device=pred_vert.device).unsqueeze(-1).expand(batch_size,pred_points.shape[1])
 	id_g = (id_g.long() + points_range).view(-1)
 	gt_counters =  torch.index_select(gt_points.contiguous().view(-1,3), 0, id_g)
 
 	dist_1 = torch.mean(torch.sum((gt_counters - pred_points.view(-1,3))**2, dim  = 1))
 
 	#####
-	# ptp
+	# pts
 	#####
 	tri1 =  torch.index_select(pred_vert, 1,adj_info['faces'][:,0])
 	tri2 =  torch.index_select(pred_vert, 1,adj_info['faces'][:,1])
 	tri3 =  torch.index_select(pred_vert, 1,adj_info['faces'][:,2])
-	_, point_options, index = tri_dist(gt_points, tri1, tri2, tri3)
+	index = nearest_triangles(gt_points, tri1, tri2, tri3)
 
 	tri_sets = [tri1, tri2, tri3]
-	point_options = point_options.view(-1)
-	points_range = tri1.shape[1]*torch.arange(0, batch_size).cuda().unsqueeze(-1).expand(batch_size,gt_points.shape[1])
-	index = (index.long() + points_range).view(-1)
+	points_range = tri1.shape[1]*torch.arange(0, batch_size, device=pred_vert.device).unsqueeze(-1).expand(batch_size,gt_points.shape[1])
+	index = (index + points_range).view(-1)
 
 	for i,t in enumerate(tri_sets):
-		t = t.view(-1,3)
+		t = t.reshape(-1,3)
 		tri_sets[i] = torch.index_select(t, 0, index)
 
-	dist_2 = calc_point_to_line(gt_points.contiguous().view(-1,3), tri_sets, point_options)
-	ratio = dist_1.data.cpu().numpy()/ (dist_2.data.cpu().numpy())
+	gt_flat = gt_points.contiguous().view(-1,3)
+	counter_p = closest_point_on_triangle(gt_flat, *tri_sets)
+	dist_2 = torch.mean(torch.sum((counter_p - gt_flat)**2, dim = -1))
 
 	loss = (dist_1 + dist_2) * 3000
 
@@ -482,148 +632,245 @@ def batch_point_to_surface(pred_vert, adj_info, gt_points, num = 1000, f1 = Fals
 		dist_to_pred = torch.sqrt(torch.sum((.57*pred_counters - .57*gt_points.contiguous().view(-1,3))**2, dim  = 1 )).view(batch_size, -1)
 		dist_to_gt = torch.sqrt(torch.sum((.57*gt_counters - .57*pred_points.view(-1,3))**2, dim = 1)).view(batch_size, -1)
 
-		f_score = 0
-		for i in range(dist_to_pred.shape[0]):
-			recall = float(torch.where(dist_to_pred[i] <=1e-2)[0].shape[0]) / float(num)
-			precision = float(torch.where(dist_to_gt[i] <= 1e-2)[0].shape[0]) / float(num)
-			f_score +=  2*(precision * recall)/(precision + recall+1e-8)
-
-		f_score = f_score / (batch_size)
-		return loss, f_score
+		f_score, _, _ = batch_f_score(dist_to_pred, dist_to_gt, thresholds)
+		return loss, f_score.mean(dim = 0)
 	else:
 		return loss
 
 
 
-def calc_point_to_line(p, triangles, point_options):
-	a, b, c = triangles
-	counter_p = torch.zeros(p.shape).cuda()
-
-	EdgeAb = edge( a, b )
-	EdgeBc = edge( b, c )
-	EdgeCa = edge( c, a )
-
-	uab = EdgeAb.Project( p )
-	uca = EdgeCa.Project( p )
-	ubc = EdgeBc.Project( p )
-
-	TriNorm = torch.cross(a - b, a - c)
-	TriPlane = Plane(EdgeAb.A, TriNorm);
-
-	# type 1
-	cond = (point_options == 1)
-	counter_p[cond] = EdgeAb.A[cond]
-
-	# type 2
-	cond = (point_options == 2)
-	counter_p[cond] = EdgeBc.A[cond]
-
-	# type 3
-	cond = (point_options == 3)
-	counter_p[cond] = EdgeCa.A[cond]
-
-	# type 4
-	cond = (point_options == 4)
-	counter_p[cond] = EdgeAb.PointAt( uab )[cond]
-
-	# type 5
-	cond = (point_options == 5)
-	counter_p[cond] = EdgeBc.PointAt( ubc )[cond]
-
-	# type 6
-	cond = (point_options == 6)
-	counter_p[cond] = EdgeCa.PointAt( uca )[cond]
-
-	# type 0
-	cond = (point_options == 0)
-	counter_p[cond] = TriPlane.Project( p )[cond]
-
-	distances = torch.mean(torch.sum((counter_p - p)**2, dim = -1))
-	return distances
-
-
-class edge():
-	def __init__(self, a, b):
-		self.A = a.clone()
-		self.B = b.clone()
-		self.Delta = b - a
-
-	def PointAt(self, t):
-		return self.A + t.unsqueeze(-1)* self.Delta
-
-	def LengthSquared(self):
-		return torch.sum(self.Delta**2, dim = -1)
-
-	def Project(self, p):
-		vec = p - self.A
-		vx, vy, vz = vec[:,0], vec[:,1], vec[:,2]
-		nx, ny, nz = self.Delta[:,0], self.Delta[:,1], self.Delta[:,2]
-		vec = (vx*nx + vy*ny + vz*nz)
-		return vec / self.LengthSquared()
-
-class Plane():
-	def __init__(self, point, direction):
-		self.Point = point.clone()
-		self.Direction = direction / torch.sqrt(torch.sum(direction**2, dim=-1)).unsqueeze(-1)
-
-	def IsAbove(self, q):
-		return torch.bmm(q.unsqueeze(1), self.Point.unsqueeze(-1)).view(-1) <=0
-
-	def Project(self, point):
-		orig = self.Point
-		v = point -orig
-		vx, vy, vz = v[:,0], v[:,1], v[:,2]
-		nx, ny, nz = self.Direction[:,0], self.Direction[:,1], self.Direction[:,2]
-		dist = (vx*nx + vy*ny + vz*nz).unsqueeze(-1)
-		projected_point = point - dist*self.Direction
-		return projected_point
-
-
-def batch_sample(verts, faces, num=10000):
-
-	dist_uni = torch.distributions.Uniform(torch.tensor([0.0]).cuda(), torch.tensor([1.0]).cuda())
-	batch_size = verts.shape[0]
-	# calculate area of each face
-
-	x1,x2,x3 = torch.split(torch.index_select(verts, 1,faces[:,0]) - torch.index_select(verts, 1,faces[:,1]), 1, dim = -1)
-	y1,y2,y3 = torch.split(torch.index_select(verts, 1,faces[:,1]) - torch.index_select(verts, 1,faces[:,2]), 1, dim = -1)
-	a = (x2*y3-x3*y2)**2
-	b = (x3*y1 - x1*y3)**2
-	c = (x1*y2 - x2*y1)**2
-	Areas = torch.sqrt(a+b+c)/2
-	Areas = Areas.squeeze(-1) /  torch.sum(Areas, dim = 1) # percentage of each face w.r.t. full surface area
-
-
-	# define descrete distribution w.r.t. face area ratios caluclated
-	choices = None
-	for A in Areas:
-
-		if choices is None:
-			choices = torch.multinomial(A, num, True)# list of faces to be sampled from
-		else:
-			choices = torch.cat((choices, torch.multinomial(A, num, True)))
-
-	# from each face sample a point
-	select_faces = faces[choices].view(verts.shape[0],3,num)
-
-
-	face_arange = verts.shape[1] * torch.arange(0, batch_size).cuda().unsqueeze(-1).expand(batch_size,num)
-	select_faces = select_faces + face_arange.unsqueeze(1)
-
-	select_faces = select_faces.view(-1,3)
-	flat_verts = verts.view(-1, 3)
-
-	xs = torch.index_select(flat_verts, 0, select_faces[:,0])
-	ys = torch.index_select(flat_verts, 0, select_faces[:,1])
-	zs = torch.index_select(flat_verts, 0, select_faces[:,2])
-	u = torch.sqrt(dist_uni.sample_n(batch_size*num))
-	v = dist_uni.sample_n(batch_size*num)
-
-	points = (1- u)*xs + (u*(1-v))*ys + u*v*zs
-	points = points.view(batch_size, num, 3)
-
+# closest point to p on the triangle (a, b, c), for tensors of matching shape (... x 3).
+# the voronoi region of p (a vertex, an edge or the face) is resolved into barycentric
+# weights (v, w) with one pass of selects, following Ericson, Real-Time Collision Detection 5.1.5
+def closest_point_on_triangle(p, a, b, c):
+	ab = b - a
+	ac = c - a
+	ap = p - a
+	bp = p - b
+	cp = p - c
+	d1 = torch.sum(ab*ap, dim = -1)
+	d2 = torch.sum(ac*ap, dim = -1)
+	d3 = torch.sum(ab*bp, dim = -1)
+	d4 = torch.sum(ac*bp, dim = -1)
+	d5 = torch.sum(ab*cp, dim = -1)
+	d6 = torch.sum(ac*cp, dim = -1)
+	va = d3*d6 - d5*d4
+	vb = d5*d2 - d1*d6
+	vc = d1*d4 - d3*d2
+
+	# denominators of the unselected regions may be zero, keep them finite so no nan leaks into gradients
+	def ratio(num, den):
+		return num / torch.where(den == 0, torch.ones_like(den), den)
+
+	zero = torch.zeros_like(d1)
+	one = torch.ones_like(d1)
+	# inside the face
+	v = ratio(vb, va + vb + vc)
+	w = ratio(vc, va + vb + vc)
+	# the later a region is selected, the higher its precedence
+	on_bc = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+	w_bc = ratio(d4 - d3, (d4 - d3) + (d5 - d6))
+	v = torch.where(on_bc, 1 - w_bc, v)
+	w = torch.where(on_bc, w_bc, w)
+	on_ac = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+	v = torch.where(on_ac, zero, v)
+	w = torch.where(on_ac, ratio(d2, d2 - d6), w)
+	at_c = (d6 >= 0) & (d5 <= d6)
+	v = torch.where(at_c, zero, v)
+	w = torch.where(at_c, one, w)
+	on_ab = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+	v = torch.where(on_ab, ratio(d1, d1 - d3), v)
+	w = torch.where(on_ab, zero, w)
+	at_b = (d3 >= 0) & (d4 <= d3)
+	v = torch.where(at_b, one, v)
+	w = torch.where(at_b, zero, w)
+	at_a = (d1 <= 0) & (d2 <= 0)
+	v = torch.where(at_a, zero, v)
+	w = torch.where(at_a, zero, w)
+
+	return a + v.unsqueeze(-1)*ab + w.unsqueeze(-1)*ac
+
+# distance from points (U x 3) to each of their triangles (U x T x 3 each)
+def _triangle_distances(points, tri1, tri2, tri3):
+	points = points.unsqueeze(-2).expand_as(tri1)
+	return torch.linalg.norm(closest_point_on_triangle(points, tri1, tri2, tri3) - points, dim = -1)
+
+# nearest_triangles without a grid: the bounding sphere of each
+# triangle gives a lower bound on its distance, and only the k triangles with the lowest bound
+# are evaluated exactly; for points whose closest candidate is further than the k-th bound,
+# the remaining triangles with a bound below that distance are evaluated as well
+def _nearest_by_bounds(points, tri1, tri2, tri3, k, memory_budget):
+	batch_size, num_points, num_tris = points.shape[0], points.shape[1], tri1.shape[1]
+	k = min(k, num_tris)
+	centroids = (tri1 + tri2 + tri3) / 3
+	radii = torch.stack([torch.linalg.norm(t - centroids, dim = -1) for t in (tri1, tri2, tri3)]).amax(dim = 0)
+	batch_range = torch.arange(batch_size, device=points.device).view(-1, 1, 1)
+
+	index = torch.empty(batch_size, num_points, dtype=torch.long, device=points.device)
+	chunk = max(1, memory_budget // (batch_size * num_tris * points.element_size()))
+	for start in range(0, num_points, chunk):
+		p = points[:, start:start + chunk]
+		lower = torch.cdist(p, centroids, compute_mode='donot_use_mm_for_euclid_dist') - radii.unsqueeze(1)
+		bound, candidates = torch.topk(lower, k, dim = 2, largest=False)
+		dists = _triangle_distances(p, tri1[batch_range, candidates], tri2[batch_range, candidates], tri3[batch_range, candidates])
+		best, arg = dists.min(dim = 2)
+		index[:, start:start + chunk] = candidates.gather(2, arg.unsqueeze(-1)).squeeze(-1)
+
+		if k < num_tris:
+			# only triangles whose bound is below the best candidate can still be closer
+			batch_ids, point_ids = torch.nonzero(best > bound[:, :, -1], as_tuple=True)
+			step = max(1, memory_budget // (16 * num_tris * points.element_size()))
+			for i in range(0, batch_ids.shape[0], step):
+				b_i, p_i = batch_ids[i:i + step], point_ids[i:i + step]
+				pair_point, pair_tri = torch.nonzero(lower[b_i, p_i] <= best[b_i, p_i].unsqueeze(-1), as_tuple=True)
+				pair_batch = b_i[pair_point]
+				pair_p = p[pair_batch, p_i[pair_point]]
+				dists = torch.linalg.norm(closest_point_on_triangle(pair_p, tri1[pair_batch, pair_tri], tri2[pair_batch, pair_tri], tri3[pair_batch, pair_tri]) - pair_p, dim = -1)
+				closest = torch.full((b_i.shape[0],), float('inf'), dtype=dists.dtype, device=dists.device)
+				closest = closest.scatter_reduce(0, pair_point, dists, reduce='amin')
+				hit = dists <= closest[pair_point]
+				index[b_i[pair_point[hit]], start + p_i[pair_point[hit]]] = pair_tri[hit]
+	return index
+
+# offsets of the cells at chebyshev distance r from a cell
+def _grid_ring(r, device):
+	steps = torch.arange(-r, r + 1, device=device)
+	offsets = torch.cartesian_prod(steps, steps, steps).view(-1, 3)
+	return offsets[offsets.abs().amax(dim = 1) == r]
+
+# uniform grid over the triangles tri1, tri2, tri3 (T x 3) of one mesh, covering points as well.
+# cells are about the size of a typical triangle, and every triangle is listed under each cell
+# its bounding box overlaps: tri_ids sorted by cell, with the run of cell c starting at cell_start[c]
+def _triangle_grid(points, tri1, tri2, tri3):
+	tris = torch.stack((tri1, tri2, tri3))
+	tri_lo, tri_hi = tris.amin(dim = 0), tris.amax(dim = 0)
+	lo = torch.minimum(tri_lo.amin(dim = 0), points.amin(dim = 0))
+	hi = torch.maximum(tri_hi.amax(dim = 0), points.amax(dim = 0))
+	# at most ~2 cbrt(T) cells along each axis, so the grid holds about 8 T cells
+	cell = max(float((hi - lo).max()) / (2 * tri1.shape[0] ** (1 / 3)),
+		float((tri_hi - tri_lo).amax(dim = 1).median()), 1e-12)
+	dims = ((hi - lo) / cell).floor().long() + 1
+
+	def cell_of(x):
+		return torch.minimum(((x - lo) / cell).floor().long().clamp(min = 0), dims - 1)
+
+	def code_of(cells):
+		return (cells[..., 0] * dims[1] + cells[..., 1]) * dims[2] + cells[..., 2]
+
+	first = cell_of(tri_lo)
+	spans = cell_of(tri_hi) - first + 1
+	counts = spans.prod(dim = 1)
+	tri_ids = torch.repeat_interleave(torch.arange(tri1.shape[0], device=tri1.device), counts)
+	local = torch.arange(tri_ids.shape[0], device=tri1.device) - torch.repeat_interleave(counts.cumsum(0) - counts, counts)
+	spans = spans[tri_ids]
+	offsets = torch.stack((local // (spans[:, 1] * spans[:, 2]), (local // spans[:, 2]) % spans[:, 1], local % spans[:, 2]), dim = 1)
+	codes = code_of(first[tri_ids] + offsets)
+	codes, order = torch.sort(codes)
+	cell_start = torch.zeros(int(dims.prod()) + 1, dtype=torch.long, device=tri1.device)
+	cell_start[1:] = torch.bincount(codes, minlength=int(dims.prod())).cumsum(0)
+	return tri_ids[order], cell_start, cell, dims, cell_of, code_of
+
+# nearest_triangles for the points (P x 3) of one mesh. every point searches the cells at
+# chebyshev distance 0, 1, ... from its own, and is done once its closest triangle so far is
+# nearer than the ring: anything outside the searched block of cells is further away than that.
+# points still open after max_rings rings are left to _nearest_by_bounds
+def _nearest_in_grid(points, tri1, tri2, tri3, max_rings, k, memory_budget):
+	num_points = points.shape[0]
+	tri_ids, cell_start, cell, dims, cell_of, code_of = _triangle_grid(points, tri1, tri2, tri3)
+	point_cells = cell_of(points)
+	best = torch.full((num_points,), float('inf'), dtype=points.dtype, device=points.device)
+	index = torch.zeros(num_points, dtype=torch.long, device=points.device)
+	max_pairs = max(1, memory_budget // (64 * points.element_size()))
+
+	active = torch.arange(num_points, device=points.device)
+	for r in range(max_rings + 1):
+		cells = point_cells[active].unsqueeze(1) + _grid_ring(r, points.device)
+		pair_point, pair_cell = torch.nonzero(((cells >= 0) & (cells < dims)).all(dim = -1), as_tuple=True)
+		codes = code_of(cells[pair_point, pair_cell])
+		starts, sizes = cell_start[codes], cell_start[codes + 1] - cell_start[codes]
+		# (point, triangle) pairs, about max_pairs at a time
+		limits = torch.arange(max_pairs, int(sizes.sum()) + max_pairs, max_pairs, device=sizes.device)
+		splits = torch.searchsorted(sizes.cumsum(0), limits, right=True).tolist()
+		for lo_i, hi_i in zip([0] + splits, splits):
+			if hi_i <= lo_i:
+				continue
+			chunk_sizes = sizes[lo_i:hi_i]
+			chunk_ends = chunk_sizes.cumsum(0)
+			local = torch.arange(int(chunk_ends[-1]), device=points.device) - torch.repeat_interleave(chunk_ends - chunk_sizes, chunk_sizes)
+			tri = tri_ids[torch.repeat_interleave(starts[lo_i:hi_i], chunk_sizes) + local]
+			point = active[torch.repeat_interleave(pair_point[lo_i:hi_i], chunk_sizes)]
+			p = points[point]
+			dists = torch.linalg.norm(closest_point_on_triangle(p, tri1[tri], tri2[tri], tri3[tri]) - p, dim = -1)
+			best.scatter_reduce_(0, point, dists, reduce='amin')
+			hit = dists <= best[point]
+			index[point[hit]] = tri[hit]
+		if r >= int(dims.max()) - 1:
+			return index
+		active = active[best[active] > r * cell]
+		if active.shape[0] == 0:
+			return index
+
+	index[active] = _nearest_by_bounds(points[active].unsqueeze(0), tri1.unsqueeze(0), tri2.unsqueeze(0), tri3.unsqueeze(0),
+		k, memory_budget).squeeze(0)
+	return index
+
+# index of the closest triangle for every point of points (B x P x 3) among the triangles
+# tri1, tri2, tri3 (B x T x 3), replacing the tri_dist extension. the triangles of each mesh
+# are bucketed into a uniform grid, so a point near the surface only measures the triangles
+# of the few cells around it. points further than max_rings cells from the surface fall back
+# to the bounding sphere search of _nearest_by_bounds, which bounds every triangle, so their
+# cost stays linear in the number of triangles
+@torch.no_grad()
+def nearest_triangles(points, tri1, tri2, tri3, max_rings=1, k=16, memory_budget=None):
+	if memory_budget is None:
+		memory_budget = CHAMFER_MEMORY_BUDGET
+	return torch.stack([_nearest_in_grid(points[b], tri1[b], tri2[b], tri3[b], max_rings, k, memory_budget)
+		for b in range(points.shape[0])])
+
+
+# samples num points uniformly on the surface of every mesh in a packed batch: verts
+# (total_verts x 3), faces (total_faces x 3) indexing into verts, and face_offsets
+# (batch_size + 1) so that faces[face_offsets[i]:face_offsets[i+1]] are the faces of mesh i.
+# runs on the device of verts; pass a generator or a seed for reproducible samples.
+# with return_barycentric, also returns the packed index of the face each point lies on
+# and its barycentric coordinates, to interpolate normals or colors the same way
+def packed_sample(verts, faces, face_offsets, num=10000, return_barycentric=False, generator=None, seed=None):
+	device = verts.device
+	if seed is not None:
+		generator = torch.Generator(device=device).manual_seed(seed)
+	batch_size = face_offsets.shape[0] - 1
+
+	# area of each face, accumulated over the whole packed batch
+	v1, v2, v3 = verts[faces[:, 0]], verts[faces[:, 1]], verts[faces[:, 2]]
+	areas = torch.linalg.norm(torch.cross(v2 - v1, v3 - v1, dim=-1), dim=-1) / 2
+	cum_areas = torch.cumsum(areas.double(), dim=0)
+	cum_areas = torch.cat((torch.zeros(1, dtype=cum_areas.dtype, device=device), cum_areas))
+	start, end = cum_areas[face_offsets[:-1]], cum_areas[face_offsets[1:]]
+
+	# a uniform draw within each mesh's range of the cumulative area picks a
+	# face with probability proportional to its area, for all meshes at once
+	r = torch.rand(batch_size, num, 3, generator=generator, device=device, dtype=cum_areas.dtype)
+	targets = start.unsqueeze(-1) + r[:, :, 0] * (end - start).unsqueeze(-1)
+	face_ids = torch.searchsorted(cum_areas[1:], targets.view(-1), right=True).view(batch_size, num)
+	face_ids = torch.minimum(torch.maximum(face_ids, face_offsets[:-1].unsqueeze(-1)), face_offsets[1:].unsqueeze(-1) - 1)
+
+	u = torch.sqrt(r[:, :, 1]).to(verts.dtype)
+	v = r[:, :, 2].to(verts.dtype)
+	barycentric = torch.stack((1 - u, u * (1 - v), u * v), dim=-1)
+	triangles = verts[faces[face_ids]]
+	points = (barycentric.unsqueeze(-1) * triangles).sum(dim=-2)
+
+	if return_barycentric:
+		return points, face_ids, barycentric
 	return points
 
+# samples num points on each of a batch of meshes sharing the same faces, verts (batch_size x N x 3)
+def batch_sample(verts, faces, num=10000, return_barycentric=False, generator=None, seed=None):
+	batch_size, num_verts = verts.shape[0], verts.shape[1]
+	packed_faces = (faces.unsqueeze(0) + num_verts * torch.arange(batch_size, device=faces.device).view(-1, 1, 1)).view(-1, 3)
+	face_offsets = faces.shape[0] * torch.arange(batch_size + 1, device=faces.device)
+	return packed_sample(verts.reshape(-1, 3), packed_faces, face_offsets, num, return_barycentric, generator, seed)
+
 
 def batch_calc_edge( verts, info):
 
@@ -644,11 +891,91 @@ def batch_calc_edge( verts, info):
 
 
 def batch_get_lap_info(positions, adj_info):
-	orig = adj_info['adj_orig']
-	nieghbor_sum = torch.matmul(orig,positions ) - positions
-	degrees = torch.sum(orig, dim = 1 ) - 1
-	degree_scaler = (1./degrees).view(-1,1)
-
-	nieghbor_sum =nieghbor_sum*degree_scaler
-	lap = positions - nieghbor_sum
-	return lap
+	# the topology never changes, so the operator is built once per face tensor
+	return laplacian_operator(adj_info['faces'], num_verts=positions.shape[-2])(positions)
+
+
+# laplacian of a fixed mesh topology: each vertex minus the weighted mean of its neighbours,
+# for positions of shape (N x 3) or (B x N x 3). the neighbour weights are held as a sparse
+# CSR matrix with the inverse of their row sums. uniform weights give the mean of the
+# neighbours, as batch_get_lap_info always did; cotangent weights are taken from the
+# angles of the mesh at verts
+class LaplacianOperator(object):
+	def __init__(self, faces, num_verts=None, weights='uniform', verts=None):
+		faces = faces.long()
+		if num_verts is None:
+			num_verts = int(faces.max()) + 1 if verts is None else verts.shape[-2]
+		if weights == 'uniform':
+			adj = sparse_adj(faces, num_verts=num_verts, self_loops=False)
+			rows, cols, values = adj.indices()[0], adj.indices()[1], adj.values()
+		elif weights == 'cotangent':
+			assert verts is not None, 'cotangent weights need the vertex positions'
+			rows, cols, values = cotangent_weights(faces, verts.detach(), num_verts)
+			# edges opposite obtuse angles get negative weights, which can leave a row summing
+			# to zero or less; clamped, every vertex is compared to a convex combination of its neighbours
+			values = values.clamp_min(0)
+		else:
+			raise ValueError('unknown laplacian weights ' + weights)
+
+		degrees = torch.zeros(num_verts, dtype=values.dtype, device=faces.device).index_add_(0, rows, values)
+		inv_degrees = 1. / degrees
+		inv_degrees[~torch.isfinite(inv_degrees)] = 0.
+		self.weights = weights
+		self.num_verts = num_verts
+		self.inv_degrees = inv_degrees.unsqueeze(-1)
+		self.matrix = torch.sparse_coo_tensor(torch.stack((rows, cols)), values, (num_verts, num_verts),
+			is_coalesced=True, check_invariants=False).to_sparse_csr()
+
+	def __call__(self, positions):
+		neighbour_mean = adj_matmul(self.matrix.to(positions.dtype), positions) * self.inv_degrees.to(positions.dtype)
+		return positions - neighbour_mean
+
+# half the sum of the cotangents of the two angles opposite each edge, as coalesced
+# (rows, cols, values) of a symmetric num_verts x num_verts matrix
+def cotangent_weights(faces, verts, num_verts):
+	rows, cols, values = [], [], []
+	for i, j, k in [(0, 1, 2), (1, 2, 0), (2, 0, 1)]:
+		# the angle at corner i is opposite the edge (j, k)
+		e1 = verts[faces[:, j]] - verts[faces[:, i]]
+		e2 = verts[faces[:, k]] - verts[faces[:, i]]
+		cot = torch.sum(e1*e2, dim = -1) / torch.linalg.norm(torch.cross(e1, e2, dim = -1), dim = -1).clamp_min(1e-12)
+		rows += [faces[:, j], faces[:, k]]
+		cols += [faces[:, k], faces[:, j]]
+		values += [cot / 2, cot / 2]
+	adj = torch.sparse_coo_tensor(torch.stack((torch.cat(rows), torch.cat(cols))), torch.cat(values), (num_verts, num_verts),
+		check_invariants=False).coalesce()
+	return adj.indices()[0], adj.indices()[1], adj.values()
+
+# operators laplacian_operator keeps, least recently used first
+LAPLACIAN_CACHE_SIZE = 64
+_laplacian_cache = OrderedDict()
+# one finalizer per live face tensor, by id, dropping its entries when it is freed
+_laplacian_finalizers = {}
+
+def _release_laplacian(faces_id):
+	_laplacian_finalizers.pop(faces_id, None)
+	for key in [key for key in _laplacian_cache if key[0] == faces_id]:
+		del _laplacian_cache[key]
+
+# the LaplacianOperator of faces, built on the first call and reused for as long as the face
+# tensor lives and is not modified in place. cotangent operators are also tied to verts.
+# there is one entry per mesh, rebuilt when its tensors are modified in place, and at most
+# LAPLACIAN_CACHE_SIZE of them
+def laplacian_operator(faces, num_verts=None, weights='uniform', verts=None):
+	key = (id(faces), num_verts, weights)
+	versions = (faces._version,)
+	if weights != 'uniform':
+		key = key + (id(verts),)
+		versions = versions + (verts._version,)
+	cached = _laplacian_cache.get(key)
+	if cached is not None and cached[0]() is faces and (verts is None or cached[1]() is verts) and cached[2] == versions:
+		_laplacian_cache.move_to_end(key)
+		return cached[3]
+	operator = LaplacianOperator(faces, num_verts, weights, verts)
+	if id(faces) not in _laplacian_finalizers:
+		_laplacian_finalizers[id(faces)] = weakref.finalize(faces, _release_laplacian, id(faces))
+	_laplacian_cache[key] = (weakref.ref(faces), None if verts is None else weakref.ref(verts), versions, operator)
+	_laplacian_cache.move_to_end(key)
+	while len(_laplacian_cache) > LAPLACIAN_CACHE_SIZE:
+		_laplacian_cache.popitem(last=False)
+	return operator